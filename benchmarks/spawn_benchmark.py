@@ -0,0 +1,74 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the spawn strategies of PopenJob while the controller holds a lot of memory.
+
+    python benchmarks/spawn_benchmark.py --memory 0 512 2048 --spawns 200
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from boerewors import spawn  # noqa: E402
+from boerewors.history import median  # noqa: E402
+from subprocess import PIPE, STDOUT  # noqa: E402
+
+
+def allocate(megabytes):
+    # touch every page, so the memory is really mapped and has to be copied by fork
+    ballast = bytearray(megabytes * 1024 * 1024)
+    for offset in range(0, len(ballast), 4096):
+        ballast[offset] = 1
+    return ballast
+
+
+def measure(strategy, spawns, command):
+    spawn.set_strategy(strategy)
+    durations = []
+    for _ in range(spawns):
+        before = time.time()
+        proc = spawn.spawn(command, stdout=PIPE, stderr=STDOUT, start_new_session=True)
+        durations.append(time.time() - before)
+        proc.stdout.read()
+        proc.wait()
+    durations.sort()
+    return median(durations), durations[int(len(durations) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--memory', type=int, nargs='+', default=[0, 256, 1024],
+                        help="megabytes the controller holds while spawning")
+    parser.add_argument('--spawns', type=int, default=200, help="processes per strategy and memory size")
+    parser.add_argument('--strategies', nargs='+', default=['popen', 'posix_spawn'], choices=spawn.STRATEGIES)
+    args = parser.parse_args()
+
+    print("{:>8} {:>12} {:>12} {:>12}".format("memory", "strategy", "median ms", "p95 ms"))
+    ballast = []
+    allocated = 0
+    for megabytes in sorted(args.memory):
+        ballast.append(allocate(megabytes - allocated))
+        allocated = megabytes
+        for strategy in args.strategies:
+            p50, p95 = measure(strategy, args.spawns, ["true"])
+            print("{:>6}MB {:>12} {:>12.3f} {:>12.3f}".format(megabytes, strategy, p50 * 1000, p95 * 1000))
+
+
+if __name__ == '__main__':
+    main()
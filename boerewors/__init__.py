@@ -12,5 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
+
 from .__version__ import __version__, __git_hash__
-from . import errors, executor, helper, jobs, logging_helper, pool, result, runners, stage
+
+_submodules = ('agent', 'broadcast', 'cache', 'cluster', 'errors', 'executor', 'fanout', 'helper', 'history', 'http',
+               'inventory', 'jobs', 'journal', 'logging_helper', 'pool', 'prefetch', 'prewarm', 'profiling', 'ratelimit', 'remote',
+               'report', 'result', 'retry', 'runners', 'sharded_pool', 'spawn', 'stage', 'timers', 'warmup')
+
+if sys.version_info >= (3, 7):
+    # the submodules are imported on first access, `import boerewors` stays cheap for the cli
+    from importlib import import_module
+
+    def __getattr__(name):
+        if name in _submodules:
+            return import_module('.' + name, __name__)
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    def __dir__():
+        return sorted(set(globals()) | set(_submodules))
+else:
+    from . import agent, broadcast, cache, cluster, errors, executor, fanout, helper, history, http, inventory, jobs, journal, logging_helper, pool, prefetch, prewarm, profiling, ratelimit, remote, report, result, retry, runners, sharded_pool, spawn, stage, timers, warmup  # noqa
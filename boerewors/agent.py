@@ -0,0 +1,198 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A small agent that runs commands and file operations for boerewors on a target host.
+
+It only needs the python standard library (2.7 or 3), so it is started over ssh by sending this file to
+`python -c` (see boerewors.remote.AgentConnection), no installation on the host is needed. Requests and responses
+are frames on stdin and stdout: a 4 byte big endian length followed by a utf8 json object. Every request has an
+`id` and an `op`, the response has the same `id`. Requests are handled in order, the response of a request is sent
+as soon as it is done, so a client can send a batch of requests without waiting.
+
+    {"id": 1, "op": "run", "command": "systemctl restart app", "timeout": 60}
+    {"id": 1, "returncode": 0, "stdout": "..."}
+"""
+
+import base64
+import json
+import os
+import signal
+import struct
+import subprocess
+import sys
+import time
+from select import select
+
+HEADER = struct.Struct('>I')
+
+
+def encode_frame(message):
+    data = json.dumps(message).encode('utf8')
+    return HEADER.pack(len(data)) + data
+
+
+def read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_frame(stream, max_size=None):
+    """
+    Read the next message from a blocking stream, None at the end of the stream. A message bigger than max_size
+    bytes raises a ValueError.
+    """
+    header = read_exactly(stream, HEADER.size)
+    if header is None:
+        return None
+    size = HEADER.unpack(header)[0]
+    if max_size is not None and size > max_size:
+        raise ValueError("message of {} bytes, at most {} are expected".format(size, max_size))
+    data = read_exactly(stream, size)
+    if data is None:
+        return None
+    return json.loads(data.decode('utf8'))
+
+
+class FrameReader(object):
+    """
+    Splits the data of a non-blocking stream into messages.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            size = HEADER.unpack_from(self.buffer, offset)[0]
+            end = offset + HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            messages.append(json.loads(bytes(self.buffer[offset + HEADER.size:end]).decode('utf8')))
+            offset = end
+        # the frames are cut off once per feed, not once per frame
+        del self.buffer[:offset]
+        return messages
+
+
+def read_output(proc, timeout=None):
+    """
+    Return the output of the process and whether it finished within timeout seconds (python 2 has no timeout for
+    communicate).
+    """
+    deadline = time.time() + timeout if timeout is not None else None
+    fileno = proc.stdout.fileno()
+    chunks = []
+    while True:
+        remaining = deadline - time.time() if deadline is not None else None
+        if remaining is not None and remaining <= 0:
+            return b''.join(chunks), False
+        if select([fileno], [], [], remaining)[0]:
+            data = os.read(fileno, 65536)
+            if not data:
+                break
+            chunks.append(data)
+    proc.wait()
+    return b''.join(chunks), True
+
+
+def run_command(request):
+    kwargs = {}
+    if sys.version_info[0] >= 3:
+        kwargs['start_new_session'] = True
+    else:
+        kwargs['preexec_fn'] = os.setsid
+    proc = subprocess.Popen(['bash', '-c', request['command']], stdin=open(os.devnull),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=request.get('cwd'), **kwargs)
+    timeout = request.get('timeout')
+    stdout, finished = read_output(proc, timeout)
+    if not finished:
+        os.killpg(proc.pid, signal.SIGKILL)
+        stdout += read_output(proc)[0]
+        return dict(returncode=None, stdout=stdout.decode('utf8', 'replace'),
+                    error="command exceeded its timeout of {}s".format(timeout))
+    return dict(returncode=proc.returncode, stdout=stdout.decode('utf8', 'replace'))
+
+
+def write_file(request):
+    path = request['path']
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    data = base64.b64decode(request['data'])
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as target:
+        target.write(data)
+    if request.get('mode') is not None:
+        os.chmod(tmp_path, request['mode'])
+    os.rename(tmp_path, path)
+    return dict(size=len(data))
+
+
+def read_file(request):
+    with open(request['path'], 'rb') as source:
+        return dict(data=base64.b64encode(source.read()).decode('ascii'))
+
+
+def ping(request):
+    return dict(pid=os.getpid())
+
+
+OPERATIONS = {
+    'run': run_command,
+    'write': write_file,
+    'read': read_file,
+    'ping': ping,
+}
+
+
+def handle(request):
+    operation = OPERATIONS.get(request.get('op'))
+    try:
+        if operation is None:
+            raise ValueError("unknown operation {}".format(request.get('op')))
+        response = operation(request)
+    except Exception as e:
+        response = dict(error="{}: {}".format(e.__class__.__name__, e))
+    response['id'] = request.get('id')
+    return response
+
+
+def serve(stdin, stdout):
+    while True:
+        request = read_frame(stdin)
+        if request is None or request.get('op') == 'exit':
+            return
+        stdout.write(encode_frame(handle(request)))
+        stdout.flush()
+
+
+def main():
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    # keep the protocol stream clean, even if something prints
+    sys.stdout = sys.stderr
+    serve(stdin, stdout)
+
+
+if __name__ == '__main__':
+    main()
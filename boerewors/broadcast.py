@@ -0,0 +1,189 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+from collections import OrderedDict
+
+from .errors import JobTimeout
+from .jobs import Job, PopenJob, SSHJob
+from .stage import Stage
+
+
+class OutputGroups(object):
+
+    def __init__(self, normalize=None):
+        """OutputGroups(normalize=None)
+
+        normalize:  type Callable[[str], str] applied to an output before it is compared, e.g. to strip timestamps
+
+        Stores every distinct output of a broadcast once, together with the hosts that returned it. Outputs are
+        compared by their exit status and the sha256 of the (normalized) output.
+        """
+        self.normalize = normalize
+        self.groups = OrderedDict()
+        self._host_keys = {}
+
+    def get_key(self, status, output):
+        if self.normalize is not None:
+            output = self.normalize(output)
+        return status, hashlib.sha256(output.encode('utf8')).hexdigest()
+
+    def add(self, host, status, output):
+        """
+        Add the output of a host and return the stored output of its group, so jobs can drop their own copy.
+        A host that is added again (e.g. retried) moves to its new group.
+        """
+        output = output or ""
+        key = self.get_key(status, output)
+        old_key = self._host_keys.get(host)
+        if old_key is not None:
+            self.remove(host)
+        if key not in self.groups:
+            self.groups[key] = (output, [])
+        self.groups[key][1].append(host)
+        self._host_keys[host] = key
+        return self.groups[key][0]
+
+    def remove(self, host):
+        key = self._host_keys.pop(host)
+        hosts = self.groups[key][1]
+        hosts.remove(host)
+        if not hosts:
+            del self.groups[key]
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        """
+        Yield (status, output, hosts) with the biggest groups first.
+        """
+        for (status, _), (output, hosts) in sorted(self.groups.items(), key=lambda item: -len(item[1][1])):
+            yield status, output, hosts
+
+    def summary(self, max_hosts=5, max_lines=5):
+        """
+        Return one line per group like "1987 hosts: OK" or "13 hosts (exit 1): disk full", followed by the
+        last lines of the output and some of the hosts of failed groups.
+        """
+        lines = []
+        for status, output, hosts in self:
+            last_lines = output.strip().splitlines()[-max_lines:]
+            if status == 0:
+                label = "OK"
+            elif status is None:
+                label = "timed out"
+            else:
+                label = "exit {}".format(status)
+            count = "{} host{}".format(len(hosts), "" if len(hosts) == 1 else "s")
+            if len(last_lines) == 1:
+                lines.append("{} ({}): {}".format(count, label, last_lines[0]))
+            else:
+                lines.append("{} ({})".format(count, label) + "".join("\n    " + line for line in last_lines))
+            if status != 0:
+                more = len(hosts) - max_hosts
+                lines.append("    hosts: {}{}".format(", ".join(hosts[:max_hosts]),
+                                                      " (+{} more)".format(more) if more > 0 else ""))
+        return lines
+
+
+class BroadcastSSHJob(SSHJob):
+
+    def start(self):
+        # the command is logged once by the stage, not for every host
+        PopenJob.start(self)
+
+
+class BroadcastJob(Job):
+
+    def __init__(self, host, command, groups, user=None, timeout=None):
+        """BroadcastJob(host, command, groups, user=None, timeout=None)
+
+        host:       type str the host that runs the command
+        command:    type str bash command
+        groups:     type OutputGroups shared by all jobs of the broadcast
+        user:       type str ssh user
+        timeout:    type float seconds for the command
+
+        Runs the command over ssh and adds its output to the groups. The job only keeps a reference to the
+        output of its group, so n hosts with the same output need the memory of one.
+        """
+        super(BroadcastJob, self).__init__()
+        self.host = host
+        self.command = command
+        self.groups = groups
+        self.user = user
+        self.command_timeout = timeout
+        self.output = None
+
+    def remote_command(self):
+        return BroadcastSSHJob(self.host, self.command, user=self.user, timeout=self.command_timeout)
+
+    def run_job(self):
+        yield self.remote_command()
+        try:
+            output = self.get_subtask_result('stdout', can_fail=True)
+            status = self.sub_task.get_result('return', can_fail=True)
+        except JobTimeout as e:
+            output, status = str(e), None
+        self.output = self.groups.add(self.host, status, output)
+        # the result replaces the subtask, so its copy of the output can be freed
+        if status == 0:
+            yield self.Ok(self.output)
+        elif status is None:
+            raise JobTimeout(self.output)
+        yield self.Error(self.output)
+
+
+class BroadcastStage(Stage):
+
+    job_class = BroadcastJob
+
+    def __init__(self, hosts, command, user=None, command_timeout=None, normalize=None, **kwargs):
+        """BroadcastStage(hosts, command, user=None, command_timeout=None, normalize=None, **kwargs)
+
+        hosts:              type List[str] the hosts that run the command
+        command:            type str bash command
+        user:               type str ssh user
+        command_timeout:    type float seconds for the command on a single host
+        normalize:          type Callable[[str], str] see OutputGroups
+        kwargs:             passed to Stage, e.g. pool_params
+
+        Runs one command on many hosts and logs the distinct outputs with their number of hosts at the end.
+        """
+        super(BroadcastStage, self).__init__(**kwargs)
+        self.hosts = hosts
+        self.command = command
+        self.user = user
+        self.command_timeout = command_timeout
+        self.groups = OutputGroups(normalize=normalize)
+
+    def get_jobs(self):
+        for host in self.hosts:
+            yield self.job_class(host, self.command, self.groups, user=self.user, timeout=self.command_timeout)
+
+    def setup(self):
+        super(BroadcastStage, self).setup()
+        self.log.notice("run on {} hosts: {}".format(len(self.hosts), self.command))
+
+    def collect_summary(self):
+        summary = super(BroadcastStage, self).collect_summary()
+        summary['distinct_outputs'] = len(self.groups)
+        return summary
+
+    def cleanup(self, errors):
+        for line in self.groups.summary():
+            self.log.notice(line)
+        super(BroadcastStage, self).cleanup(errors)
@@ -0,0 +1,138 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import json
+import sqlite3
+import time
+
+from .helper import LoggableObject
+
+
+def hash_key(key):
+    """
+    Return the content address of a cache key, the key can be anything json can serialize (str, tuple, dict, ...).
+    """
+    data = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+
+class ResultCache(LoggableObject):
+
+    def __init__(self, path, ttl=24 * 3600, max_entries=100000):
+        """ResultCache(path, ttl=24 * 3600, max_entries=100000)
+
+        path:           type str sqlite database file, it is created if it does not exist
+        ttl:            type float seconds a successful result stays valid
+        max_entries:    type int the least recently used results are evicted above this size
+
+        Remembers the successful results of idempotent jobs by their cache_key.
+        """
+        super(ResultCache, self).__init__()
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._pending = []
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, stored_at REAL, used_at REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)")
+        self.connection.commit()
+
+    def get(self, key):
+        """
+        Return (value, stored_at) of a valid result or None.
+        """
+        hashed_key = hash_key(key)
+        now = time.time()
+        row = self.connection.execute(
+            "SELECT value, stored_at FROM results WHERE key = ? AND stored_at > ?",
+            (hashed_key, now - self.ttl)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute("UPDATE results SET used_at = ? WHERE key = ?", (now, hashed_key))
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, value):
+        # results are written in batches, see flush
+        now = time.time()
+        self._pending.append((hash_key(key), json.dumps(value, default=str), now, now))
+
+    def flush(self):
+        if self._pending:
+            self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", self._pending)
+            self._pending = []
+        self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        self.connection.execute("DELETE FROM results WHERE stored_at <= ?", (time.time() - self.ttl,))
+        count = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used_at LIMIT ?)",
+                (count - self.max_entries,))
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class CacheRecorder(object):
+
+    def __init__(self, cache, stage, runner=None):
+        """CacheRecorder(cache, stage, runner=None)
+
+        cache:      type ResultCache
+        stage:      the running stage
+        runner:     the runner of the stage
+
+        A pool listener that skips the jobs with a cached successful result and caches the results of the
+        successful jobs. Only jobs with a cache_key take part, the key is scoped to the runner and the stage.
+        A skipped job gets the cached value as its result (Skip(value)).
+        """
+        self.cache = cache
+        self.runner_name = runner.name if runner is not None else ""
+        self.stage_key = stage._logging_info
+
+    def get_key(self, job):
+        key = getattr(job, 'cache_key', None)
+        if key is None:
+            return None
+        return (self.runner_name, self.stage_key, key)
+
+    def add_job(self, job):
+        key = self.get_key(job)
+        if key is None or getattr(job, 'skipped', False):
+            return
+        cached = self.cache.get(key)
+        if cached is not None:
+            value, stored_at = cached
+            job.log.info("cached result from {}".format(
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stored_at))))
+            job.skip(value)
+
+    def task_started(self, pool, task):
+        pass
+
+    def task_finished(self, pool, task):
+        key = self.get_key(task)
+        if key is None or task.skipped or not task.was_successful():
+            return
+        result = task._result
+        self.cache.put(key, result.value if hasattr(result, 'value') else result)
+
+    def finish(self, errors):
+        self.cache.flush()
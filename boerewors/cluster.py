@@ -0,0 +1,486 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import hmac
+import json
+import os
+import socket
+from collections import OrderedDict
+from select import select
+from time import sleep
+
+from .agent import FrameReader, encode_frame, read_frame
+from .errors import ClusterException
+from .helper import LoggableObject, monotonic, to_json
+from .inventory import shard_of
+from .pool import Pool
+from .result import Result, Ok, Err, Skip, Timeout
+
+RESULT_TYPES = dict((result_type.__name__, result_type) for result_type in (Ok, Err, Skip, Timeout))
+# the coordinator and its workers prove that they know this secret before the arguments are sent
+TOKEN_VARIABLE = 'BOEREWORS_CLUSTER_TOKEN'
+
+
+def get_token():
+    token = os.environ.get(TOKEN_VARIABLE)
+    if not token:
+        raise ClusterException("set the shared secret of the coordinator and its workers in ${}".format(
+            TOKEN_VARIABLE))
+    return token
+
+
+def new_challenge():
+    return hashlib.sha256(os.urandom(32)).hexdigest()
+
+
+def sign(token, challenge):
+    return hmac.new(token.encode('utf8'), challenge.encode('utf8'), hashlib.sha256).hexdigest()
+
+
+def verify(token, challenge, signature):
+    return hmac.compare_digest(sign(token, challenge), str(signature or ''))
+
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def encode_state(task):
+    """
+    Return the state of a task as json. Results keep their type, exceptions and values json can not encode are
+    sent as strings. Monotonic times differ between machines, so only the duration is sent.
+    """
+    state = task.get_state()
+    result = state.pop('_result', None)
+    exception = state.pop('_exception', None)
+    started_at = state.pop('started_at', None)
+    finished_at = state.pop('finished_at', None)
+    data = dict(state=dict((name, to_json(value)) for name, value in state.items()))
+    if isinstance(result, Result):
+        data['result'] = [result.__class__.__name__, to_json(result.value)]
+    else:
+        data['raw_result'] = to_json(result)
+    if exception is not None:
+        data['exception'] = str(exception)
+    if started_at is not None and finished_at is not None:
+        data['duration'] = finished_at - started_at
+    return data
+
+
+def decode_state(data):
+    state = dict(data.get('state') or {})
+    if 'result' in data:
+        name, value = data['result']
+        state['_result'] = RESULT_TYPES.get(name, Err)(value)
+    else:
+        state['_result'] = data.get('raw_result')
+    state['_exception'] = ClusterException(data['exception']) if 'exception' in data else None
+    return state
+
+
+def task_key(task):
+    """
+    Return the key the coordinator and the workers agree on, the stage and the index of the job in it.
+    """
+    return task._logging_info
+
+
+class Connection(object):
+
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.name = name
+        self.reader = FrameReader()
+        self.stream = sock.makefile('rb')
+
+    def send(self, message):
+        self.sock.sendall(encode_frame(message))
+
+    def receive(self, max_size=None):
+        """
+        Block until the next message arrives, None if the other side is gone.
+        """
+        return read_frame(self.stream, max_size)
+
+    def receive_available(self):
+        """
+        Read what arrived without blocking, None if the other side is gone.
+        """
+        data = self.sock.recv(65536)
+        if not data:
+            return None
+        return self.reader.feed(data)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+
+class Coordinator(LoggableObject):
+
+    # seconds a connecting worker has to answer the challenge, a peer that does not is rejected
+    handshake_timeout = 10
+
+    def __init__(self, address, workers, argv, accept_timeout=300, token=None):
+        """Coordinator(address, workers, argv, accept_timeout=300, token=None)
+
+        address:        type str host:port the workers connect to
+        workers:        type int number of workers that have to connect
+        argv:           type List[str] arguments the workers run the runner with
+        accept_timeout: type float seconds to wait for the workers
+        token:          type str secret shared with the workers (default: $BOEREWORS_CLUSTER_TOKEN), a peer that
+                            does not know it gets no arguments and no jobs
+
+        Runs the stages together with workers on other machines. Every worker runs the same runner with the same
+        arguments, so it creates the same stages and jobs. Canaries, non parallel stages and should_continue stay
+        on the coordinator, the jobs of parallel stages are split across the workers (see ClusterPool).
+        """
+        super(Coordinator, self).__init__()
+        self.address = parse_address(address)
+        self.workers = workers
+        self.argv = argv
+        self.accept_timeout = accept_timeout
+        self.token = get_token() if token is None else token
+        self.connections = []
+        self._server = None
+        self._stage_sent = True
+
+    def start(self):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(self.address)
+        self._server.listen(self.workers)
+        self._server.settimeout(self.accept_timeout)
+        self.log.notice("wait for {} workers on {}:{}".format(self.workers, *self.address))
+        try:
+            while len(self.connections) < self.workers:
+                sock, peer = self._server.accept()
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                connection = Connection(sock, "{}:{}".format(*peer[:2]))
+                if not self.authenticate(connection):
+                    connection.close()
+                    continue
+                sock.settimeout(None)
+                self.connections.append(connection)
+                self.log.notice("worker {} connected from {}".format(len(self.connections), connection.name))
+        except socket.timeout:
+            self.close()
+            raise ClusterException("only {} of {} workers connected".format(len(self.connections), self.workers))
+        finally:
+            if self._server is not None:
+                self._server.close()
+                self._server = None
+        return self
+
+    def authenticate(self, connection):
+        """
+        Challenge the worker to sign a random value with the token, then sign its challenge and send the arguments.
+        """
+        connection.sock.settimeout(self.handshake_timeout)
+        challenge = new_challenge()
+        try:
+            connection.send(dict(op='challenge', challenge=challenge))
+            # the peer is not trusted yet
+            answer = connection.receive(max_size=1024)
+            if not answer or answer.get('op') != 'auth' or not verify(self.token, challenge, answer.get('signature')):
+                self.log.error("rejected {}, it does not know the cluster token".format(connection.name))
+                return False
+            connection.send(dict(op='hello', worker=len(self.connections), workers=self.workers, argv=self.argv,
+                                 signature=sign(self.token, str(answer.get('challenge')))))
+        except (IOError, OSError, ValueError) as e:
+            self.log.error("handshake with {} failed: {}".format(connection.name, e))
+            return False
+        return True
+
+    def broadcast(self, message):
+        for connection in list(self.connections):
+            try:
+                connection.send(message)
+            except (IOError, OSError) as e:
+                self.log.error("lost worker {}: {}".format(connection.name, e))
+                self.connections.remove(connection)
+
+    def begin_stage(self):
+        self._stage_sent = False
+
+    def run_stage(self, assignments, pool_params):
+        self._stage_sent = True
+        for connection, tasks in zip(self.connections, assignments):
+            connection.send(dict(op='stage', tasks=tasks, pool_params=pool_params))
+
+    def end_stage(self):
+        # the workers go through the same stages, they skip the ones that ran on the coordinator
+        if not self._stage_sent:
+            self.broadcast(dict(op='skip'))
+            self._stage_sent = True
+
+    def close(self):
+        self.broadcast(dict(op='stop'))
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+
+def has_callable_limits(concurrency_limits):
+    return any(callable(limit) for limit in (concurrency_limits or {}).values())
+
+
+class ClusterPool(Pool):
+
+    # seconds the workers get after the deadline to report their expired tasks
+    deadline_grace = 10
+
+    def __init__(self, coordinator, pool_size=10, processes=None, **pool_params):
+        """ClusterPool(coordinator, pool_size=10, processes=None, **pool_params)
+
+        Runs the tasks on the workers of the coordinator, pool_size is split across them. The coordinator keeps
+        its own copy of every task and updates it with the state the workers send, so listeners, results and
+        summaries work as with a local Pool.
+
+        Tasks with concurrency keys are assigned to workers by their keys (see ShardedPool), so tasks that share
+        all of their keys run on the same worker. The limits are enforced per worker. Callable limits can not be
+        enforced across the workers, a ClusterException is raised for them (the executor runs such stages on the
+        coordinator instead).
+
+        The workers enforce the deadline themselves. A worker that did not report all of its tasks deadline_grace
+        seconds after the deadline is dropped and its remaining tasks time out.
+        """
+        super(ClusterPool, self).__init__(pool_size=pool_size, **pool_params)
+        if has_callable_limits(self.concurrency_limits):
+            raise ClusterException("callable concurrency limits can not be enforced across workers: {}".format(
+                sorted(name for name, limit in self.concurrency_limits.items() if callable(limit))))
+        self.coordinator = coordinator
+        workers = max(1, len(coordinator.connections))
+        self.worker_params = dict(pool_size=max(1, -(-pool_size // workers)))
+        if processes is not None:
+            self.worker_params['processes'] = processes
+        if 'scheduling' in pool_params:
+            self.worker_params['scheduling'] = pool_params['scheduling']
+        # every worker registers the same named rate limits, together they stay within them
+        self.worker_params['rate_limit_share'] = self.rate_limit_share / workers
+        if self.concurrency_limits:
+            self.worker_params['concurrency_limits'] = dict(self.concurrency_limits)
+        self.running_tasks = OrderedDict()
+
+    def get_worker(self, index, task, workers):
+        keys = self.get_concurrency_keys(task)
+        if keys:
+            return shard_of(json.dumps(sorted(keys), default=str), workers)
+        return index % workers
+
+    def run(self):
+        tasks = []
+        for task in self.upcomming_tasks:
+            if getattr(task, 'skipped', False):
+                # done already, e.g. resumed or cached
+                self.finish_task(task)
+            else:
+                tasks.append(task)
+        self.upcomming_tasks.clear()
+
+        connections = list(self.coordinator.connections)
+        if not connections:
+            raise ClusterException("no workers are connected")
+        assignments = [[] for _ in connections]
+        owners = {}
+        for idx, task in enumerate(tasks):
+            worker = self.get_worker(idx, task, len(connections))
+            assignments[worker].append([idx, task_key(task)])
+            owners[idx] = worker
+        pool_params = dict(self.worker_params)
+        if self.deadline is not None:
+            pool_params['timeout'] = max(0, self.deadline - monotonic())
+        self.coordinator.run_stage(assignments, pool_params)
+        self.log.info("run {} tasks on {} workers".format(len(tasks), len(connections)))
+
+        pending = set(range(len(tasks)))
+        active = dict((connection.fileno(), (worker, connection)) for worker, connection in enumerate(connections))
+
+        def unfinished(worker):
+            return [idx for idx in pending if owners[idx] == worker]
+
+        while active:
+            timeout = 1.0
+            if self.deadline is not None:
+                remaining = self.deadline + self.deadline_grace - monotonic()
+                if remaining <= 0:
+                    self.log.error("the workers did not report all tasks in time, abort the remaining tasks")
+                    for worker, connection in list(active.values()):
+                        self.lose_worker(connection, unfinished(worker), tasks, pending, "the stage timed out",
+                                         timed_out=True)
+                    break
+                timeout = min(timeout, remaining)
+            readable, _, _ = select(list(active), [], [], timeout)
+            self.tick_listeners(monotonic())
+            for fileno in readable:
+                worker, connection = active[fileno]
+                try:
+                    messages = connection.receive_available()
+                except (IOError, OSError):
+                    messages = None
+                if messages is None:
+                    del active[fileno]
+                    self.lose_worker(connection, unfinished(worker), tasks, pending,
+                                     "worker {} disconnected".format(connection.name))
+                    continue
+                for message in messages:
+                    if message['op'] == 'done':
+                        del active[fileno]
+                        lost = unfinished(worker)
+                        if lost:
+                            self.log.error("worker {} did not report {} of its tasks".format(
+                                connection.name, len(lost)))
+                            self.fail_remote_tasks(lost, tasks, pending, "worker {} did not report the task".format(
+                                connection.name))
+                        break
+                    elif message['op'] == 'error':
+                        del active[fileno]
+                        self.lose_worker(connection, unfinished(worker), tasks, pending, "worker {} failed: {}".format(
+                            connection.name, message.get('error')))
+                        break
+                    elif message['op'] == 'started':
+                        task = tasks[message['id']]
+                        task.set_state(decode_state(message['state']))
+                        task.started_at = monotonic()
+                        self.running_tasks[message['id']] = task
+                        for listener in self.listeners:
+                            listener.task_started(self, task)
+                    elif message['op'] == 'finished':
+                        self.finish_remote_task(message['id'], tasks, pending, message['state'])
+
+    def finish_remote_task(self, idx, tasks, pending, state):
+        task = tasks[idx]
+        task.set_state(decode_state(state))
+        task.finished_at = monotonic()
+        task.started_at = task.finished_at - state.get('duration', 0)
+        pending.discard(idx)
+        self.running_tasks.pop(idx, None)
+        self.add_finished(task)
+        for listener in self.listeners:
+            listener.task_finished(self, task)
+
+    def fail_remote_tasks(self, lost, tasks, pending, reason, timed_out=False):
+        for idx in lost:
+            if timed_out:
+                state = dict(result=['Timeout', reason], state=dict(_failed_finally=True))
+            else:
+                state = dict(exception=reason, state=dict(_failed_finally=True))
+            self.finish_remote_task(idx, tasks, pending, state)
+
+    def lose_worker(self, connection, lost, tasks, pending, reason, timed_out=False):
+        """
+        Drop the worker for the rest of the run and fail the tasks it did not report.
+        """
+        self.log.error("lost worker {}, {} of its tasks did not finish: {}".format(connection.name, len(lost), reason))
+        if connection in self.coordinator.connections:
+            self.coordinator.connections.remove(connection)
+        connection.close()
+        self.fail_remote_tasks(lost, tasks, pending, reason, timed_out)
+
+
+class Worker(LoggableObject):
+
+    def __init__(self, address, connect_timeout=60, token=None):
+        """Worker(address, connect_timeout=60, token=None)
+
+        The connection of a worker to its coordinator, see BoereworsExecutor.run_worker. The token
+        (default: $BOEREWORS_CLUSTER_TOKEN) has to be the one of the coordinator.
+        """
+        super(Worker, self).__init__()
+        self.address = parse_address(address)
+        self.connect_timeout = connect_timeout
+        self.token = get_token() if token is None else token
+        self.connection = None
+        self.lost = False
+
+    def connect(self):
+        deadline = monotonic() + self.connect_timeout
+        while True:
+            try:
+                sock = socket.create_connection(self.address)
+                break
+            except (IOError, OSError):
+                # the coordinator may not listen yet
+                if monotonic() > deadline:
+                    raise ClusterException("could not connect to the coordinator {}:{}".format(*self.address))
+                sleep(0.5)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connection = Connection(sock, "{}:{}".format(*self.address))
+        return self
+
+    def receive(self):
+        return self.connection.receive()
+
+    def hello(self):
+        """
+        Answer the challenge of the coordinator and return its hello, after checking that the coordinator knows
+        the token as well. None if the coordinator closed the connection.
+        """
+        message = self.receive()
+        if message is None:
+            return None
+        if message.get('op') != 'challenge':
+            raise ClusterException("unexpected message from the coordinator: {}".format(message.get('op')))
+        challenge = new_challenge()
+        self.connection.send(dict(op='auth', signature=sign(self.token, str(message.get('challenge'))),
+                                  challenge=challenge))
+        hello = self.receive()
+        if hello is None:
+            return None
+        if hello.get('op') != 'hello' or not verify(self.token, challenge, hello.get('signature')):
+            raise ClusterException("the coordinator {}:{} does not know the cluster token".format(*self.address))
+        return hello
+
+    def send(self, message):
+        if self.lost:
+            return
+        try:
+            self.connection.send(message)
+        except (IOError, OSError) as e:
+            # the running jobs are finished anyway, aborting them halfway would be worse
+            self.lost = True
+            self.log.error("lost the coordinator: {}".format(e))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class WorkerReporter(object):
+    """
+    Listener of the pool of a worker, sends the state of the tasks to the coordinator.
+    """
+
+    def __init__(self, worker, ids):
+        self.worker = worker
+        self.ids = ids
+
+    def add_job(self, job):
+        pass
+
+    def task_started(self, pool, task):
+        self.worker.send(dict(op='started', id=self.ids[id(task)], state=encode_state(task)))
+
+    def task_finished(self, pool, task):
+        self.worker.send(dict(op='finished', id=self.ids[id(task)], state=encode_state(task)))
+
+    def finish(self, errors=False):
+        pass
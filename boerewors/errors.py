@@ -25,3 +25,23 @@ class SymlinkException(BoereworsException):
 
 class ConfigNotFoundException(BoereworsException):
     pass
+
+
+class JobTimeout(BoereworsException):
+    pass
+
+
+class JobCancelled(BoereworsException):
+    pass
+
+
+class NoSourceException(BoereworsException):
+    pass
+
+
+class ClusterException(BoereworsException):
+    pass
+
+
+class HttpException(BoereworsException):
+    pass
@@ -14,6 +14,7 @@
 
 import sys
 from argparse import ArgumentParser
+from itertools import chain
 try:
     from itertools import izip as zip
 except ImportError:
@@ -23,7 +24,19 @@ except ImportError:
 from . import __version__ as boerewors_version
 from . import __git_hash__ as boerewors_hash
 from .pool import Pool
-from .logging_helper import logging, NOTICE
+from .jobs import shutdown_process_pool
+from .helper import monotonic
+from .history import ProgressTracker
+from .errors import ConfigNotFoundException
+from .inventory import Inventory, job_filter, parse_limit, parse_shard
+from .logging_helper import logging, NOTICE, setup_logging
+from .errors import ClusterException
+from .report import StageReport
+from . import spawn
+from .runners import LazyRunner, entry_point_runners
+
+# the modules of optional features (history, journal, cache, cluster, processes, prefetch, prewarm, profile, report
+# file) are imported when their option is used, so the cli starts fast
 
 
 def take_upto(max_elements=None, iterator=None):
@@ -37,100 +50,489 @@ def take_upto(max_elements=None, iterator=None):
             yield element
 
 
+def strip_options(argv, names):
+    """
+    Remove the options with a value from argv, e.g. strip_options(['--workers', '2', 'deploy'], ['--workers']).
+    """
+    stripped = []
+    skip_value = False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+        elif arg in names:
+            skip_value = True
+        elif arg.split('=', 1)[0] not in names:
+            stripped.append(arg)
+    return stripped
+
+
+def announce_jobs(jobs, listeners):
+    # let the listeners know about every job before it is run (e.g. to skip it or to estimate its duration)
+    for job in jobs:
+        for listener in listeners:
+            listener.add_job(job)
+        yield job
+
+
 class BoereworsExecutor(object):
 
-    def __init__(self, runners, title=None):
+    def __init__(self, runners=None, title=None, history=None, journal=None, cache=None, entry_points=None,
+                 inventory=None, report=None, on_record=None, profile=None, prefetch=None):
+        """BoereworsExecutor(runners=None, title=None, history=None, journal=None, cache=None, entry_points=None,
+                              inventory=None, report=None, on_record=None, profile=None, prefetch=None)
+
+        runners:    type List[Runner | LazyRunner | str] a str "package.module:RunnerClass" is loaded lazily
+        title:      type str name of the program
+        history:    type str path of the sqlite file that keeps the job durations for the ETA, can be
+                        overwritten with --history
+        journal:    type str path of the journal with the outcomes of all jobs, needed to --resume a run, can be
+                        overwritten with --journal
+        cache:      type str path of the sqlite file that caches the results of jobs with a cache_key, can be
+                        overwritten with --cache
+        entry_points:   type str entry point group, e.g. "boerewors.runners", every entry point is a LazyRunner
+        inventory:  type str path of the host inventory, the runner gets it as runner.inventory, can be overwritten
+                        with --inventory
+        report:     type str path of a JSON Lines file with a record of every finished job and stage, can be
+                        overwritten with --report
+        on_record:  type callable called with each of these records as soon as the job or stage is done, see
+                        report.job_record
+        profile:    type str path of a json report where the controller spent its time during the run (see
+                        profiling.Profiler), can be overwritten with --profile
+        prefetch:   type int build the next stage and buffer up to this many of its jobs while the current stage
+                        runs (see prefetch.StagePrefetcher), can be overwritten with --prefetch
+
+        Lazy runners are only imported and created if their subcommand is selected.
+        """
+        setup_logging()
         self.title = title if title else "boerewors"
         self.runners = {}
         self.parser = None
+        self.history = history
+        self.journal = journal
+        self.cache = cache
+        self.inventory = inventory
+        self.report = report
+        self.on_record = on_record
+        self.profile = profile
+        self.prefetch = prefetch
         self.log = logging.getLogger("root.executor")
+        runners = list(runners or [])
+        if entry_points is not None:
+            runners.extend(entry_point_runners(entry_points))
         for runner in runners:
+            if not hasattr(runner, 'name'):
+                runner = LazyRunner.from_path(runner)
             try:
                 self.runners[runner.name] = runner
             except Exception:
                 self.log.warning("runner {} couldn't be added")
         self.setup_arg_parser()
 
-    def setup_arg_parser(self):
-        parser = ArgumentParser(self.title)
+    def get_runner(self, name):
+        """
+        Return the runner of the subcommand, a lazy runner is loaded now.
+        """
+        runner = self.runners[name]
+        if isinstance(runner, LazyRunner):
+            runner = self.runners[name] = runner.load()
+        return runner
+
+    def setup_arg_parser(self, selected=None, add_help=True):
+        """
+        Build the argument parser. The options of lazy runners are only added for the selected one.
+        """
+        parser = ArgumentParser(self.title, add_help=add_help)
         parser.add_argument('--version', action='store_true')
         parser.add_argument('-v', '--verbose', action='count', default=0)
-        parser.add_argument('--limit', type=int, help="limit the amount of jobs per stage")
+        parser.add_argument('--limit', type=parse_limit,
+                            help="limit the amount of jobs per stage, or select hosts of the inventory, e.g. "
+                                 "dc=ams|fra,role=web,tag=canary")
+        parser.add_argument('--shard', type=parse_shard,
+                            help="only run the jobs of shard i of n, e.g. 2/4, hosts are split by a stable hash")
+        parser.add_argument('--inventory', default=self.inventory, help="host inventory file")
+        parser.add_argument('--processes', type=int,
+                            help="run the jobs of parallel stages in this many worker processes")
+        parser.add_argument('--coordinate', metavar='HOST:PORT',
+                            help="split the jobs of parallel stages across workers that connect to this address")
+        parser.add_argument('--workers', type=int, default=1, help="number of workers for --coordinate")
+        parser.add_argument('--worker', metavar='HOST:PORT',
+                            help="run the jobs the coordinator at this address assigns, with its arguments")
+        parser.add_argument('--spawn', choices=spawn.STRATEGIES, default='auto',
+                            help="how commands are started, see boerewors.spawn (default: auto)")
+        parser.add_argument('--prewarm', action='store_true',
+                            help="open the ssh connections to the hosts of a stage while its canary runs")
+        parser.add_argument('--history', default=self.history,
+                            help="sqlite file with the job durations of previous runs, used for the ETA")
+        parser.add_argument('--journal', default=self.journal,
+                            help="file that records the outcome of every job, needed to resume a run")
+        parser.add_argument('--cache', default=self.cache,
+                            help="sqlite file with the results of jobs with a cache key, cached jobs are skipped")
+        parser.add_argument('--report', default=self.report,
+                            help="JSON Lines file with the outcome of every job, written while the run goes on")
+        parser.add_argument('--profile', default=self.profile, metavar='FILE',
+                            help="profile the controller and write a json report, e.g. to tell whether it or the "
+                                 "hosts are the bottleneck of a slow run")
+        parser.add_argument('--prefetch', type=int, default=self.prefetch, metavar='JOBS',
+                            help="build the next stage and buffer up to JOBS of its jobs while the current stage "
+                                 "runs, its get_jobs must not depend on the outcome of the current stage")
+        parser.add_argument('--cache-ttl', type=float, default=24 * 3600,
+                            help="seconds a cached result stays valid (default: one day)")
+        parser.add_argument('--run-id', help="id of the run in the journal (default: a new id, or the last run "
+                                             "of the journal with --resume and --retry-failed)")
+        resume = parser.add_mutually_exclusive_group()
+        resume.add_argument('--resume', action='store_true',
+                            help="skip the jobs that succeeded in the run of the journal")
+        resume.add_argument('--retry-failed', action='store_true',
+                            help="only run the jobs that failed in the run of the journal")
 
         if len(self.runners) == 1:
-            runner = list(self.runners.values())[0]
-            parser.set_defaults(runner=runner.name)
-            runner.setup_parser(parser)
+            name, runner = list(self.runners.items())[0]
+            parser.set_defaults(runner=name)
+            if name == selected or not isinstance(runner, LazyRunner):
+                self.get_runner(name).setup_parser(parser)
         else:
             subparsers = parser.add_subparsers()
-            for runner in self.runners.values():
-                new_parser = subparsers.add_parser(runner.name)
-                new_parser.set_defaults(runner=runner.name)
-                runner.setup_parser(new_parser)
+            for name, runner in self.runners.items():
+                new_parser = subparsers.add_parser(name, add_help=add_help, help=getattr(runner, 'help', None))
+                new_parser.set_defaults(runner=name)
+                if name == selected or not isinstance(runner, LazyRunner):
+                    self.get_runner(name).setup_parser(new_parser)
         self.parser = parser
+        return parser
+
+    def parse_args(self, argv=None):
+        argv = sys.argv[1:] if argv is None else list(argv)
+        if any(isinstance(runner, LazyRunner) for runner in self.runners.values()):
+            # find the subcommand without loading any runner, then add the options of the selected one
+            args, _ = self.setup_arg_parser(add_help=False).parse_known_args(argv)
+            if args.version:
+                return args
+            self.setup_arg_parser(selected=getattr(args, 'runner', None))
+        return self.parser.parse_args(argv)
+
+    def run_pool(self, jobs, listeners, **pool_params):
+        coordinator = pool_params.pop('coordinator', None)
+        profiler = pool_params.pop('profiler', None)
+        # pool_params with processes > 1 spread the jobs across worker processes
+        limits = (pool_params.get('concurrency_limits') or {}).values()
+        if coordinator is not None and any(callable(limit) for limit in limits):
+            # the workers can not share a callable limit, e.g. the growing capacity of a FanoutStage
+            self.log.warning("the stage has callable concurrency limits, it runs on the coordinator")
+            coordinator = None
+        if coordinator is not None:
+            from .cluster import ClusterPool
+            pool = ClusterPool(coordinator, **pool_params)
+        elif pool_params.get('processes', 1) > 1:
+            from .sharded_pool import ShardedPool
+            pool = ShardedPool(**pool_params)
+        else:
+            pool_params.pop('processes', None)
+            pool = Pool(**pool_params)
+        for listener in listeners:
+            pool.add_listener(listener)
+        if profiler is not None:
+            profiler.instrument(pool)
+        for job in jobs:
+            pool.add_task(job)
+        pool.run()
+        return pool
+
+    def open_journal(self, args):
+        """
+        Return the journal (None without one, False on errors) and the job outcomes of the resumed run.
+        """
+        resume = args.resume or args.retry_failed
+        if not args.journal:
+            if resume:
+                self.log.error("--resume and --retry-failed need a --journal")
+                return False, None
+            return None, None
+        from .journal import Journal, new_run_id
+        run_id = args.run_id
+        outcomes = None
+        if resume:
+            run_id = run_id or Journal.last_run_id(args.journal)
+            if run_id is None:
+                self.log.error("the journal {} has no run to resume".format(args.journal))
+                return False, None
+            outcomes = Journal.load_outcomes(args.journal, run_id)
+            self.log.notice("resume run {}, {} jobs are recorded".format(run_id, len(outcomes)))
+        journal = Journal(args.journal, run_id or new_run_id())
+        journal.write("run", runner=args.runner, resume=bool(resume))
+        self.log.notice("run id {}".format(journal.run_id))
+        return journal, outcomes
+
+    def load_inventory(self, args):
+        """
+        Return the inventory (None without one, False on errors) and the hosts selected by --limit.
+        """
+        selector = args.limit if isinstance(args.limit, dict) else None
+        if not args.inventory:
+            if selector is not None:
+                self.log.error("selecting hosts with --limit needs an --inventory")
+                return False, None
+            return None, None
+        try:
+            inventory = Inventory.load(args.inventory)
+            hosts = set(inventory.select(selector)) if selector is not None else None
+        except (ConfigNotFoundException, ValueError) as e:
+            self.log.error("E1792421116: {}".format(e))
+            return False, None
+        if hosts is not None:
+            self.log.notice("--limit selects {} of {} hosts".format(len(hosts), len(inventory)))
+        return inventory, hosts
+
+    def run_worker(self, address):
+        """
+        Connect to the coordinator, set up the runner with its arguments and run the jobs it assigns, stage by
+        stage. A worker goes through the same stages as the coordinator, so the stages and their jobs have to
+        be the same for the same arguments.
+        """
+        from .cluster import Worker, WorkerReporter, task_key
+        try:
+            worker = Worker(address).connect()
+        except ClusterException as e:
+            self.log.error(e)
+            return False
+        try:
+            try:
+                hello = worker.hello()
+            except (ClusterException, IOError, OSError, ValueError) as e:
+                self.log.error(e)
+                return False
+            if hello is None:
+                self.log.error("the coordinator closed the connection")
+                return False
+            self.log.notice("worker {} of {}".format(hello['worker'] + 1, hello['workers']))
+            args = self.parse_args(hello['argv'])
+            runner = self.get_runner(args.runner)
+            inventory, hosts = self.load_inventory(args)
+            if inventory is False:
+                return False
+            runner.inventory = inventory
+            limit = args.limit if isinstance(args.limit, int) else None
+            if not runner.setup(args):
+                self.log.error("E1485877222: setup of runner {} failed.".format(args.runner))
+                return False
+            errors = False
+            for stage in runner.stages:
+                message = worker.receive()
+                if message is None or message['op'] == 'stop':
+                    break
+                if message['op'] == 'skip':
+                    continue
+                stage.job_filter = job_filter(hosts, args.shard)
+                stage.setup()
+                errors = False
+                try:
+                    jobs = dict((task_key(job), job) for job in take_upto(limit, stage.jobs))
+                    ids = {}
+                    for idx, key in message['tasks']:
+                        ids[id(jobs[key])] = idx
+                    pool_params = dict(message['pool_params'])
+                    timeout = pool_params.pop('timeout', None)
+                    if timeout is not None:
+                        pool_params['deadline'] = monotonic() + timeout
+                    report = StageReport(stage)
+                    self.run_pool((jobs[key] for _, key in message['tasks']),
+                                  [WorkerReporter(worker, ids), report], **pool_params)
+                    errors = report.failed > 0
+                except Exception as e:
+                    # the coordinator fails the tasks that were not reported
+                    errors = True
+                    worker.send(dict(op='error', error="{}: {}".format(e.__class__.__name__, e)))
+                    raise
+                else:
+                    worker.send(dict(op='done'))
+                finally:
+                    stage.cleanup(errors=errors)
+            runner.cleanup()
+            shutdown_process_pool()
+            return not errors
+        finally:
+            worker.close()
 
     def run(self, argv=None):
-        args = self.parser.parse_args(argv)
+        argv = sys.argv[1:] if argv is None else list(argv)
+        args = self.parse_args(argv)
         if args.verbose >= 0:
             self.log.setLevel(max(NOTICE - args.verbose * 10, 5))
-        runner = self.runners[args.runner]
         if args.version:
-            print("boerewors {} v{} (git commit:{})".format(args.runner, boerewors_version, boerewors_hash))
+            print("boerewors {} v{} (git commit:{})".format(
+                getattr(args, 'runner', self.title), boerewors_version, boerewors_hash))
             sys.exit(0)
+        spawn.set_strategy(args.spawn)
+        if args.worker:
+            return self.run_worker(args.worker)
+        if getattr(args, 'runner', None) is None:
+            self.parser.error("choose one of the commands: {}".format(", ".join(sorted(self.runners))))
+        runner = self.get_runner(args.runner)
         self.log.notice("running {} v{} (git commit:{})".format(args.runner, boerewors_version, boerewors_hash))
+        inventory, hosts = self.load_inventory(args)
+        if inventory is False:
+            return False
+        runner.inventory = inventory
+        limit = args.limit if isinstance(args.limit, int) else None
         if not runner.setup(args):
             self.log.error("E1485877222: setup of runner {} failed.".format(args.runner))
             return False
+        journal, outcomes = self.open_journal(args)
+        if journal is False:
+            return False
+        history = cache = control_dir = report_writer = profiler = prefetcher = None
+        if args.history:
+            from .history import DurationHistory
+            history = DurationHistory(args.history)
+        if journal is not None:
+            from .journal import JournalRecorder
+        if args.cache:
+            from .cache import ResultCache, CacheRecorder
+            cache = ResultCache(args.cache, ttl=args.cache_ttl)
+        if args.prewarm:
+            from .prewarm import ControlDirectory, Prewarmer
+            control_dir = ControlDirectory().open()
+        if args.report:
+            from .report import ReportWriter
+            report_writer = ReportWriter(args.report)
+        callbacks = [callback for callback in (report_writer, self.on_record) if callback is not None]
+        if args.profile:
+            from .profiling import Profiler
+            profiler = Profiler().start()
+        stages = runner.stages
+        if args.prefetch:
+            from .prefetch import StagePrefetcher
+
+            def set_job_filter(stage):
+                stage.job_filter = job_filter(hosts, args.shard)
+            prefetcher = StagePrefetcher(stages, buffer_size=args.prefetch, prepare=set_job_filter)
+            stages = prefetcher
+        coordinator = None
         errors = False
-        for stage in runner.stages:
-            stage.setup()
-            errors = False
-            try:
-                jobs_iterator = take_upto(args.limit, stage.jobs)
-                if stage.is_canary:
-                    self.log.info("run canary job")
-                    job = next(jobs_iterator)
-                    self.log.debug("next job {}".format(job))
-                    job.get_result()
-                    if not job.was_successful():
-                        # it failed exit
-                        self.log.error("canary job failed. {}".format(job._result))
-                        self.log.error("Stage {} failed. ".format(stage))
-                        errors = True
-                        break
-                    self.log.info("canary job succeeded")
-
-                if stage.allow_parallel_execution:
-                    # maybe something like fail_early
-                    pool = Pool(**stage.pool_params)
-                    # pool.set_logging_info(stage._logging_info)
-                    for job in jobs_iterator:
-                        pool.add_task(job)
-                    pool.run()
-                    results = list(pool.results)
-                    self.log.info(results)
-                    self.log.info(all(results))
-                    if not all(results):
-                        self.log.error("Stage {} failed. ".format(stage))
-                        for result in results:
-                            if not result:
-                                self.log.error(result)
-                        errors = True
-                else:
-                    for job in jobs_iterator:
-                        job.get_result()
+        try:
+            if args.coordinate:
+                from .cluster import Coordinator
+                try:
+                    coordinator = Coordinator(args.coordinate, args.workers,
+                                              strip_options(argv, ['--coordinate', '--workers'])).start()
+                except ClusterException as e:
+                    self.log.error(e)
+                    return False
+            for stage in stages:
+                stage.job_filter = job_filter(hosts, args.shard)
+                if profiler is not None:
+                    profiler.begin_stage(stage)
+                stage.setup()
+                if coordinator is not None:
+                    coordinator.begin_stage()
+                errors = False
+                # the canary and the pool share the time of the stage
+                deadline = monotonic() + stage.timeout if stage.timeout else None
+                listeners = [ProgressTracker(stage, runner=runner, history=history,
+                                             pool_size=stage.pool_params.get('pool_size', 10))]
+                if journal is not None:
+                    listeners.append(JournalRecorder(journal, stage, outcomes, retry_failed=args.retry_failed))
+                if cache is not None:
+                    listeners.append(CacheRecorder(cache, stage, runner=runner))
+                if control_dir is not None:
+                    listeners.append(control_dir)
+                report = StageReport(stage, callbacks)
+                listeners.append(report)
+                prewarmer = None
+                try:
+                    stage_jobs = stage.jobs if prefetcher is None else prefetcher.get_jobs(stage)
+                    jobs_iterator = announce_jobs(
+                        take_upto(limit, stage_jobs), listeners)
+                    if stage.is_canary:
+                        self.log.info("run canary job")
+                        job = next(jobs_iterator)
+                        # jobs that are done already can not be the canary
+                        done_jobs = []
+                        while getattr(job, 'skipped', False):
+                            done_jobs.append(job)
+                            job = next(jobs_iterator)
+                        jobs_iterator = chain(done_jobs, jobs_iterator)
+                        if args.prewarm:
+                            # connect to the other hosts while the canary runs
+                            upcoming = list(jobs_iterator)
+                            jobs_iterator = iter(upcoming)
+                            prewarmer = Prewarmer(upcoming, pool_size=stage.pool_params.get('pool_size', 10),
+                                                  ssh_control=control_dir.ssh_control)
+                            prewarmer.start()
+                        self.log.debug("next job {}".format(job))
+                        # a pool of one enforces the timeouts of the job
+                        self.run_pool([job], listeners, pool_size=1, deadline=deadline, profiler=profiler)
                         if not job.was_successful():
-                            self.log.error("Job {} failed".format(job))
+                            # it failed exit
+                            self.log.error("canary job {}. {}".format(
+                                "timed out" if job.timed_out() else "failed", job._result))
+                            self.log.error("Stage {} failed. ".format(stage))
                             errors = True
+                            break
+                        self.log.info("canary job succeeded")
 
-                if not stage.should_continue(errors):
-                    self.log.warning(
-                        "Stage {}, will not continue. {} {}".format(
-                            stage, "(there have been errors)" if errors else "", errors))
-                    break
-            except StopIteration:
-                self.log.warning("stage emitted no jobs")
-            finally:
-                stage.cleanup(errors=errors)
+                    if stage.allow_parallel_execution:
+                        # maybe something like fail_early
+                        pool_params = dict(deadline=deadline, profiler=profiler)
+                        pool_params.update(stage.pool_params)
+                        if args.processes:
+                            pool_params['processes'] = args.processes
+                            if prewarmer is not None:
+                                # the workers fork, a copy of the running warm up thread would be left half way
+                                prewarmer.join(prewarmer.timeout)
+                                prewarmer = None
+                        if coordinator is not None:
+                            pool_params['coordinator'] = coordinator
+                        if not stage.keep_jobs:
+                            pool_params['keep_finished'] = False
+                        self.run_pool(jobs_iterator, listeners, **pool_params)
+                    else:
+                        self.run_pool(jobs_iterator, listeners, pool_size=1, deadline=deadline,
+                                      keep_finished=stage.keep_jobs, profiler=profiler)
+                    # the report logged every failed job when it finished
+                    if report.failed:
+                        self.log.error("Stage {} failed: {} of {} jobs failed{}".format(
+                            stage, report.failed, report.finished,
+                            ", {} timed out".format(report.timed_out) if report.timed_out else ""))
+                        errors = True
+
+                    if not stage.should_continue(errors):
+                        self.log.warning(
+                            "Stage {}, will not continue. {} {}".format(
+                                stage, "(there have been errors)" if errors else "", errors))
+                        break
+                except StopIteration:
+                    self.log.warning("stage emitted no jobs")
+                finally:
+                    if prewarmer is not None:
+                        prewarmer.join(prewarmer.timeout)
+                    if prefetcher is not None:
+                        prefetcher.finish_stage(stage)
+                    if coordinator is not None:
+                        coordinator.end_stage()
+                    for listener in listeners:
+                        listener.finish(errors)
+                    stage.cleanup(errors=errors)
+                    if profiler is not None:
+                        profiler.end_stage()
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            if history is not None:
+                history.close()
+            if journal is not None:
+                journal.close()
+            if cache is not None:
+                cache.close()
+            if control_dir is not None:
+                control_dir.close()
+            if report_writer is not None:
+                report_writer.close()
+            if profiler is not None:
+                profiler.stop()
+                profiler.write(args.profile)
+                self.log.notice("profile: {}".format(profiler.summary()))
+            if coordinator is not None:
+                coordinator.close()
         runner.cleanup()
+        shutdown_process_pool()
         return not errors
@@ -0,0 +1,172 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from collections import deque
+
+from .errors import NoSourceException
+from .helper import LoggableObject
+from .jobs import Job, SSHJob, cmd_quote
+from .stage import Stage
+
+
+class SourceTracker(LoggableObject):
+
+    def __init__(self, origin_slots=3, fanout=2):
+        """SourceTracker(origin_slots=3, fanout=2)
+
+        origin_slots:   type int number of hosts that download from the origin at the same time
+        fanout:         type int number of hosts a finished host serves at the same time
+
+        Keeps track of the hosts that have the artifact. Every source provides a number of slots, a transfer
+        takes one slot of a host (peers first to spare the origin) and gives it back when it is done.
+        """
+        super(SourceTracker, self).__init__()
+        self.origin_slots = origin_slots
+        self.fanout = fanout
+        self.sources = []
+        self._origin_slots = deque([None] * origin_slots)
+        self._peer_slots = deque()
+        self.active = 0
+
+    def capacity(self):
+        """
+        Number of transfers that can run at the same time, it grows with every finished host.
+        """
+        return self.active + len(self._origin_slots) + len(self._peer_slots)
+
+    def acquire(self):
+        """
+        Return a source for a new transfer, None stands for the origin.
+        """
+        if self._peer_slots:
+            source = self._peer_slots.popleft()
+        elif self._origin_slots:
+            source = self._origin_slots.popleft()
+        else:
+            raise NoSourceException("all {} sources are busy".format(len(self.sources) + 1))
+        self.active += 1
+        return source
+
+    def release(self, source):
+        self.active -= 1
+        if source is None:
+            self._origin_slots.append(source)
+        else:
+            self._peer_slots.append(source)
+
+    def add_source(self, host):
+        self.sources.append(host)
+        self._peer_slots.extend([host] * self.fanout)
+
+
+class FanoutJob(Job):
+
+    origin_command = "mkdir -p $(dirname {path}) && curl -fsS -o {path}.part {url} && mv {path}.part {path}"
+    peer_command = "mkdir -p $(dirname {path}) && rsync -a {source}:{path} {path}"
+
+    def __init__(self, host, sources, path, url, user=None, timeout=None):
+        """FanoutJob(host, sources, path, url, user=None, timeout=None)
+
+        host:       type str the host that gets the artifact
+        sources:    type SourceTracker shared by all jobs of the stage
+        path:       type str where the artifact is stored on every host
+        url:        type str where the artifact is downloaded from the origin
+        user:       type str ssh user
+        timeout:    type float seconds for the transfer
+
+        Copies the artifact from the origin or a host that has it already. The commands are run on the
+        host and can be changed with the class attributes origin_command and peer_command, e.g. to pull
+        from the http server of a peer.
+        """
+        super(FanoutJob, self).__init__()
+        self.host = host
+        self.sources = sources
+        self.path = path
+        self.url = url
+        self.user = user
+        self.transfer_timeout = timeout
+        self.source = None
+
+    def origin_transfer(self):
+        command = self.origin_command.format(path=cmd_quote(self.path), url=cmd_quote(self.url))
+        return SSHJob(self.host, command, user=self.user, timeout=self.transfer_timeout)
+
+    def peer_transfer(self, source):
+        command = self.peer_command.format(path=cmd_quote(self.path), source=cmd_quote(source))
+        return SSHJob(self.host, command, user=self.user, timeout=self.transfer_timeout)
+
+    def run_job(self):
+        self.source = self.sources.acquire()
+        self.log.info("copy from {}".format(self.source or "origin"))
+        try:
+            if self.source is None:
+                yield self.origin_transfer()
+            else:
+                yield self.peer_transfer(self.source)
+            error = self.error_if_subtask_failed()
+        finally:
+            # give the slot back, even if the transfer timed out
+            self.sources.release(self.source)
+        if error is not None:
+            yield error
+        self.sources.add_source(self.host)
+        yield self.Ok(self.source or "origin")
+
+
+class FanoutStage(Stage):
+
+    job_class = FanoutJob
+    concurrency_key = 'fanout_source'
+
+    def __init__(self, hosts, path, url, origin_slots=3, fanout=2, user=None, transfer_timeout=None, **kwargs):
+        """FanoutStage(hosts, path, url, origin_slots=3, fanout=2, user=None, transfer_timeout=None, **kwargs)
+
+        hosts:              type List[str] the hosts that get the artifact
+        path:               type str where the artifact is stored on every host
+        url:                type str where the artifact is downloaded from the origin
+        origin_slots:       type int number of hosts that download from the origin at the same time
+        fanout:             type int number of hosts a finished host serves at the same time
+        user:               type str ssh user
+        transfer_timeout:   type float seconds for a single transfer
+        kwargs:             passed to Stage, e.g. pool_params
+
+        Distributes an artifact as a growing tree: a few seed hosts download it from the origin, every host that
+        has it serves the next hosts. The pool only starts as many transfers as there are free sources, so the
+        distribution takes about log(n) waves instead of n / origin_slots.
+        """
+        super(FanoutStage, self).__init__(**kwargs)
+        self.hosts = hosts
+        self.path = path
+        self.url = url
+        self.user = user
+        self.transfer_timeout = transfer_timeout
+        self.sources = SourceTracker(origin_slots=origin_slots, fanout=fanout)
+        pool_params = dict(pool_size=max(len(hosts), 1))
+        pool_params.update(self.pool_params)
+        concurrency_limits = dict(pool_params.get('concurrency_limits') or {})
+        concurrency_limits[self.concurrency_key] = self.sources.capacity
+        pool_params['concurrency_limits'] = concurrency_limits
+        self.pool_params = pool_params
+
+    def get_jobs(self):
+        for host in self.hosts:
+            job = self.job_class(host, self.sources, self.path, self.url, user=self.user,
+                                 timeout=self.transfer_timeout)
+            job.concurrency_keys = {self.concurrency_key: self.name}
+            yield job
+
+    def cleanup(self, errors):
+        self.log.notice("{} of {} hosts have the artifact".format(len(self.sources.sources), len(self.hosts)))
+        super(FanoutStage, self).cleanup(errors)
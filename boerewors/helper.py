@@ -15,10 +15,33 @@
 import re
 import json
 
+try:
+    from time import monotonic
+except ImportError:
+    # python 2 has no monotonic clock in the standard library
+    from time import time as monotonic
+
+try:
+    string_types = (basestring,)  # noqa: F821
+except NameError:
+    # python 3
+    string_types = (str,)
+
 from .errors import SymlinkException
 from .logging_helper import logging, root_logger
 
 
+def to_json(value):
+    """
+    Return the value if json can encode it, its repr otherwise.
+    """
+    try:
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        return repr(value)
+
+
 def camel_case_to_snake_case(camel_case_input):
     return re.sub(r'[A-Z]', lambda x: "_{}".format(x.group().lower()), camel_case_input).strip('_')
 
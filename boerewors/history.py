@@ -0,0 +1,224 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+from .helper import LoggableObject, monotonic
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "{}h {:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "{}m {:02d}s".format(seconds // 60, seconds % 60)
+    return "{}s".format(seconds)
+
+
+class DurationHistory(LoggableObject):
+
+    def __init__(self, path, samples=10, max_age=90 * 24 * 3600):
+        """DurationHistory(path, samples=10, max_age=90 * 24 * 3600)
+
+        path:       type str sqlite database file, it is created if it does not exist
+        samples:    type int number of recent successful runs per host used for the estimate
+        max_age:    type float seconds, older records are removed when the history is flushed
+
+        Stores the duration of every job keyed by runner, stage and host.
+        """
+        super(DurationHistory, self).__init__()
+        self.path = path
+        self.samples = samples
+        self.max_age = max_age
+        self._pending = []
+        # only runs with a history need sqlite
+        import sqlite3
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS durations "
+            "(runner TEXT, stage TEXT, host TEXT, duration REAL, success INTEGER, recorded_at REAL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS durations_key ON durations (runner, stage, host, recorded_at)")
+        self.connection.commit()
+
+    def record(self, runner, stage, host, duration, success=True):
+        # records are written in batches, see flush
+        self._pending.append((runner, stage, host, duration, int(bool(success)), time.time()))
+
+    def flush(self):
+        if self._pending:
+            self.connection.executemany("INSERT INTO durations VALUES (?, ?, ?, ?, ?, ?)", self._pending)
+            self._pending = []
+        self.connection.execute("DELETE FROM durations WHERE recorded_at < ?", (time.time() - self.max_age,))
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def load_stage(self, runner, stage):
+        """
+        Return the expected duration per host and the median over all hosts (None without history).
+        """
+        durations = {}
+        cursor = self.connection.execute(
+            "SELECT host, duration FROM durations WHERE runner = ? AND stage = ? AND success = 1 "
+            "ORDER BY recorded_at DESC", (runner, stage))
+        for host, duration in cursor:
+            host_durations = durations.setdefault(host, [])
+            if len(host_durations) < self.samples:
+                host_durations.append(duration)
+        expected = dict((host, median(values)) for host, values in durations.items())
+        return expected, median(expected.values())
+
+
+class ProgressTracker(LoggableObject):
+
+    def __init__(self, stage, runner=None, history=None, pool_size=1, report_interval=10.0, slow_factor=1.5,
+                 min_samples=5):
+        """ProgressTracker(stage, runner=None, history=None, pool_size=1, report_interval=10.0, slow_factor=1.5,
+                           min_samples=5)
+
+        stage:              the running stage
+        runner:             the runner of the stage
+        history:            type DurationHistory or None, without history the ETA is based on the current rate only
+        pool_size:          type int number of jobs that run at the same time
+        report_interval:    type float seconds between two progress log lines
+        slow_factor:        type float warn if the finished jobs took this many times longer than their history
+        min_samples:        type int number of finished jobs with history before the stage is compared with it
+
+        A pool listener (see Pool.add_listener) that logs the progress and the ETA of a stage. With a history it
+        sets the expected_duration of the jobs (which is used by pools with scheduling='priority') and records
+        the durations of the finished jobs.
+        """
+        super(ProgressTracker, self).__init__()
+        self.stage = stage
+        self.runner_name = runner.name if runner is not None else ""
+        self.stage_key = stage._logging_info
+        self.history = history
+        self.pool_size = pool_size
+        self.report_interval = report_interval
+        self.slow_factor = slow_factor
+        self.min_samples = min_samples
+        self.set_logging_info(stage._logging_info)
+        self.expected, self.stage_median = ({}, None)
+        if history is not None:
+            self.expected, self.stage_median = history.load_stage(self.runner_name, self.stage_key)
+        self.total_jobs = 0
+        self.finished_jobs = 0
+        self.started_at = monotonic()
+        self._last_report = self.started_at
+        self._remaining_expected = 0.0
+        self._actual_sum = 0.0
+        self._expected_sum = 0.0
+        self._compared_jobs = 0
+        self._warned = False
+
+    @staticmethod
+    def job_key(job):
+        return getattr(job, 'host', None) or job.name
+
+    def add_job(self, job):
+        self.total_jobs += 1
+        expected = self.expected.get(self.job_key(job), self.stage_median)
+        if getattr(job, 'expected_duration', None) is None and expected is not None:
+            job.expected_duration = expected
+        self._remaining_expected += getattr(job, 'expected_duration', None) or 0
+
+    def task_started(self, pool, task):
+        pass
+
+    def task_finished(self, pool, task):
+        self.finished_jobs += 1
+        duration = task.finished_at - task.started_at
+        expected = getattr(task, 'expected_duration', None)
+        if expected:
+            self._remaining_expected -= expected
+        # a skipped job did not run, its duration says nothing about the host
+        if not getattr(task, 'skipped', False):
+            if expected:
+                self._actual_sum += duration
+                self._expected_sum += expected
+                self._compared_jobs += 1
+            if self.history is not None:
+                self.history.record(self.runner_name, self.stage_key, self.job_key(task), duration,
+                                    task.was_successful())
+            self.check_trend()
+
+    def tick(self, pool, now):
+        # also while no job finishes, e.g. during a long canary
+        if now - self._last_report >= self.report_interval:
+            self._last_report = now
+            self.report()
+
+    @property
+    def trend(self):
+        """
+        Ratio of the actual and the expected duration of the finished jobs, None without history.
+        """
+        if not self._compared_jobs:
+            return None
+        return self._actual_sum / self._expected_sum
+
+    @property
+    def rate(self):
+        elapsed = monotonic() - self.started_at
+        return self.finished_jobs / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """
+        Estimated seconds until all jobs are finished, None if there is nothing to base it on.
+        """
+        remaining_jobs = self.total_jobs - self.finished_jobs
+        if remaining_jobs <= 0:
+            return 0.0
+        if self._remaining_expected > 0:
+            trend = self.trend or 1.0
+            return self._remaining_expected * trend / min(self.pool_size, remaining_jobs)
+        if self.finished_jobs:
+            return remaining_jobs / self.rate
+        return None
+
+    def check_trend(self):
+        trend = self.trend
+        if self._warned or trend is None or self._compared_jobs < self.min_samples:
+            return
+        if trend >= self.slow_factor:
+            self._warned = True
+            self.log.warning("the stage is {:.1f} times slower than its history".format(trend))
+
+    def report(self):
+        eta = self.eta
+        self.log.notice("{}/{} jobs finished ({:.0%}), {:.2f} jobs/s, ETA {}".format(
+            self.finished_jobs, self.total_jobs, self.finished_jobs / float(max(self.total_jobs, 1)), self.rate,
+            format_duration(eta) if eta is not None else "unknown"))
+
+    def finish(self, errors=False):
+        self.log.notice("{}/{} jobs finished in {}, {}".format(
+            self.finished_jobs, self.total_jobs, format_duration(monotonic() - self.started_at),
+            "with errors" if errors else "without errors"))
+        if self.history is not None:
+            self.history.flush()
@@ -0,0 +1,545 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import socket
+from select import select
+from time import sleep
+
+try:
+    import ssl
+except ImportError:
+    # python without ssl support, only http urls work
+    ssl = None
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from .errors import HttpException, JobTimeout
+from .helper import LoggableObject, monotonic
+from .jobs import Job
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS, errno.EALREADY)
+# a response head that does not end within this many bytes is not http
+MAX_HEAD_SIZE = 65536
+# a request with one of these methods can be sent again if the server closed its connection, the others may have
+# been processed already
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+
+def parse_url(url):
+    """
+    Return the origin (scheme, host, port) and the path with the query of an http or https url.
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        raise HttpException("unsupported url {}".format(url))
+    path = parts.path or "/"
+    if parts.query:
+        path = "{}?{}".format(path, parts.query)
+    return (scheme, parts.hostname, parts.port or DEFAULT_PORTS[scheme]), path
+
+
+def would_block(error):
+    if ssl is not None and isinstance(error, (ssl.SSLWantReadError, ssl.SSLWantWriteError)):
+        return True
+    return getattr(error, 'errno', None) in WOULD_BLOCK
+
+
+class HttpResponse(object):
+
+    def __init__(self, status, reason, version, headers, body):
+        self.status = status
+        self.reason = reason
+        self.version = version
+        # the names are lower case
+        self.headers = headers
+        self.body = body
+
+    @property
+    def text(self):
+        return self.body.decode('utf8', 'replace')
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def __repr__(self):
+        return "<HttpResponse {} {}>".format(self.status, self.reason)
+
+
+class ResponseParser(object):
+
+    def __init__(self, head_only=False):
+        """ResponseParser(head_only=False)
+
+        head_only:  type bool the response has no body, e.g. of a HEAD request
+
+        Parses a HTTP/1.x response from the bytes fed to it while they arrive.
+        """
+        self.head_only = head_only
+        self.buffer = b""
+        self.status = None
+        self.reason = None
+        self.version = None
+        self.headers = {}
+        self.body = []
+        self.received = 0
+        self.length = None
+        self.chunked = False
+        self.until_close = False
+        self.done = False
+        self._in_body = False
+        self._chunk_left = None
+        self._in_trailer = False
+
+    def feed(self, data):
+        """
+        Return True once the response is complete. Empty data means that the server closed the connection.
+        """
+        if not data:
+            if self._in_body and self.until_close:
+                self.done = True
+                return True
+            raise HttpException("the connection was closed before the response was complete")
+        self.buffer += data
+        if not self._in_body and not self.parse_head():
+            return False
+        return self.parse_body()
+
+    def parse_head(self):
+        while True:
+            end = self.buffer.find(b"\r\n\r\n")
+            if end == -1:
+                if len(self.buffer) > MAX_HEAD_SIZE:
+                    raise HttpException("the response head is too long")
+                return False
+            lines = self.buffer[:end].decode('latin-1').split("\r\n")
+            self.buffer = self.buffer[end + 4:]
+            parts = lines[0].split(None, 2)
+            if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+                raise HttpException("invalid status line {!r}".format(lines[0]))
+            self.version, self.status = parts[0], int(parts[1])
+            self.reason = parts[2] if len(parts) > 2 else ""
+            self.headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                self.headers[name.strip().lower()] = value.strip()
+            if not 100 <= self.status < 200:
+                break
+            # an interim response (e.g. 100 Continue), the real one follows
+
+        self._in_body = True
+        if self.head_only or self.status in (204, 304):
+            self.length = 0
+        elif 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self.chunked = True
+        elif 'content-length' in self.headers:
+            self.length = int(self.headers['content-length'])
+        else:
+            self.until_close = True
+        return True
+
+    def parse_body(self):
+        if self.chunked:
+            return self.parse_chunks()
+        if self.length is None:
+            self.add_body(self.buffer)
+            self.buffer = b""
+        else:
+            missing = self.length - self.received
+            self.add_body(self.buffer[:missing])
+            # anything after the body should not be there, the connection is not reused then
+            self.buffer = self.buffer[missing:]
+        if self.length is not None and self.received >= self.length:
+            self.done = True
+        return self.done
+
+    def parse_chunks(self):
+        while not self.done:
+            if self._in_trailer:
+                if self.buffer.startswith(b"\r\n"):
+                    end = -2
+                else:
+                    end = self.buffer.find(b"\r\n\r\n")
+                    if end == -1:
+                        return False
+                self.buffer = self.buffer[end + 4:]
+                self.done = True
+                break
+            if self._chunk_left is None:
+                end = self.buffer.find(b"\r\n")
+                if end == -1:
+                    return False
+                size = int(self.buffer[:end].split(b";")[0].strip(), 16)
+                self.buffer = self.buffer[end + 2:]
+                if size == 0:
+                    self._in_trailer = True
+                    continue
+                self._chunk_left = size
+            if len(self.buffer) < self._chunk_left + 2:
+                return False
+            self.add_body(self.buffer[:self._chunk_left])
+            self.buffer = self.buffer[self._chunk_left + 2:]
+            self._chunk_left = None
+        return True
+
+    def add_body(self, data):
+        if data:
+            self.body.append(data)
+            self.received += len(data)
+
+    def get_response(self):
+        return HttpResponse(self.status, self.reason, self.version, self.headers, b"".join(self.body))
+
+
+class HttpConnection(LoggableObject):
+
+    def __init__(self, origin, address, ssl_context=None):
+        """HttpConnection(origin, address, ssl_context=None)
+
+        origin:         type tuple (scheme, host, port)
+        address:        type tuple (family, socktype, proto, canonname, sockaddr) see socket.getaddrinfo
+        ssl_context:    type ssl.SSLContext for https origins
+
+        A non-blocking connection, connect() starts connecting and poll_connect() returns True once the connection
+        (and its tls handshake) is ready.
+        """
+        super(HttpConnection, self).__init__()
+        self.origin = origin
+        self.address = address
+        self.ssl_context = ssl_context
+        self.sock = None
+        self.connected = False
+        self.requests = 0
+        self.idle_since = None
+        self._handshake = False
+
+    def connect(self):
+        family, socktype, proto, _, sockaddr = self.address
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        error = self.sock.connect_ex(sockaddr)
+        if error not in (0,) + WOULD_BLOCK:
+            raise socket.error(error, os.strerror(error))
+
+    def poll_connect(self):
+        if self.connected:
+            return True
+        if not self._handshake:
+            _, writable, _ = select([], [self.sock], [], 0)
+            if not writable:
+                return False
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            if self.origin[0] != 'https':
+                self.connected = True
+                return True
+            if ssl is None:
+                raise HttpException("https is not supported without the ssl module")
+            context = self.ssl_context or ssl.create_default_context()
+            self.sock = context.wrap_socket(self.sock, server_hostname=self.origin[1], do_handshake_on_connect=False)
+            self._handshake = True
+        try:
+            self.sock.do_handshake()
+        except socket.error as e:
+            if would_block(e):
+                return False
+            raise
+        self.connected = True
+        return True
+
+    def is_stale(self):
+        # an idle connection is readable only if the server closed it (or sent something it should not have)
+        readable, _, _ = select([self.sock], [], [], 0)
+        return bool(readable)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+        self.connected = False
+
+
+class HttpConnectionPool(object):
+
+    def __init__(self, max_per_origin=10, idle_timeout=30, ssl_context=None):
+        """HttpConnectionPool(max_per_origin=10, idle_timeout=30, ssl_context=None)
+
+        max_per_origin: type int connections per (scheme, host, port) at most, jobs wait for a free one
+        idle_timeout:   type float seconds an idle connection is kept for the next request
+        ssl_context:    type ssl.SSLContext for https, e.g. with the internal ca (default: the system defaults)
+
+        Keeps the connections of finished requests open (keep-alive), so a lot of requests to the same hosts only
+        need a few sockets. Host names are resolved once per origin.
+        """
+        self.max_per_origin = max_per_origin
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self.pid = os.getpid()
+        self.idle = {}
+        self.active = {}
+        self.addresses = {}
+
+    def resolve(self, origin):
+        if origin not in self.addresses:
+            # blocking, health checks usually use ips or a few host names
+            self.addresses[origin] = socket.getaddrinfo(origin[1], origin[2], 0, socket.SOCK_STREAM)[0]
+        return self.addresses[origin]
+
+    def acquire(self, origin):
+        """
+        Return an idle or a new (not yet connected) connection, None if max_per_origin connections are in use.
+        """
+        idle = self.idle.get(origin, [])
+        now = monotonic()
+        while idle:
+            connection = idle.pop()
+            if now - connection.idle_since < self.idle_timeout and not connection.is_stale():
+                self.active[origin] = self.active.get(origin, 0) + 1
+                return connection
+            connection.close()
+        if self.active.get(origin, 0) >= self.max_per_origin:
+            return None
+        connection = HttpConnection(origin, self.resolve(origin), self.ssl_context)
+        self.active[origin] = self.active.get(origin, 0) + 1
+        return connection
+
+    def release(self, connection, reusable=True):
+        self.active[connection.origin] -= 1
+        if reusable and connection.connected:
+            connection.idle_since = monotonic()
+            self.idle.setdefault(connection.origin, []).append(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+        self.idle = {}
+
+
+_connection_pool = None
+
+
+def get_connection_pool():
+    """
+    Return the connection pool of the HttpJobs that do not get their own, a forked process gets a new one.
+    """
+    global _connection_pool
+    if _connection_pool is None or _connection_pool.pid != os.getpid():
+        _connection_pool = HttpConnectionPool()
+    return _connection_pool
+
+
+class HttpJob(Job):
+
+    def __init__(self, url, method='GET', headers=None, body=None, timeout=10, expected_status=None,
+                 connections=None, host=None):
+        """HttpJob(url, method='GET', headers=None, body=None, timeout=10, expected_status=None, connections=None,
+                   host=None)
+
+        url:                type str http or https url
+        method:             type str
+        headers:            type dict request headers, e.g. {'Host': 'www.example.com'} to check a backend by its ip
+        body:               type bytes | str request body
+        timeout:            type float seconds for the whole request, including waiting for a connection
+        expected_status:    type Iterable[int] status codes that are a success (default: 2xx and 3xx)
+        connections:        type HttpConnectionPool (default: one pool shared by all HttpJobs of the process)
+        host:               type str the host the job checks, e.g. in the journal (default: the host of the url)
+
+        A request on a non-blocking socket that the pool polls like a PopenJob. The result is a HttpResponse, e.g.
+        job.get_result('status') or job.get_result('text').
+        """
+        super(HttpJob, self).__init__()
+        self.url = url
+        self.method = method.upper()
+        self.origin, self.path = parse_url(url)
+        self.host = host or self.origin[1]
+        self.request_headers = dict(headers or {})
+        if body is not None and not isinstance(body, bytes):
+            body = body.encode('utf8')
+        self.body = body
+        self.timeout = timeout
+        self.expected_status = set(expected_status) if expected_status is not None else None
+        self.connections = connections
+        self.connection = None
+        self._state = None
+        self._request = None
+        self._out = b""
+        self._parser = None
+        self._retried = False
+
+    def build_request(self):
+        scheme, host, port = self.origin
+        headers = [("Host", host if port == DEFAULT_PORTS[scheme] else "{}:{}".format(host, port)),
+                   ("User-Agent", "boerewors"), ("Accept-Encoding", "identity"), ("Connection", "keep-alive")]
+        if self.body is not None:
+            headers.append(("Content-Length", str(len(self.body))))
+        overrides = dict((name.lower(), (name, value)) for name, value in self.request_headers.items())
+        headers = [overrides.pop(name.lower(), (name, value)) for name, value in headers]
+        headers.extend(overrides.values())
+        head = "{} {} HTTP/1.1\r\n{}\r\n\r\n".format(
+            self.method, self.path, "\r\n".join("{}: {}".format(name, value) for name, value in headers))
+        return head.encode('latin-1') + (self.body or b"")
+
+    def start(self):
+        self.log.debug("start request {} {}".format(self.method, self.url))
+        if self.connections is None:
+            self.connections = get_connection_pool()
+        self.deadline = monotonic() + self.timeout if self.timeout else None
+        self._request = self.build_request()
+        self._state = 'waiting'
+
+    def poll(self):
+        if self._result is not None or self._exception is not None:
+            return True
+        if self._state is None:
+            self.start()
+        try:
+            self.step()
+        except (socket.error, HttpException) as e:
+            if self.can_retry():
+                # the server closed the idle connection, the request did not reach it
+                self.log.info("connection closed by the server, retry on a new one: {}".format(e))
+                self._retried = True
+                self.release_connection(reusable=False)
+                self._state = 'waiting'
+                return None
+            self.log.error("request {} {} failed: {}".format(self.method, self.url, e))
+            self.release_connection(reusable=False)
+            self._exception = e if isinstance(e, HttpException) else HttpException(str(e))
+            return True
+        return True if self._result is not None else None
+
+    def can_retry(self):
+        return (self.method in IDEMPOTENT_METHODS and not self._retried and self.connection is not None and self.connection.requests > 0
+                and self._state in ('sending', 'receiving') and not self._parser.buffer and not self._parser.status)
+
+    def step(self):
+        if self._state == 'waiting':
+            self.connection = self.connections.acquire(self.origin)
+            if self.connection is None:
+                return
+            self._out = self._request
+            self._parser = ResponseParser(head_only=self.method == 'HEAD')
+            if self.connection.connected:
+                self._state = 'sending'
+            else:
+                self.connection.connect()
+                self._state = 'connecting'
+        if self._state == 'connecting':
+            if not self.connection.poll_connect():
+                return
+            self._state = 'sending'
+        if self._state == 'sending':
+            while self._out:
+                try:
+                    sent = self.connection.sock.send(self._out)
+                except socket.error as e:
+                    if would_block(e):
+                        return
+                    raise
+                self._out = self._out[sent:]
+            self._state = 'receiving'
+        if self._state == 'receiving':
+            while True:
+                try:
+                    data = self.connection.sock.recv(65536)
+                except socket.error as e:
+                    if would_block(e):
+                        return
+                    raise
+                if self._parser.feed(data):
+                    self.finish_request(closed=not data)
+                    return
+
+    def finish_request(self, closed):
+        response = self._parser.get_response()
+        self.connection.requests += 1
+        self.release_connection(reusable=not closed and not self._parser.buffer and response.keep_alive)
+        self._state = 'done'
+        self._result = response
+        self.log.debug("{} {}: {}".format(self.method, self.url, response.status))
+
+    def release_connection(self, reusable):
+        if self.connection is not None:
+            self.connections.release(self.connection, reusable)
+            self.connection = None
+
+    def wait(self, timeout=0.05):
+        if self.connection is None or self.connection.sock is None:
+            sleep(0.01)
+        elif self._state == 'receiving':
+            select([self.connection.sock], [], [], timeout)
+        else:
+            select([], [self.connection.sock], [], timeout)
+
+    def get_result(self, result_type=None, can_fail=False):
+        """
+        Wait for the response.
+
+        result_type:    None for the HttpResponse, "status", "headers", "body" (bytes) or "text"
+        can_fail:       type bool False raises if the request failed or the status is not expected
+        """
+        while self.poll() is None:
+            if self.deadline is not None and monotonic() >= self.deadline:
+                self.expire()
+                break
+            self.wait()
+        if not can_fail:
+            if self._exception:
+                raise self._exception
+            if not self.was_successful():
+                raise HttpException("{} {} returned {}".format(self.method, self.url, self._result))
+        if result_type is None or self._result is None:
+            return self._result
+        return getattr(self._result, result_type)
+
+    def get_deadline(self):
+        if self._state in (None, 'done') or self._exception is not None:
+            return None
+        return self.deadline
+
+    def terminate(self):
+        self.release_connection(reusable=False)
+
+    def expire(self, final=False):
+        self.terminate()
+        self._state = 'done'
+        self._exception = JobTimeout("{} {} exceeded its timeout of {}s".format(self.method, self.url, self.timeout))
+
+    def was_successful(self):
+        if self.skipped:
+            return True
+        if self._exception is not None or not isinstance(self._result, HttpResponse):
+            return False
+        if self.expected_status is not None:
+            return self._result.status in self.expected_status
+        return 200 <= self._result.status < 400
@@ -0,0 +1,246 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import json
+import os
+from argparse import ArgumentTypeError
+
+from .errors import ConfigNotFoundException
+from .helper import LoggableObject, string_types
+from .logging_helper import logging
+from .journal import job_key
+
+# bump it if the cached form changes
+CACHE_VERSION = 2
+
+
+def shard_of(key, count):
+    """
+    Return the shard (0 .. count - 1) of a host or job key. It only depends on the key, so every machine that
+    runs a shard of the same release gets the same split.
+    """
+    import hashlib
+    return int(hashlib.sha1(key.encode('utf8')).hexdigest(), 16) % count
+
+
+def parse_shard(value):
+    """
+    argparse type for --shard i/n, returns the zero based (index, count).
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ArgumentTypeError("shard has to look like i/n, e.g. 2/4: {}".format(value))
+    if not 1 <= index <= count:
+        raise ArgumentTypeError("shard {} is not between 1 and {}".format(index, count))
+    return index - 1, count
+
+
+def parse_selector(value):
+    """
+    Parse a selector like "dc=ams|fra,role=web,tag=canary" into {field: [values]}. The values of a field are
+    alternatives, the fields have to match all.
+    """
+    selector = {}
+    for part in value.split(','):
+        field, sep, values = part.partition('=')
+        if not sep or not field.strip() or not values.strip():
+            raise ArgumentTypeError("selector has to look like field=value[|value],...: {}".format(value))
+        selector.setdefault(field.strip(), []).extend(value.strip() for value in values.split('|'))
+    return selector
+
+
+def parse_limit(value):
+    """
+    argparse type for --limit, a number of jobs per stage or a selector of hosts in the inventory.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return parse_selector(value)
+
+
+def job_filter(hosts=None, shard=None):
+    """
+    Return a function that tells if a job belongs to the selected hosts (jobs without a host are not filtered)
+    and to the shard (index, count), None if there is nothing to filter.
+    """
+    if hosts is None and shard is None:
+        return None
+
+    def is_selected(job):
+        host = getattr(job, 'host', None)
+        if hosts is not None and host is not None and host not in hosts:
+            return False
+        return shard is None or shard_of(host or job_key(job), shard[1]) == shard[0]
+    return is_selected
+
+
+class Inventory(LoggableObject):
+
+    # fields with a single value per host, tags are a list
+    fields = ('dc', 'role')
+
+    def __init__(self, hosts):
+        """Inventory(hosts)
+
+        hosts:  type List[dict] with the key host, the indexed fields (dc, role) and a list of tags, other keys
+                    are kept but not indexed
+
+        Indexes the hosts by every value of the fields and tags, so a selection costs the size of the smallest
+        matching set instead of a scan of all hosts.
+        """
+        super(Inventory, self).__init__()
+        self.hosts = {}
+        self.order = {}
+        self.index = dict((field, {}) for field in self.fields + ('tag',))
+        for host in hosts:
+            name = host['host']
+            self.order[name] = len(self.order)
+            self.hosts[name] = host
+            for field in self.fields:
+                if host.get(field) is not None:
+                    self.index[field].setdefault(host[field], set()).add(name)
+            for tag in host.get('tags') or ():
+                self.index['tag'].setdefault(tag, set()).add(name)
+
+    @classmethod
+    def load(cls, path, cache_path=None):
+        """
+        Load the inventory file, using the cached hosts if the file did not change. The cache is used as is if
+        the mtime and size of the file match, otherwise if the sha256 of its content matches. The cache is plain
+        json, so a writable cache file can not run code in the controller. A .json inventory is not cached, reading
+        the cache would cost as much as reading the file.
+        """
+        if not os.path.isfile(path):
+            raise ConfigNotFoundException("inventory {} does not exist".format(path))
+        if path.endswith('.json'):
+            with io.open(path, encoding='utf8') as inventory_file:
+                return cls(cls.parse(inventory_file.read(), path))
+        if cache_path is None:
+            directory, name = os.path.split(os.path.abspath(path))
+            cache_path = os.path.join(directory, ".{}.cache".format(name))
+        stat = os.stat(path)
+        cached = cls.read_cache(cache_path)
+        if cached is not None and (cached['mtime'], cached['size']) == (stat.st_mtime, stat.st_size):
+            return cls(cached['hosts'])
+
+        with io.open(path, 'rb') as inventory_file:
+            data = inventory_file.read()
+        # hashlib is only needed if the inventory is used, not to start the cli
+        import hashlib
+        checksum = hashlib.sha256(data).hexdigest()
+        if cached is not None and cached['sha256'] == checksum:
+            hosts = cached['hosts']
+        else:
+            hosts = cls.parse(data.decode('utf8'), path)
+        inventory = cls(hosts)
+        cls.write_cache(cache_path, dict(version=CACHE_VERSION, mtime=stat.st_mtime, size=stat.st_size,
+                                         sha256=checksum, hosts=hosts))
+        return inventory
+
+    @staticmethod
+    def parse(data, path=None):
+        """
+        Parse the content of an inventory file. A .json file has a list of host dicts, other files have one
+        host per line, e.g. "web01 dc=ams role=web tags=canary,ssd", # starts a comment.
+        """
+        if path is not None and path.endswith('.json'):
+            hosts = json.loads(data)
+            return hosts['hosts'] if isinstance(hosts, dict) else hosts
+        hosts = []
+        for line in data.splitlines():
+            parts = line.split('#', 1)[0].split()
+            if not parts:
+                continue
+            host = dict(host=parts[0])
+            for part in parts[1:]:
+                key, _, value = part.partition('=')
+                host[key] = value.split(',') if key == 'tags' else value
+            hosts.append(host)
+        return hosts
+
+    @classmethod
+    def read_cache(cls, cache_path):
+        try:
+            with io.open(cache_path, encoding='utf8') as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            # no cache yet, or one we can not read: parse the inventory again
+            return None
+        if not isinstance(cached, dict) or cached.get('version') != CACHE_VERSION:
+            return None
+        hosts = cached.get('hosts')
+        if not isinstance(hosts, list) or not all(isinstance(host, dict) and 'host' in host for host in hosts):
+            return None
+        if not all(name in cached for name in ('mtime', 'size', 'sha256')):
+            return None
+        return cached
+
+    @classmethod
+    def write_cache(cls, cache_path, cached):
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(cached, cache_file)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError) as e:
+            # the cache only saves time, a read-only directory is fine
+            logging.getLogger("root.inventory").debug("could not write the inventory cache {}: {}".format(
+                cache_path, e))
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def __contains__(self, host):
+        return host in self.hosts
+
+    def __iter__(self):
+        return iter(sorted(self.hosts, key=self.order.get))
+
+    def get(self, host):
+        return self.hosts.get(host)
+
+    def select(self, selector=None, **criteria):
+        """
+        Return the names of the hosts that match, in the order of the inventory.
+
+        select("dc=ams,role=web") or select(dc="ams", role=["web", "api"], tag="canary")
+        """
+        if isinstance(selector, string_types):
+            selector = parse_selector(selector)
+        selector = dict(selector or {})
+        for field, values in criteria.items():
+            selector[field] = [values] if isinstance(values, string_types) else list(values)
+        if not selector:
+            return list(self)
+
+        matches = []
+        for field, values in selector.items():
+            if field == 'host':
+                matches.append(set(value for value in values if value in self.hosts))
+                continue
+            if field not in self.index:
+                raise ValueError("{} is not indexed, use one of host, {}".format(
+                    field, ", ".join(sorted(self.index))))
+            hosts = set()
+            for value in values:
+                hosts |= self.index[field].get(value, set())
+            matches.append(hosts)
+        # intersect the smallest sets first
+        matches.sort(key=len)
+        selected = matches[0].intersection(*matches[1:])
+        return sorted(selected, key=self.order.get)
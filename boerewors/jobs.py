@@ -14,10 +14,15 @@
 
 from subprocess import Popen, PIPE, STDOUT, CalledProcessError
 from select import select
+from time import sleep
 import os
+import signal
+import sys
 
-from .result import Result, Ok, Err, Skip
-from .helper import LoggableObject
+from .errors import JobCancelled, JobTimeout
+from .result import Result, Ok, Err, Skip, Timeout
+from .helper import LoggableObject, monotonic, string_types
+from .spawn import spawn
 
 try:
     from shlex import quote as cmd_quote
@@ -27,10 +32,44 @@ except ImportError:
 
 class Job(LoggableObject):
     max_retries = 1
-
-    def __init__(self, max_retries=None):
+    retry_policy = None
+    # monotonic time until the job waits for its next attempt, the pool parks the job until then
+    wakeup_at = None
+    # seconds a single attempt may take, None for no limit
+    timeout = None
+    # monotonic time when the current attempt times out
+    deadline = None
+    # values of the concurrency keys this job counts against, e.g. {'dc': 'ams', 'lb_pool': 'web-ams-1'}
+    concurrency_keys = None
+    # tokens the pool takes from the named rate limits before it starts the job, e.g. {'bastion': 1}, see ratelimit
+    rate_limits = None
+    # used by pools with scheduling='priority': higher priorities first, then the longest expected duration (seconds)
+    priority = 0
+    expected_duration = None
+    # the host this job works on, used to identify the job e.g. in the duration history
+    host = None
+    # identifies the job between runs, e.g. in the journal (default: the stage and the index of the job in it)
+    job_id = None
+    # identifies the input of an idempotent job, a successful result is cached under this key (see ResultCache)
+    cache_key = None
+    # (control_dir, control_persist) of the multiplexed ssh connections of the job and its subtasks, None uses the
+    # class attributes of SSHJob (see set_ssh_control)
+    ssh_control = None
+    # monotonic times set by the pool
+    started_at = None
+    finished_at = None
+    # attributes that hold the outcome of a job, a ShardedPool copies them from the worker process
+    state_attributes = ('_result', '_exception', '_failed_finally', 'started_at', 'finished_at')
+
+    def __init__(self, max_retries=None, retry_policy=None, timeout=None):
         super(Job, self).__init__()
         self.max_retries = self.__class__.max_retries if max_retries is None else max_retries
+        if retry_policy is not None:
+            self.retry_policy = retry_policy
+        if timeout is not None:
+            self.timeout = timeout
+        self.wakeup_at = None
+        self.deadline = None
         self._job = None
         self._failed_finally = False
         self._result = None
@@ -45,7 +84,8 @@ class Job(LoggableObject):
 
     def get_result(self, result_type=None, wait_for_it=True, can_fail=False):
         while wait_for_it and self.poll() is None:
-            continue
+            if self.wakeup_at is not None:
+                sleep(max(0, self.wakeup_at - monotonic()))
         if not can_fail and self._exception:
             raise self._exception
         return self._result
@@ -54,29 +94,43 @@ class Job(LoggableObject):
         self.sub_task = self.get_next_subtask()
 
     def job_wrapper(self):
-        for idx in range(1, self.max_retries + 1):
+        for attempt in range(1, self.max_retries + 1):
             self.reset()
-            self.log.info("try to execute {}/{}".format(idx, self.max_retries))
+            self.log.info("try to execute {}/{}".format(attempt, self.max_retries))
+            self.deadline = monotonic() + self.timeout if self.timeout else None
             try:
                 for idx, sub_task in enumerate(self.run_job()):
                     self.log.debug("          {}.. subtask {}".format(idx, sub_task))
                     if isinstance(sub_task, LoggableObject):
                         sub_task.set_logging_info(self._logging_info, idx)
+                    self.pass_ssh_control(sub_task)
 
                     self.sub_task = sub_task
                     if isinstance(sub_task, Result):
                         self._result = sub_task
                         break
                     yield sub_task
+            except JobTimeout as e:
+                self.log.error("attempt timed out: {}".format(e))
+                self._result = Timeout(str(e))
             except Exception as e:
                 self.log.exception("subtask had an exception and died")
                 # self.set_exception_to_corresponding_sub_job(e)
                 self._exception = e
+            self.deadline = None
             self.log.debug("sub_tasks done")
             if not self._exception and self._result:
                 self.log.info("job successful")
                 break
             self.log.info("job not successful")
+            if self.timed_out() and self.retry_policy is not None and not self.retry_policy.retry_on_timeout:
+                self._failed_finally = True
+                self.log.error("job timed out, it will not be retried")
+                return
+            if self.retry_policy is not None and attempt < self.max_retries:
+                delay = self.retry_policy.get_delay(attempt)
+                self.log.info("retry in {:.2f}s".format(delay))
+                self.wakeup_at = monotonic() + delay
             yield False
         else:
             self._failed_finally = True
@@ -88,6 +142,12 @@ class Job(LoggableObject):
             self.log.debug("task finished failed finally {}, result {}".format(self._failed_finally, self._result))
             return True
 
+        if self.wakeup_at is not None:
+            if monotonic() < self.wakeup_at:
+                # we are waiting for the next attempt
+                return None
+            self.wakeup_at = None
+
         if not self.sub_task:
             # this job has not been started yet
             self.log.debug("the sub task {} has not been started yet. Lets start it".format(repr(self.sub_task)))
@@ -98,6 +158,9 @@ class Job(LoggableObject):
         if isinstance(self.sub_task, Job):
             is_sub_task_finished = self.sub_task.poll()
             if is_sub_task_finished is None:
+                if self.sub_task.wakeup_at is not None:
+                    # the subtask waits (e.g. for a rate limit or a retry), the pool parks this job meanwhile
+                    self.wakeup_at = self.sub_task.wakeup_at
                 return None
 
         next_sub_task = self.get_next_subtask()
@@ -107,6 +170,13 @@ class Job(LoggableObject):
             # we are finished
             pass
 
+    def get_state(self):
+        return dict((name, getattr(self, name, None)) for name in self.state_attributes)
+
+    def set_state(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def get_next_subtask(self):
         if self._job is None:
             # initialize the job
@@ -116,6 +186,95 @@ class Job(LoggableObject):
         except StopIteration:
             return False
 
+    def set_ssh_control(self, ssh_control):
+        """
+        Open the ssh connections of this job and of the subtasks it yields with the settings ssh_control
+        (control_dir, control_persist), e.g. the ones of a ControlDirectory, instead of the class attributes of SSHJob.
+        """
+        self.ssh_control = ssh_control
+
+    def pass_ssh_control(self, sub_task):
+        if self.ssh_control is not None and isinstance(sub_task, Job) and sub_task.ssh_control is None:
+            sub_task.set_ssh_control(self.ssh_control)
+
+    def get_deadline(self):
+        """
+        Return the earliest (monotonic) deadline of this job and its running subtasks, None if there is none.
+        """
+        deadline = self.deadline
+        if isinstance(self.sub_task, Job):
+            sub_task_deadline = self.sub_task.get_deadline()
+            if deadline is None or (sub_task_deadline is not None and sub_task_deadline < deadline):
+                deadline = sub_task_deadline
+        return deadline
+
+    def terminate(self):
+        """
+        Kill the processes of the running subtasks.
+        """
+        if isinstance(self.sub_task, Job):
+            self.sub_task.terminate()
+
+    def expire(self, final=False):
+        """
+        Abort what passed its deadline.
+
+        If the deadline of this job passed, the current attempt is aborted with a Timeout result and the job
+        may be retried. If only the deadline of a subtask passed, the subtask is aborted and get_subtask_result
+        raises a JobTimeout. With final=True the job is aborted for good, e.g. if the stage ran out of time.
+        """
+        if final:
+            self.terminate()
+            if self._job is not None:
+                self._job.close()
+            self.deadline = None
+            self.wakeup_at = None
+            self._result = Timeout("the stage timed out")
+            self._failed_finally = True
+            self.log.error("job aborted, the stage timed out")
+        elif self.deadline is not None and self.deadline <= monotonic():
+            self.terminate()
+            try:
+                next_sub_task = self._job.throw(
+                    JobTimeout("{} exceeded its timeout of {}s".format(self.name, self.timeout)))
+            except StopIteration:
+                next_sub_task = False
+            if next_sub_task:
+                self.sub_task = next_sub_task
+        elif isinstance(self.sub_task, Job):
+            self.sub_task.expire()
+
+    def cancel(self, reason="cancelled"):
+        """
+        Stop the job for good, e.g. because another subtask of its Parallel group failed. The running subtask is
+        cancelled as well and the job is finished with a JobCancelled exception.
+        """
+        if isinstance(self.sub_task, Job):
+            self.sub_task.cancel(reason)
+        else:
+            self.terminate()
+        if self._job is not None:
+            self._job.close()
+        self.deadline = None
+        self.wakeup_at = None
+        self._exception = JobCancelled(reason)
+        self._failed_finally = True
+        self.log.warning("job cancelled: {}".format(reason))
+
+    def timed_out(self):
+        return isinstance(self._result, Timeout) or isinstance(self._exception, JobTimeout)
+
+    def skip(self, reason=True):
+        """
+        Mark the job as done without running it, the pool finishes it right away.
+        """
+        self.log.info("skip job: {}".format(reason))
+        self._result = Skip(reason)
+
+    @property
+    def skipped(self):
+        return isinstance(self._result, Skip)
+
     def get_subtask_result(self, result_type=None, can_fail=False):
         """
 
@@ -183,8 +342,21 @@ def _decode(output):
 
 class PopenJob(Job):
 
+    state_attributes = Job.state_attributes + ('_stdout', '_stderr')
+
     def __init__(self, *args, **kwargs):
         super(PopenJob, self).__init__()
+        self.timeout = kwargs.pop('timeout', None)
+        if os.name == 'posix' and self.timeout:
+            # run the process in its own process group, so a timeout can kill all of its children too. Without a
+            # timeout the process stays in the group of boerewors (e.g. Ctrl-C reaches it), unless it is started
+            # with start_new_session=True (preexec_fn=os.setsid on python 2)
+            if sys.version_info[0] >= 3:
+                kwargs.setdefault('start_new_session', True)
+            else:
+                kwargs.setdefault('preexec_fn', os.setsid)
+        self._own_process_group = os.name == 'posix' and bool(
+            kwargs.get('start_new_session') or kwargs.get('preexec_fn') is os.setsid)
         self.log.debug("init popenjob {} {}".format(args, kwargs))
         self.args = args
         self.kwargs = kwargs
@@ -240,7 +412,8 @@ class PopenJob(Job):
 
     def start(self):
         self.log.debug("start task")
-        self.proc = Popen(*self.args, **self.kwargs)
+        self.proc = spawn(*self.args, **self.kwargs)
+        self.deadline = monotonic() + self.timeout if self.timeout else None
         self._read_handles = []
         if self.proc.stdout:
             self._read_handles.append(self.proc.stdout)
@@ -270,6 +443,9 @@ class PopenJob(Job):
 
     def poll(self):
         if self.proc is None:
+            if self._exception is not None:
+                # cancelled before it was started
+                return True
             self.start()
             return None
 
@@ -283,8 +459,39 @@ class PopenJob(Job):
 
         return retval
 
+    def get_deadline(self):
+        if self.proc is None or self._result is not None:
+            return None
+        return self.deadline
+
+    def terminate(self):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.log.warning("kill process {}".format(self.proc.pid))
+        try:
+            if self._own_process_group:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except OSError:
+            # the process finished in the meantime
+            pass
+
+    def expire(self, final=False):
+        self.terminate()
+        self._exception = JobTimeout("command exceeded its timeout of {}s: {}".format(self.timeout, self.args))
+
+    def cancel(self, reason="cancelled"):
+        # poll reaps the killed process
+        self.terminate()
+        self._exception = JobCancelled(reason)
+
     def was_successful(self):
-        if self.proc is None or self.proc.returncode is None:
+        if self.skipped:
+            return True
+        # the return code, also if the process ran in another process (see ShardedPool). A timeout or a cancel
+        # fails the job, even if the process exited with 0 before it was killed
+        if self._result is None or self._exception is not None:
             return False
 
         retval = self._result == 0
@@ -299,22 +506,47 @@ class PopenJob(Job):
 
 class BourneShell(PopenJob):
 
-    def __init__(self, bash_command, stdout=PIPE, stderr=STDOUT):
-        super(BourneShell, self).__init__(["bash", "-c", bash_command], stdout=stdout, stderr=stderr)
+    def __init__(self, bash_command, stdout=PIPE, stderr=STDOUT, timeout=None):
+        super(BourneShell, self).__init__(["bash", "-c", bash_command], stdout=stdout, stderr=stderr,
+                                          timeout=timeout)
         self.log.debug("init bourneshell {}".format(bash_command))
 
 
+DEFAULT_SSH_OPTIONS = ['StrictHostKeyChecking=no', 'BatchMode=yes', 'ConnectTimeout=10']
+
+
+def ssh_options(options=None, control_dir=None, control_persist=60):
+    """
+    Return the ssh options (default: DEFAULT_SSH_OPTIONS). With a control_dir all connections to a host share one
+    master connection, that stays open for control_persist seconds after the last one finished.
+    """
+    options = list(DEFAULT_SSH_OPTIONS if options is None else options)
+    if control_dir is not None:
+        options += [
+            'ControlMaster=auto',
+            'ControlPath={}'.format(os.path.join(control_dir, '%C')),
+            'ControlPersist={}'.format(control_persist),
+        ]
+    return options
+
+
 class SSHJob(PopenJob):
 
     user = "sshuser"
+    # directory for the sockets of multiplexed ssh connections, None opens a new connection for every command
+    control_dir = None
+    # seconds a master connection stays open after its last command, "yes" until it is closed with ssh -O exit
+    control_persist = 60
 
-    def __init__(self, ip, bash_command, user=None, options=None, stdout=PIPE, stderr=STDOUT):
-        """SSHJob(ip, bash_command, user=None, options=None, stdout=PIPE, stderr=STDOUT)
+    def __init__(self, ip, bash_command, user=None, options=None, stdout=PIPE, stderr=STDOUT, timeout=None):
+        """SSHJob(ip, bash_command, user=None, options=None, stdout=PIPE, stderr=STDOUT, timeout=None)
 
         ip:             type str ip or hostname
         bash_command:   type str bash command that should be executed on the server
         user:           type str user name that connects to the server
         options:        type List[str] default: ['StrictHostKeyChecking=no', 'BatchMode=yes', 'ConnectTimeout=10']
+                            if the class attribute control_dir (or the ssh_control of the job) is set, the options
+                            to reuse connections are added
         stdout:         type str or subprocess.PIPE
                             "pipe" creates a file object (default)
                             None disables stdout for the process
@@ -322,15 +554,13 @@ class SSHJob(PopenJob):
                             "pipe" creates a file object
                             "stdout" redirects stderr to stdout (default)
                             None disables stderr for the process
+        timeout:        type float seconds after which the ssh process group is killed, None for no limit
 
         runs the following bash command '/usr/bin/ssh {options} {user}@{server} {bash_command}'
 
         the bash_command will be quoted to make sure that all of it is executed remotely
 
         """
-        if options is None:
-            options = ['StrictHostKeyChecking=no', 'BatchMode=yes', 'ConnectTimeout=10']
-
         if str(stdout).lower() == "pipe":
             stdout = PIPE
         if str(stderr).lower() == "pipe":
@@ -345,21 +575,428 @@ class SSHJob(PopenJob):
             "bash_command": self.bash_command,
         }
         self.ip = ip
+        self.login = "{user}@{server}".format(**data)
+        self.options = options
+        ssh_command = self.get_ssh_command()
+
+        super(SSHJob, self).__init__(ssh_command, stdout=stdout, stderr=stderr, timeout=timeout)
+        self.ssh_command = ssh_command
+        self.host = ip
+        self.log.debug("init ssh with {}".format(data))
+
+    def get_ssh_command(self):
+        control_dir, control_persist = self.ssh_control or (self.control_dir, self.control_persist)
         ssh_command = ['/usr/bin/ssh']
-        for option in options:
+        for option in ssh_options(self.options, control_dir, control_persist):
             ssh_command += ["-o", option]
         ssh_command += [
-            "{user}@{server}".format(**data),
+            self.login,
             "/usr/bin/env",
             "bash",
             "-xec",
             self.bash_command
         ]
+        return ssh_command
 
-        super(SSHJob, self).__init__(ssh_command, stdout=stdout, stderr=stderr)
-        self.ssh_command = ssh_command
-        self.log.debug("init ssh with {}".format(data))
+    def set_ssh_control(self, ssh_control):
+        super(SSHJob, self).set_ssh_control(ssh_control)
+        if self.proc is None:
+            self.ssh_command = self.get_ssh_command()
+            self.args = (self.ssh_command,)
 
     def start(self):
         self.log.notice('\nSSH command started({ip}): \n{bash_command}'.format(bash_command=self.bash_command, ip=self.ip))
-        super(SSHJob, self).start()
\ No newline at end of file
+        super(SSHJob, self).start()
+
+_process_pool = None
+
+
+def process_pool_available():
+    try:
+        import concurrent.futures  # noqa: F401
+    except ImportError:
+        # python 2 without the `futures` backport
+        return False
+    return True
+
+
+def get_process_pool(max_workers=None):
+    """Return the ProcessPoolExecutor shared by all ProcessJobs, create it on first use.
+
+    max_workers is only used when the executor is created, defaults to the number of cpus.
+    """
+    global _process_pool
+    if _process_pool is None:
+        if not process_pool_available():
+            raise RuntimeError("ProcessJob needs concurrent.futures, install the `futures` backport on python 2")
+        # imported on first use, it pulls in multiprocessing which slows down the start of every run
+        from concurrent.futures import ProcessPoolExecutor
+        _process_pool = ProcessPoolExecutor(max_workers=max_workers)
+    return _process_pool
+
+
+def shutdown_process_pool(wait=True):
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=wait)
+        _process_pool = None
+
+
+class ProcessJob(Job):
+
+    def __init__(self, function, *args, **kwargs):
+        """ProcessJob(function, *args, **kwargs)
+
+        function:       picklable callable (e.g. a module level function), it will be executed in the shared
+                        process pool as function(*args, **kwargs)
+
+        Use it for cpu heavy work on the controller (checksums, compression, rendering configs). The pool keeps
+        polling the other jobs while the function is computed on another core. The return value of the
+        function is the result of this job.
+        """
+        super(ProcessJob, self).__init__()
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.future = None
+
+    def start(self):
+        self.log.debug("submit {} to the process pool".format(getattr(self.function, '__name__', self.function)))
+        self.future = get_process_pool().submit(self.function, *self.args, **self.kwargs)
+
+    def poll(self):
+        if self.future is None:
+            self.start()
+            return None
+        if self.future.cancelled():
+            return True
+        if not self.future.done():
+            return None
+        if self._exception is None:
+            self._exception = self.future.exception()
+        if self._exception is None:
+            self._result = self.future.result()
+        return True
+
+    def get_result(self, result_type=None, can_fail=False):
+        if self.future is None:
+            self.start()
+        # there is nothing to drive, so we can block on the future
+        self.future.exception()
+        self.poll()
+        if not can_fail and self._exception:
+            raise self._exception
+        return self._result
+
+    def was_successful(self):
+        if self.skipped:
+            return True
+        if self._exception is not None or self.future is None or not self.future.done():
+            return False
+        return self.future.exception() is None
+
+    def cancel(self, reason="cancelled"):
+        # a function that runs already can not be stopped, it finishes but does not count
+        if self.future is not None:
+            self.future.cancel()
+        self._exception = JobCancelled(reason)
+
+
+class Parallel(Job):
+
+    def __init__(self, jobs, fail_fast=False):
+        """Parallel(jobs, fail_fast=False)
+
+        jobs:       type List[Job] subtasks that run at the same time, in the pool slot of the job that yields them
+        fail_fast:  type bool kill the other subtasks as soon as one of them failed
+
+        A subtask that is finished when all of its subtasks are finished. The results are returned as a list in
+        the order of the subtasks, e.g.
+
+            yield Parallel([self.download(), self.remove_old_releases()])
+            download, cleanup = self.get_subtask_result()
+
+        get_result reraises the exception of the first failed subtask, with can_fail=True the list holds the
+        exception of a failed subtask instead of its result. With fail_fast the running subtasks are cancelled
+        (their processes are killed) after a failure and the group finishes once they returned.
+        """
+        super(Parallel, self).__init__()
+        self.jobs = list(jobs)
+        self.fail_fast = fail_fast
+        self._running = None
+        self._stopped = False
+        self._cancelled = set()
+
+    def start(self):
+        for idx, job in enumerate(self.jobs):
+            job.set_logging_info(self._logging_info, idx)
+            self.pass_ssh_control(job)
+        self._running = list(self.jobs)
+
+    def poll(self):
+        if self._running is None:
+            self.start()
+        running = []
+        for job in self._running:
+            if job.poll() is None:
+                running.append(job)
+            elif self.fail_fast and not self._stopped and not job.was_successful():
+                self.log.error("subtask {} failed, stop the others".format(job))
+                self._stopped = True
+        self._running = running
+        if self._stopped:
+            self.cancel_running("another subtask failed")
+        if self._running:
+            return None
+        # the outcome as it is, get_result of a failed subtask would raise (e.g. the JobTimeout of a PopenJob)
+        self._result = [job._exception if job._exception is not None else job._result for job in self.jobs]
+        return True
+
+    def cancel_running(self, reason):
+        for job in self._running or ():
+            if id(job) not in self._cancelled:
+                self._cancelled.add(id(job))
+                job.cancel(reason)
+
+    def cancel(self, reason="cancelled"):
+        if self._running is None:
+            self.start()
+        self._stopped = True
+        self.cancel_running(reason)
+
+    def get_result(self, result_type=None, can_fail=False):
+        while self.poll() is None:
+            # the subtasks wait for their processes, do not spin a core meanwhile
+            select([], [], [], 0.001)
+        if not can_fail:
+            failed = [job for job in self.jobs if not job.was_successful()]
+            # the subtasks that were cancelled because of a failure come last
+            failed.sort(key=lambda job: isinstance(job._exception, JobCancelled))
+            for job in failed:
+                # reraise the exception of the failed job
+                job.get_result(result_type)
+        return self._result
+
+    def get_deadline(self):
+        deadlines = [job.get_deadline() for job in self._running or ()]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def terminate(self):
+        for job in self._running or ():
+            job.terminate()
+
+    def expire(self, final=False):
+        now = monotonic()
+        for job in self._running or ():
+            deadline = job.get_deadline()
+            if final or (deadline is not None and deadline <= now):
+                job.expire(final)
+
+    def was_successful(self):
+        if self.skipped:
+            return True
+        return self._result is not None and all(job.was_successful() for job in self.jobs)
+
+
+class BandwidthShare(object):
+
+    def __init__(self, total, shares):
+        """BandwidthShare(total, shares)
+
+        total:      type int bandwidth in KB/s for all transfers together, e.g. for a pool
+        shares:     type int number of transfers that run at the same time at most, e.g. the pool size
+
+        A new transfer gets an equal share of the bandwidth that is not used by the running transfers, so the
+        transfers never use more than total together.
+        """
+        self.total = total
+        self.shares = shares
+        self.allocated = 0
+        self.active = 0
+
+    def acquire(self):
+        free = self.total - self.allocated
+        share = max(1, int(free / max(1, self.shares - self.active)))
+        self.allocated += share
+        self.active += 1
+        return share
+
+    def release(self, share):
+        self.allocated -= share
+        self.active -= 1
+
+
+def sha256_file(path, block_size=1024 * 1024):
+    import hashlib
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(block_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def local_checksum(path, checksums):
+    """
+    Return a subtask that computes the sha256 of a local file. The checksums are cached in the dict checksums by
+    the full path, size and mtime, so a file that is copied to many hosts with the same dict is only read once.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in checksums:
+        if process_pool_available():
+            checksums[key] = ProcessJob(sha256_file, path)
+        else:
+            checksums[key] = CachedResult(sha256_file(path))
+    return checksums[key]
+
+
+class CachedResult(Job):
+
+    def __init__(self, value):
+        super(CachedResult, self).__init__()
+        self._result = value
+
+    def poll(self):
+        return True
+
+    def get_result(self, result_type=None, can_fail=False):
+        return self._result
+
+    def was_successful(self):
+        return True
+
+
+class TransferJob(Job):
+
+    user = "sshuser"
+
+    def __init__(self, ip, sources, destination, user=None, options=None, compress=False, delta=True,
+                 bwlimit=None, bandwidth=None, parallel=1, verify=True, timeout=None, checksums=None):
+        """TransferJob(ip, sources, destination, user=None, options=None, compress=False, delta=True,
+                       bwlimit=None, bandwidth=None, parallel=1, verify=True, timeout=None, checksums=None)
+
+        ip:             type str ip or hostname
+        sources:        type str or List[str] local files or directories
+        destination:    type str remote directory, the sources are copied into it
+        user:           type str user name that connects to the server
+        options:        type List[str] ssh options, see SSHJob (connections are reused if SSHJob.control_dir or the
+                            ssh_control of the job is set)
+        compress:       type bool compress the data during the transfer
+        delta:          type bool only transfer the changed parts of files that exist already
+        bwlimit:        type int bandwidth limit in KB/s for this job
+        bandwidth:      type BandwidthShare bandwidth shared with other jobs, e.g. all jobs of the pool
+        parallel:       type int number of rsync processes, the sources are split into this many chunks
+        verify:         type bool compare the sha256 of the copied files with the local ones, the files in
+                            directories too (symlinks are not compared)
+        timeout:        type float seconds for every rsync process
+        checksums:      type dict cache of the local checksums, share one dict between the jobs that copy the same
+                            files to different hosts (default: a dict of this job)
+
+        copies the sources with rsync over ssh
+        """
+        super(TransferJob, self).__init__()
+        self.ip = self.host = ip
+        self.sources = [sources] if isinstance(sources, string_types) else list(sources)
+        self.destination = destination
+        self.user = self.__class__.user if user is None else user
+        self.options = options
+        self.compress = compress
+        self.delta = delta
+        self.bwlimit = bwlimit
+        self.bandwidth = bandwidth
+        self.parallel = max(1, parallel)
+        self.verify = verify
+        self.transfer_timeout = timeout
+        self.checksums = {} if checksums is None else checksums
+
+    def get_chunks(self):
+        """
+        Split the sources into chunks of about the same size, the biggest files first.
+        """
+        chunks = [[] for _ in range(min(self.parallel, len(self.sources)))]
+        sizes = [0] * len(chunks)
+        by_size = sorted(self.sources, key=lambda path: os.path.getsize(path) if os.path.isfile(path) else 0,
+                         reverse=True)
+        for path in by_size:
+            idx = sizes.index(min(sizes))
+            chunks[idx].append(path)
+            sizes[idx] += os.path.getsize(path) if os.path.isfile(path) else 0
+        return chunks
+
+    def rsync_command(self, chunk, bwlimit=None):
+        command = ['rsync', '-a', '--partial']
+        if self.compress:
+            command.append('-z')
+        if not self.delta:
+            command.append('--whole-file')
+        if bwlimit:
+            command.append('--bwlimit={}'.format(bwlimit))
+        control_dir, control_persist = self.ssh_control or (SSHJob.control_dir, SSHJob.control_persist)
+        ssh = ['ssh']
+        for option in ssh_options(self.options, control_dir, control_persist):
+            ssh += ['-o', option]
+        command += ['-e', ' '.join(cmd_quote(part) for part in ssh)]
+        command += chunk
+        command.append('{}@{}:{}/'.format(self.user, self.ip, self.destination.rstrip('/')))
+        return command
+
+    def remote_command(self, command):
+        return SSHJob(self.ip, command, user=self.user, options=self.options, timeout=self.transfer_timeout)
+
+    def get_copied_files(self):
+        """
+        Return {path relative to the destination: local path} of the regular files that rsync copies, a directory
+        source "dir" ends up in destination/dir, "dir/" copies its contents.
+        """
+        files = {}
+        for source in self.sources:
+            if os.path.isdir(source):
+                prefix = "" if source.endswith('/') else os.path.basename(os.path.normpath(source))
+                for root, _, names in os.walk(source):
+                    for name in names:
+                        path = os.path.join(root, name)
+                        if os.path.isfile(path) and not os.path.islink(path):
+                            files[os.path.join(prefix, os.path.relpath(path, source))] = path
+            elif os.path.isfile(source) and not os.path.islink(source):
+                files[os.path.basename(source)] = source
+        return files
+
+    def get_bwlimit(self, share):
+        limits = [limit for limit in (self.bwlimit, share) if limit]
+        if not limits:
+            return None
+        return max(1, int(min(limits) / self.parallel))
+
+    def run_job(self):
+        share = self.bandwidth.acquire() if self.bandwidth is not None else None
+        try:
+            bwlimit = self.get_bwlimit(share)
+            yield Parallel(PopenJob(self.rsync_command(chunk, bwlimit), stdout=PIPE, stderr=STDOUT,
+                                    timeout=self.transfer_timeout)
+                           for chunk in self.get_chunks())
+            error = self.error_if_subtask_failed()
+        finally:
+            if share is not None:
+                self.bandwidth.release(share)
+        if error is not None:
+            yield error
+
+        files = self.get_copied_files() if self.verify else {}
+        if files:
+            names = sorted(files)
+            yield Parallel(local_checksum(files[name], self.checksums) for name in names)
+            expected = dict(zip(names, self.get_subtask_result()))
+            # sha256sum reads stdin without file names, a missing file is a mismatch, not a failed command
+            command = "cd {} && sha256sum -- {} < /dev/null".format(
+                cmd_quote(self.destination), " ".join(cmd_quote(name) for name in names))
+            yield self.remote_command(command)
+            remote = {}
+            for line in (self.get_subtask_result('stdout', can_fail=True) or "").splitlines():
+                parts = line.split(None, 1)
+                if len(parts) == 2 and parts[1] in expected:
+                    remote[parts[1]] = parts[0]
+            mismatches = [name for name in names if remote.get(name) != expected[name]]
+            if mismatches:
+                yield self.Error("checksum mismatch: {}".format(", ".join(mismatches)))
+        yield self.Ok(self.sources)
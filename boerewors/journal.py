@@ -0,0 +1,170 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import json
+import os
+import random
+import time
+
+from .helper import LoggableObject, monotonic
+
+
+def new_run_id():
+    return "{}-{:04x}".format(time.strftime("%Y%m%d-%H%M%S"), random.randint(0, 0xffff))
+
+
+def job_status(job):
+    if job.was_successful():
+        return "ok"
+    if job.timed_out():
+        return "timeout"
+    return "error"
+
+
+def job_key(job):
+    # the explicit id of the job, otherwise the stage and the index of the job in it, both are stable between runs
+    # (several jobs of a stage can work on the same host)
+    return getattr(job, 'job_id', None) or job._logging_info
+
+
+def read_records(path):
+    if not os.path.exists(path):
+        return
+    with io.open(path, encoding='utf8') as journal_file:
+        for line in journal_file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # the last line can be incomplete if the controller died while writing it
+                continue
+
+
+class Journal(LoggableObject):
+
+    def __init__(self, path, run_id, sync_every=100, sync_interval=1.0):
+        """Journal(path, run_id, sync_every=100, sync_interval=1.0)
+
+        path:           type str the journal file, records are appended as json lines
+        run_id:         type str the id of this run, a resumed run uses the id of the interrupted one
+        sync_every:     type int number of records after which the file is synced to the disk
+        sync_interval:  type float seconds after which pending records are synced to the disk, checked on every
+                            write and on the tick of the pool (see JournalRecorder)
+
+        Records the outcome of every job and stage. Syncing in batches keeps the journal cheap for big stages,
+        at most the records of the last batch are lost if the controller dies.
+        """
+        super(Journal, self).__init__()
+        self.path = path
+        self.run_id = run_id
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._file = io.open(path, 'a', encoding='utf8')
+        self._pending = 0
+        self._last_sync = monotonic()
+
+    @staticmethod
+    def last_run_id(path):
+        run_id = None
+        for record in read_records(path):
+            run_id = record.get('run_id', run_id)
+        return run_id
+
+    @staticmethod
+    def load_outcomes(path, run_id):
+        """
+        Return the last status of every job of the run as {(stage, job): status}.
+        """
+        outcomes = {}
+        for record in read_records(path):
+            if record.get('run_id') == run_id and record.get('type') == 'job':
+                outcomes[(record['stage'], record['job'])] = record['status']
+        return outcomes
+
+    def write(self, record_type, **record):
+        record.update(type=record_type, run_id=self.run_id, time=time.time())
+        line = json.dumps(record, sort_keys=True)
+        if not isinstance(line, type(u"")):
+            # python 2
+            line = line.decode('utf8')
+        self._file.write(line + u"\n")
+        self._pending += 1
+        if self._pending >= self.sync_every:
+            self.sync()
+        else:
+            self.sync_if_due(monotonic())
+
+    def sync_if_due(self, now):
+        """
+        Sync the pending records if the last sync is sync_interval seconds ago, e.g. on the tick of the pool, so
+        the last records of a stage whose jobs stopped finishing reach the disk too.
+        """
+        if self._pending and now - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+        self._last_sync = monotonic()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class JournalRecorder(object):
+
+    def __init__(self, journal, stage, outcomes=None, retry_failed=False):
+        """JournalRecorder(journal, stage, outcomes=None, retry_failed=False)
+
+        journal:        type Journal
+        stage:          the running stage
+        outcomes:       type dict {(stage, job): status} of the resumed run, see Journal.load_outcomes
+        retry_failed:   type bool only run the jobs that failed in the resumed run, skip all others
+
+        A pool listener that writes the outcome of every finished job to the journal and skips the jobs that
+        are already done.
+        """
+        self.journal = journal
+        self.stage_key = stage._logging_info
+        self.outcomes = outcomes or {}
+        self.retry_failed = retry_failed
+
+    def add_job(self, job):
+        status = self.outcomes.get((self.stage_key, job_key(job)))
+        if self.retry_failed:
+            done = status in (None, "ok")
+        else:
+            done = status == "ok"
+        if done:
+            job.skip("done in run {}".format(self.journal.run_id))
+        return job
+
+    def task_started(self, pool, task):
+        pass
+
+    def task_finished(self, pool, task):
+        if task.skipped:
+            return
+        self.journal.write("job", stage=self.stage_key, job=job_key(task), status=job_status(task))
+
+    def tick(self, pool, now):
+        self.journal.sync_if_due(now)
+
+    def finish(self, errors):
+        self.journal.write("stage", stage=self.stage_key, status="error" if errors else "ok")
+        self.journal.sync()
@@ -34,5 +34,11 @@ setLoggerClass(MyLogger)
 
 root_logger = logging.getLogger('root')
 
-if not root_logger.handlers:
-    logging.basicConfig(level=NOTICE, format=FORMAT)
+
+def setup_logging(level=NOTICE, format=FORMAT):
+    """
+    Log to stderr, unless the application configured a handler already. Called by the BoereworsExecutor, so
+    importing boerewors as a library leaves the logging configuration alone.
+    """
+    if not root_logger.handlers:
+        logging.basicConfig(level=level, format=format)
@@ -13,51 +13,372 @@
 # limitations under the License.
 
 from collections import deque
-from .helper import LoggableObject
+from heapq import heappush, heappop
+from itertools import count
+from time import sleep
+from .helper import LoggableObject, monotonic
 from .logging_helper import logging
+from . import ratelimit
+from .timers import TimerWheel
+
+
+class PriorityQueue(object):
+    """
+    Drop-in replacement for the deque of upcomming tasks that pops the most important task first.
+
+    Tasks with a higher `priority` go first, tasks with the same priority are ordered by their `expected_duration`
+    (longest first) and finally by the order they were added. Adding and popping a task is O(log n).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = count()
+
+    def _key(self, task, order):
+        priority = getattr(task, 'priority', 0) or 0
+        expected_duration = getattr(task, 'expected_duration', None) or 0
+        return (-priority, -expected_duration, order)
+
+    def append(self, task):
+        order = getattr(task, '_queue_order', None)
+        if order is None:
+            # kept on the task, the queue holds nothing of a task that was popped for good
+            order = task._queue_order = next(self._counter)
+        # the second counter breaks ties between tasks that got their order from another queue
+        heappush(self._heap, (self._key(task, order), next(self._counter), task))
+
+    # a task that is put back keeps its original position
+    appendleft = append
+
+    def popleft(self):
+        if not self._heap:
+            raise IndexError("pop from an empty priority queue")
+        _, _, task = heappop(self._heap)
+        return task
+
+    def clear(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __bool__(self):
+        return bool(self._heap)
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return (task for _, _, task in sorted(self._heap, key=lambda entry: entry[:2]))
 
 
 class Pool(LoggableObject):
 
-    def __init__(self, pool_size=10):
+    def __init__(self, pool_size=10, deadline=None, timer_resolution=0.1, concurrency_limits=None,
+                 scheduling='fifo', keep_finished=True, rate_limit_share=1.0):
+        """Pool(pool_size=10, deadline=None, timer_resolution=0.1, concurrency_limits=None, scheduling='fifo',
+                keep_finished=True, rate_limit_share=1.0)
+
+        pool_size:          type int maximum number of tasks running at the same time
+        deadline:           type float monotonic time when all remaining tasks are aborted (e.g. the stage timeout)
+        timer_resolution:   type float seconds, deadlines of tasks are enforced at most this late
+        concurrency_limits: type dict maximum number of running tasks per value of a concurrency key,
+                                e.g. {'lb_pool': 2, 'dc': 50}. The tasks provide their values in
+                                task.concurrency_keys, e.g. {'lb_pool': 'web-ams-1', 'dc': 'ams'}. A limit can be
+                                a callable that returns the current limit, e.g. if the capacity grows during the run
+        scheduling:         type str 'fifo' starts the tasks in the order they were added, 'priority' starts the
+                                tasks with the highest task.priority and then the longest task.expected_duration
+                                first (see PriorityQueue)
+        keep_finished:      type bool False does not keep the finished tasks in finished_tasks, the listeners
+                                still get every one of them, e.g. to stream the outcomes (see report.StageReport)
+        rate_limit_share:   type float share of the named rate limits this process uses (see ratelimit.set_share),
+                                set by ShardedPool and ClusterPool for their workers
+
+        A task that would exceed one of the concurrency limits waits, the pool starts other tasks meanwhile. So does
+        a task whose task.rate_limits have no tokens left, without holding a slot until they are available.
+        """
         super(Pool, self).__init__()
         self.pool_size = pool_size
-        self.upcomming_tasks = deque()
+        self.deadline = deadline
+        self.concurrency_limits = concurrency_limits or {}
+        if any(limit < 1 for limit in self.concurrency_limits.values() if not callable(limit)):
+            raise ValueError("concurrency limits must be at least 1: {}".format(self.concurrency_limits))
+        # running tasks per (key, value) and the tasks that wait for a (key, value) to become available
+        self._key_usage = {}
+        self._held_keys = {}
+        self._blocked_tasks = {}
+        if scheduling == 'fifo':
+            self.upcomming_tasks = deque()
+        elif scheduling == 'priority':
+            self.upcomming_tasks = PriorityQueue()
+        else:
+            raise ValueError("unknown scheduling {}, use 'fifo' or 'priority'".format(scheduling))
         self.running_tasks = deque()
         self.finished_tasks = deque()
+        self.keep_finished = keep_finished
+        self.rate_limit_share = rate_limit_share
+        # tasks that were not started yet because of their rate limits, by the time their tokens are available
+        self.throttled_tasks = []
+        # started tasks that gave up their slot until their wakeup time (e.g. a delayed retry)
+        self.delayed_tasks = []
+        self.resumed_tasks = deque()
+        self._delay_counter = count()
+        # deadlines of the running tasks, they are only touched if a task (or its subtask) changes its deadline
+        self.timers = TimerWheel(resolution=timer_resolution, now=monotonic())
+        self._task_timers = {}
+        self.listeners = []
+        # the listeners with a tick method
+        self._tickers = []
         self.log = logging.getLogger("root.pool")
 
     def add_task(self, task):
         self.upcomming_tasks.append(task)
 
-    def consume_task(self):
-        task = self.upcomming_tasks.popleft()
+    def add_listener(self, listener):
+        """
+        Register an object that is notified with listener.task_started(pool, task) and
+        listener.task_finished(pool, task). If it has a method tick(pool, now), it is called in every round of the
+        loop too, e.g. to log the progress while no task finishes.
+        """
+        self.listeners.append(listener)
+        if hasattr(listener, 'tick'):
+            self._tickers.append(listener)
+
+    def tick_listeners(self, now):
+        for listener in self._tickers:
+            listener.tick(self, now)
+
+    def start_task(self, task):
+        task.started_at = monotonic()
         task.start()
         self.running_tasks.append(task)
+        for listener in self.listeners:
+            listener.task_started(self, task)
 
-    def run(self,):
-        while self.running_tasks or self.upcomming_tasks:
-            # self.log.debug("running: {}, upcomming {}".format(len(self.running_tasks), len(self.upcomming_tasks)))
-            while self.upcomming_tasks and len(self.running_tasks) < self.pool_size:
-                self.log.info("consume task")
-                self.consume_task()
-            still_running_tasks = deque()
-            while self.running_tasks:
-                task = self.running_tasks.popleft()
-                if task.poll() is None:
-                    # task is not finished yet
-                    # self.log.debug("task {} is not finished".format(task))
-                    still_running_tasks.append(task)
+    def finish_task(self, task):
+        self.unwatch_deadline(task)
+        self.release_keys(task)
+        task.finished_at = monotonic()
+        if getattr(task, 'started_at', None) is None:
+            # the task never got a slot
+            task.started_at = task.finished_at
+        self.add_finished(task)
+        for listener in self.listeners:
+            listener.task_finished(self, task)
+
+    def add_finished(self, task):
+        if self.keep_finished:
+            self.finished_tasks.append(task)
+
+    def get_concurrency_keys(self, task):
+        keys = getattr(task, 'concurrency_keys', None) or {}
+        return [(name, value) for name, value in keys.items() if name in self.concurrency_limits]
+
+    def get_limit(self, name):
+        limit = self.concurrency_limits[name]
+        return limit() if callable(limit) else limit
+
+    def get_blocking_key(self, task):
+        for key in self.get_concurrency_keys(task):
+            if self._key_usage.get(key, 0) >= self.get_limit(key[0]):
+                return key
+        return None
+
+    def acquire_keys(self, task):
+        keys = self.get_concurrency_keys(task)
+        if keys:
+            self._held_keys[id(task)] = keys
+        for key in keys:
+            self._key_usage[key] = self._key_usage.get(key, 0) + 1
+
+    def release_keys(self, task):
+        for key in self._held_keys.pop(id(task), ()):
+            self._key_usage[key] -= 1
+            self.wake_blocked_tasks(key)
+
+    def wake_blocked_tasks(self, key):
+        waiting_tasks = self._blocked_tasks.get(key)
+        if not waiting_tasks:
+            return
+        # wake up as many waiting tasks as the key has room for, unless another key blocks them
+        free = self.get_limit(key[0]) - self._key_usage.get(key, 0)
+        woken_tasks = []
+        while waiting_tasks and len(woken_tasks) < free:
+            waiting_task = waiting_tasks.popleft()
+            blocking_key = self.get_blocking_key(waiting_task)
+            if blocking_key is None:
+                woken_tasks.append(waiting_task)
+            else:
+                self._blocked_tasks.setdefault(blocking_key, deque()).append(waiting_task)
+        # the woken tasks go first
+        for waiting_task in reversed(woken_tasks):
+            self.upcomming_tasks.appendleft(waiting_task)
+        if not waiting_tasks:
+            self._blocked_tasks.pop(key, None)
+
+    def recheck_callable_limits(self):
+        """
+        A callable limit can grow without a task of its key finishing, e.g. after it dropped to 0 while no task of
+        the key was running. Wake up the tasks that wait for such a key if it has room again.
+        """
+        for key in list(self._blocked_tasks):
+            if callable(self.concurrency_limits.get(key[0])):
+                self.wake_blocked_tasks(key)
+
+    def next_eligible_task(self):
+        while self.upcomming_tasks:
+            task = self.upcomming_tasks.popleft()
+            if getattr(task, 'skipped', False):
+                return task
+            blocking_key = self.get_blocking_key(task)
+            if blocking_key is None:
+                return task
+            # skip it, the task is woken up as soon as a task with the same key finishes
+            self.log.debug("task {} waits for {}={}".format(task, *blocking_key))
+            self._blocked_tasks.setdefault(blocking_key, deque()).append(task)
+        return None
+
+    def consume_task(self):
+        if self.resumed_tasks:
+            # this task was started already, it just waited for its wakeup time
+            self.running_tasks.append(self.resumed_tasks.popleft())
+            return True
+        task = self.next_eligible_task()
+        if task is None:
+            return False
+        if getattr(task, 'skipped', False):
+            # nothing to run, e.g. it was done in a previous run
+            self.finish_task(task)
+            return True
+        wait = ratelimit.try_acquire_all(ratelimit.get_requests(getattr(task, 'rate_limits', None)))
+        if wait:
+            self.log.debug("task {} waits {:.2f}s for its rate limits".format(task, wait))
+            heappush(self.throttled_tasks, (monotonic() + wait, next(self._delay_counter), task))
+            return True
+        self.acquire_keys(task)
+        self.start_task(task)
+        return True
+
+    def delay_task(self, task):
+        self.log.info("task waits for {:.2f}s".format(task.wakeup_at - monotonic()))
+        heappush(self.delayed_tasks, (task.wakeup_at, next(self._delay_counter), task))
+
+    def resume_delayed_tasks(self):
+        now = monotonic()
+        while self.delayed_tasks and self.delayed_tasks[0][0] <= now:
+            _, _, task = heappop(self.delayed_tasks)
+            self.resumed_tasks.append(task)
+        throttled_tasks = []
+        while self.throttled_tasks and self.throttled_tasks[0][0] <= now:
+            throttled_tasks.append(heappop(self.throttled_tasks)[2])
+        # they try again before the other upcomming tasks
+        for task in reversed(throttled_tasks):
+            self.upcomming_tasks.appendleft(task)
+
+    def wait_for_delayed_tasks(self):
+        waiting = [tasks[0][0] for tasks in (self.delayed_tasks, self.throttled_tasks) if tasks]
+        if self._blocked_tasks:
+            # only a callable limit can wake them up now, it is checked again at the timer resolution
+            waiting.append(monotonic() + self.timers.resolution)
+        if waiting and not (self.running_tasks or self.resumed_tasks or self.upcomming_tasks):
+            wakeup_at = min(waiting)
+            if self.deadline is not None:
+                wakeup_at = min(wakeup_at, self.deadline)
+            sleep(max(0, wakeup_at - monotonic()))
+
+    def watch_deadline(self, task):
+        deadline = getattr(task, 'get_deadline', lambda: None)()
+        timer = self._task_timers.get(id(task))
+        if timer is not None:
+            if timer.deadline == deadline:
+                return
+            timer.cancel()
+            del self._task_timers[id(task)]
+        if deadline is not None:
+            self._task_timers[id(task)] = self.timers.schedule(deadline, task)
+
+    def unwatch_deadline(self, task):
+        timer = self._task_timers.pop(id(task), None)
+        if timer is not None:
+            timer.cancel()
+
+    def expire_tasks(self, now):
+        for task in self.timers.expired(now):
+            self._task_timers.pop(id(task), None)
+            deadline = task.get_deadline()
+            if deadline is not None and deadline <= now:
+                self.log.warning("task {} timed out".format(task))
+                task.expire()
+
+    def expire_all_tasks(self):
+        self.log.error("the pool ran out of time, abort all remaining tasks")
+        remaining_tasks = list(self.running_tasks) + list(self.resumed_tasks)
+        remaining_tasks += [task for _, _, task in self.delayed_tasks] + list(self.upcomming_tasks)
+        remaining_tasks += [task for _, _, task in self.throttled_tasks]
+        for waiting_tasks in self._blocked_tasks.values():
+            remaining_tasks += list(waiting_tasks)
+        self._blocked_tasks = {}
+        for task in remaining_tasks:
+            task.expire(final=True)
+            self.finish_task(task)
+        self.running_tasks.clear()
+        self.resumed_tasks.clear()
+        self.upcomming_tasks.clear()
+        self.delayed_tasks = []
+        self.throttled_tasks = []
+
+    def poll_running_tasks(self):
+        for _ in range(len(self.running_tasks)):
+            task = self.running_tasks.popleft()
+            if task.poll() is None:
+                # task is not finished yet
+                if getattr(task, 'wakeup_at', None) is not None and task.wakeup_at > monotonic():
+                    # free the slot while the task waits
+                    self.unwatch_deadline(task)
+                    self.delay_task(task)
                 else:
-                    self.log.info("task is finished :)")
-                    self.finished_tasks.append(task)
-            self.running_tasks = still_running_tasks
+                    self.watch_deadline(task)
+                    self.running_tasks.append(task)
+            else:
+                self.log.info("task is finished :)")
+                self.finish_task(task)
+
+    def run(self,):
+        previous_share = ratelimit.get_share()
+        if self.rate_limit_share != 1.0:
+            ratelimit.set_share(self.rate_limit_share)
+        try:
+            while (self.running_tasks or self.upcomming_tasks or self.delayed_tasks or self.resumed_tasks
+                   or self._blocked_tasks or self.throttled_tasks):
+                # self.log.debug("running: {}, upcomming {}".format(len(self.running_tasks), len(self.upcomming_tasks)))
+                now = monotonic()
+                if self.deadline is not None and now >= self.deadline:
+                    self.expire_all_tasks()
+                    break
+                self.expire_tasks(now)
+                self.resume_delayed_tasks()
+                self.recheck_callable_limits()
+                while (self.resumed_tasks or self.upcomming_tasks) and len(self.running_tasks) < self.pool_size:
+                    self.log.info("consume task")
+                    if not self.consume_task():
+                        # all upcomming tasks are waiting for a concurrency key
+                        break
+                self.poll_running_tasks()
+                self.tick_listeners(now)
+                self.wait_for_delayed_tasks()
+        except KeyboardInterrupt:
+            self.log.error("interrupted, kill the running tasks")
+            for task in self.running_tasks:
+                task.terminate()
+            raise
+        finally:
+            # the share belongs to this pool, e.g. the canary pool that runs next uses all of every limit
+            if self.rate_limit_share != 1.0:
+                ratelimit.set_share(previous_share)
 
     @property
     def results(self):
+        """
+        Whether each finished task was successful. The tasks are done, so they are not polled again.
+        """
         for task in self.finished_tasks:
-            if task._exception:
-                yield False
-            else:
-                task.get_result()
-                yield task.was_successful()
+            yield not task._exception and task.was_successful()
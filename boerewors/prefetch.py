@@ -0,0 +1,188 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+try:
+    from queue import Empty, Full, Queue
+except ImportError:
+    # python 2
+    from Queue import Empty, Full, Queue
+
+# marks the end of the jobs of a stage in the buffer
+_END = object()
+# seconds a blocked thread waits before it checks whether it was cancelled
+_CHECK_INTERVAL = 0.1
+
+
+class PrefetchedStage(object):
+
+    def __init__(self, stages, buffer_size, prepare=None):
+        """PrefetchedStage(stages, buffer_size, prepare=None)
+
+        stages:         type Iterator[Stage] the stages of the runner, the next one is taken from it
+        buffer_size:    type int number of jobs that are buffered at most
+        prepare:        type callable called with the stage before its jobs are built, e.g. to set its job_filter
+
+        Builds the next stage and its jobs in a background thread. The thread fills the buffer and waits while it
+        is full, the jobs are built on as the stage takes them.
+        """
+        self.stages = stages
+        self.prepare = prepare
+        self.stage = None
+        self.buffered = False
+        self._error = None
+        self._buffer = Queue(maxsize=max(1, buffer_size))
+        self._stage_built = threading.Event()
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="boerewors-prefetch")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def run(self):
+        try:
+            self.stage = next(self.stages)
+        except StopIteration:
+            pass
+        except Exception as e:
+            # raised where the executor takes the next stage, like without prefetching
+            self._error = e
+        self.buffered = self.stage is not None and getattr(self.stage, 'can_prefetch', False)
+        self._stage_built.set()
+        if not self.buffered:
+            return
+        try:
+            if self.prepare is not None:
+                self.prepare(self.stage)
+            for job in self.stage.jobs:
+                if not self.put(job):
+                    return
+        except Exception as e:
+            # raised where the executor takes the jobs
+            self._error = e
+        self.put(_END)
+
+    def put(self, item):
+        while not self._cancelled.is_set():
+            try:
+                self._buffer.put(item, timeout=_CHECK_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def get_stage(self):
+        """
+        Wait until the stage is built and return it, None if the runner has no more stages.
+        """
+        self._stage_built.wait()
+        if self.stage is None:
+            self.raise_error()
+            return None
+        return self.stage
+
+    @property
+    def jobs(self):
+        while True:
+            try:
+                job = self._buffer.get(timeout=_CHECK_INTERVAL)
+            except Empty:
+                if not self._thread.is_alive() and self._buffer.empty():
+                    # cancelled, nothing will come
+                    return
+                continue
+            if job is _END:
+                self.raise_error()
+                return
+            yield job
+
+    def cancel(self):
+        self._cancelled.set()
+
+
+class StagePrefetcher(object):
+
+    def __init__(self, stages, buffer_size=1000, prepare=None):
+        """StagePrefetcher(stages, buffer_size=1000, prepare=None)
+
+        stages:         type Iterable[Stage] the stages of the runner, e.g. runner.stages
+        buffer_size:    type int jobs of the next stage that are buffered at most while the current one runs
+        prepare:        type callable called with every stage before its jobs are built
+
+        Iterates the stages like runner.stages, but builds the next stage and buffers its first jobs in a
+        background thread while the current stage runs, so the next stage can start right away. get_jobs(stage)
+        returns the jobs of a stage, the buffered ones first.
+
+        get_stages of the runner runs before the previous stage is done, it must not depend on its outcome. The
+        jobs are only built ahead for stages that set can_prefetch = True, their get_jobs runs before setup and
+        before the previous stage is done. Of the other stages only the stage itself is built ahead.
+        """
+        self.stages = stages
+        self.buffer_size = buffer_size
+        self.prepare = prepare
+        self._prefetched = {}
+        self._pending = None
+
+    def __iter__(self):
+        stages = iter(self.stages)
+        while True:
+            if self._pending is None:
+                try:
+                    stage = next(stages)
+                except StopIteration:
+                    return
+            else:
+                pending, self._pending = self._pending, None
+                stage = pending.get_stage()
+                if stage is None:
+                    return
+                if pending.buffered:
+                    self._prefetched[id(stage)] = pending
+            self._pending = PrefetchedStage(stages, self.buffer_size, self.prepare).start()
+            yield stage
+
+    def get_jobs(self, stage):
+        """
+        Return the jobs of the stage, the prefetched ones if the stage was built ahead.
+        """
+        prefetched = self._prefetched.get(id(stage))
+        if prefetched is None:
+            if self.prepare is not None:
+                self.prepare(stage)
+            return stage.jobs
+        return prefetched.jobs
+
+    def finish_stage(self, stage):
+        """
+        Stop building the jobs of the stage, e.g. when --limit took only some of them.
+        """
+        prefetched = self._prefetched.pop(id(stage), None)
+        if prefetched is not None:
+            prefetched.cancel()
+
+    def close(self):
+        for prefetched in self._prefetched.values():
+            prefetched.cancel()
+        self._prefetched.clear()
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
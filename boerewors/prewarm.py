@@ -0,0 +1,214 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from select import select
+
+from .helper import LoggableObject, monotonic
+from .jobs import Job, PopenJob, SSHJob
+
+
+def run_processes(jobs, pool_size, timeout, interval=0.05):
+    """
+    Run the PopenJobs, at most pool_size at the same time, and kill the ones that still run after timeout seconds.
+    Return the jobs that did not finish, the ones that were not started yet too.
+
+    The processes only wait for the network, unlike a Pool the loop sleeps between two polls. It does not take
+    the cpu from the pool of the stage that runs at the same time.
+    """
+    deadline = monotonic() + timeout
+    upcoming = deque(jobs)
+    running = []
+    while upcoming or running:
+        while upcoming and len(running) < pool_size:
+            job = upcoming.popleft()
+            job.start()
+            running.append(job)
+        running = [job for job in running if job.poll() is None]
+        if monotonic() >= deadline:
+            break
+        if running:
+            select([], [], [], interval)
+    for job in running:
+        job.expire(final=True)
+        job.proc.wait()
+    return running + list(upcoming)
+
+
+class PrewarmJob(SSHJob):
+
+    def __init__(self, host, user=None, timeout=None):
+        """PrewarmJob(host, user=None, timeout=None)
+
+        Runs `true` on the host. This resolves its name, checks that it is reachable and, with a control_dir (see
+        set_ssh_control), leaves a master connection open that the jobs of the host reuse.
+        """
+        super(PrewarmJob, self).__init__(host, "true", user=user, timeout=timeout)
+
+    def start(self):
+        # one line per host would drown the log of the canary
+        PopenJob.start(self)
+
+
+class Prewarmer(LoggableObject):
+
+    job_class = PrewarmJob
+
+    def __init__(self, jobs, pool_size=50, timeout=30, ssh_control=None):
+        """Prewarmer(jobs, pool_size=50, timeout=30, ssh_control=None)
+
+        jobs:           type List[Job] the upcoming jobs, the hosts of the jobs with a host are warmed up
+        pool_size:      type int number of connections that are opened at the same time
+        timeout:        type float seconds the warm up may take at most
+        ssh_control:    type tuple (control_dir, control_persist) of the connections, see ControlDirectory
+
+        Opens the ssh connections to the hosts of the upcoming jobs in a background thread, e.g. while the
+        canary runs. Hosts are warmed up once per user, in the order of their jobs.
+        """
+        super(Prewarmer, self).__init__()
+        self.targets = []
+        seen = set()
+        for job in jobs:
+            host = getattr(job, 'host', None)
+            if getattr(job, 'skipped', False):
+                continue
+            target = (host, getattr(job, 'user', None))
+            if host is not None and target not in seen:
+                seen.add(target)
+                self.targets.append(target)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.ssh_control = ssh_control
+        self.jobs = []
+        self._thread = None
+
+    def run(self):
+        try:
+            run_processes(self.jobs, self.pool_size, self.timeout)
+        except Exception:
+            # warming up is optional, the jobs will connect on their own
+            self.log.exception("warm up failed")
+
+    def start(self):
+        if not self.targets:
+            return
+        self.log.notice("warm up the connections to {} hosts".format(len(self.targets)))
+        self.jobs = [self.job_class(host, user=user) for host, user in self.targets]
+        if self.ssh_control is not None:
+            for job in self.jobs:
+                job.set_ssh_control(self.ssh_control)
+        self._thread = threading.Thread(target=self.run, name="boerewors-prewarm")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        """
+        Wait until the warm up is done and return the hosts that were not reachable.
+        """
+        if self._thread is None:
+            return []
+        self._thread.join(timeout)
+        unreachable = [job.host for job in self.jobs if job.proc is not None and not job.was_successful()]
+        if unreachable:
+            self.log.warning("{} hosts were not reachable during the warm up: {}".format(
+                len(unreachable), ", ".join(unreachable[:10])))
+        return unreachable
+
+
+class ControlDirectory(LoggableObject):
+    """
+    Temporary directory for the sockets of multiplexed ssh connections, unless SSHJob.control_dir is configured
+    already. It is a pool listener (see Pool.add_listener), the jobs it sees and their subtasks use it as their
+    ssh_control (see Job.set_ssh_control). Other jobs and SSHJob keep their own settings.
+
+    The master connections stay open until the directory is closed, a warmed up host may wait longer than any
+    ControlPersist timeout for its job (e.g. during a long canary). Close stops the master connections of the
+    hosts of the jobs with ssh -O exit.
+    """
+
+    # seconds the ssh -O exit commands may take together
+    exit_timeout = 10
+    # number of ssh -O exit commands that run at the same time
+    exit_concurrency = 50
+
+    def __init__(self):
+        super(ControlDirectory, self).__init__()
+        self.path = None
+        self.targets = []
+        self._seen = set()
+        self.ssh_control = None
+
+    def open(self):
+        if SSHJob.control_dir is None:
+            # short path, unix sockets are limited to about 100 characters
+            self.path = tempfile.mkdtemp(prefix="bw-ssh-")
+            self.ssh_control = (self.path, "yes")
+        return self
+
+    def add_job(self, job):
+        if self.path is None:
+            return
+        if isinstance(job, Job) and job.ssh_control is None:
+            job.set_ssh_control(self.ssh_control)
+        host = getattr(job, 'host', None)
+        target = (host, getattr(job, 'user', None) or SSHJob.user)
+        if host is not None and target not in self._seen:
+            self._seen.add(target)
+            self.targets.append(target)
+
+    def task_started(self, pool, task):
+        pass
+
+    def task_finished(self, pool, task):
+        pass
+
+    def finish(self, errors):
+        pass
+
+    def exit_command(self, host, user):
+        return ['/usr/bin/ssh', '-o', 'ControlPath={}'.format(os.path.join(self.path, '%C')), '-O', 'exit',
+                "{}@{}".format(user, host)]
+
+    def exit_masters(self):
+        # only the hosts that were connected have a socket, ssh fails quickly for the others
+        with open(os.devnull, 'w') as devnull:
+            jobs = []
+            for host, user in self.targets:
+                job = PopenJob(self.exit_command(host, user), stdout=devnull, stderr=devnull)
+                job.target = (host, user)
+                jobs.append(job)
+            for job in run_processes(jobs, self.exit_concurrency, self.exit_timeout):
+                self.log.warning("the master connection to {1}@{0} did not exit".format(*job.target))
+
+    def close(self):
+        if self.path is not None:
+            try:
+                self.exit_masters()
+            finally:
+                shutil.rmtree(self.path, ignore_errors=True)
+                self.path = None
+                self.ssh_control = None
+                self.targets = []
+                self._seen = set()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
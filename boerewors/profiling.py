@@ -0,0 +1,258 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import logging
+import threading
+import time
+from functools import wraps
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+from .helper import monotonic
+from .jobs import PopenJob
+
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    cpu_time = time.clock
+
+# share of the run the controller has to be busy to be the bottleneck
+BUSY_THRESHOLD = 0.5
+
+
+class Component(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.cpu = 0.0
+        self.wall = 0.0
+
+    def as_dict(self):
+        return dict(calls=self.calls, cpu=round(self.cpu, 6), wall=round(self.wall, 6))
+
+
+class Profiler(object):
+
+    def __init__(self, trace_memory=True, top=10):
+        """Profiler(trace_memory=True, top=10)
+
+        trace_memory:   type bool take tracemalloc snapshots at the start and the end of every stage (python 3)
+        top:            type int number of source lines with the biggest memory growth per stage in the report
+
+        Measures where the controller spends its time while it is started: starting tasks, polling them, reading
+        their pipes, logging and the rest of the pool loop (scheduler). The times of a component include the
+        logging it does. Every round of polls counts as busy if a task finished or a pipe had output, otherwise
+        as idle. A controller that is busy most of the time is the bottleneck, one that is mostly idle waits for
+        the fleet. tracemalloc makes allocations a lot slower, the times are for comparing the components, not
+        for comparing runs.
+
+        Only the pools passed to instrument are measured, the profiler is also their listener (see
+        Pool.add_listener). Pipes and logging are measured in the thread that started the profiler, not in
+        background threads (e.g. the Prewarmer). Of a ShardedPool or a ClusterPool only the time of its loop and
+        the finished tasks are measured, not the workers (other processes or hosts).
+        """
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.top = top
+        self.components = dict((name, Component()) for name in ('start', 'poll', 'pipes', 'logging', 'pool'))
+        self.counters = dict(poll_rounds=0, busy_rounds=0, task_polls=0, finished_tasks=0, pipe_reads=0,
+                             pipe_reads_with_output=0)
+        self.busy_wall = 0.0
+        self.stages = []
+        self._patches = []
+        self._thread = None
+        self._stage = None
+        self._started_at = None
+        self._started_cpu = None
+        self._own_tracing = False
+        self.wall = None
+        self.cpu = None
+
+    def start(self):
+        self._started_at = monotonic()
+        self._started_cpu = cpu_time()
+        self._thread = threading.current_thread()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._own_tracing = True
+        self.install()
+        return self
+
+    def stop(self):
+        self.uninstall()
+        self.wall = monotonic() - self._started_at
+        self.cpu = cpu_time() - self._started_cpu
+        if self._own_tracing:
+            tracemalloc.stop()
+            self._own_tracing = False
+
+    def patch(self, owner, name, wrapper):
+        original = owner.__dict__[name]
+        self._patches.append((owner, name, original))
+        setattr(owner, name, wraps(original)(wrapper(original)))
+
+    def timed(self, component, original):
+        stats = self.components[component]
+
+        def wrapper(*args, **kwargs):
+            started_at, started_cpu = monotonic(), cpu_time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                stats.calls += 1
+                stats.wall += monotonic() - started_at
+                stats.cpu += cpu_time() - started_cpu
+        return wrapper
+
+    def in_own_thread(self, original, measured):
+        # the classes are shared with background threads, their time is not work of the controller
+        def wrapper(*args, **kwargs):
+            if threading.current_thread() is self._thread:
+                return measured(*args, **kwargs)
+            return original(*args, **kwargs)
+        return wrapper
+
+    def install(self):
+        profiler = self
+
+        def consume_pipes(original):
+            timed_original = self.timed('pipes', original)
+
+            def wrapper(job):
+                output = (len(job._stdout or ""), len(job._stderr or ""))
+                result = timed_original(job)
+                profiler.counters['pipe_reads'] += 1
+                if (len(job._stdout or ""), len(job._stderr or "")) != output:
+                    profiler.counters['pipe_reads_with_output'] += 1
+                return result
+            return self.in_own_thread(original, wrapper)
+
+        self.patch(PopenJob, 'consume_pipes_non_blocking', consume_pipes)
+        self.patch(logging.Handler, 'handle',
+                   lambda original: self.in_own_thread(original, self.timed('logging', original)))
+
+    def instrument(self, pool):
+        """
+        Measure the pool (Pool, ShardedPool or ClusterPool) while it runs, call it before pool.run().
+        """
+        profiler = self
+        poll_original = self.timed('poll', pool.poll_running_tasks)
+        start_original = self.timed('start', pool.start_task)
+
+        def poll_running_tasks():
+            progress = profiler.progress()
+            profiler.counters['poll_rounds'] += 1
+            profiler.counters['task_polls'] += len(pool.running_tasks)
+            started_at = monotonic()
+            result = poll_original()
+            if profiler.progress() != progress:
+                profiler.counters['busy_rounds'] += 1
+                profiler.busy_wall += monotonic() - started_at
+            return result
+
+        def start_task(task):
+            started_at = monotonic()
+            try:
+                return start_original(task)
+            finally:
+                # starting a task (e.g. forking ssh) is work of the controller
+                profiler.busy_wall += monotonic() - started_at
+
+        # attributes of the instance, the methods of the classes stay untouched
+        pool.run = self.timed('pool', pool.run)
+        pool.poll_running_tasks = poll_running_tasks
+        pool.start_task = start_task
+        pool.add_listener(self)
+        return pool
+
+    def task_started(self, pool, task):
+        pass
+
+    def task_finished(self, pool, task):
+        self.counters['finished_tasks'] += 1
+
+    def uninstall(self):
+        while self._patches:
+            owner, name, original = self._patches.pop()
+            setattr(owner, name, original)
+
+    def progress(self):
+        return self.counters['finished_tasks'], self.counters['pipe_reads_with_output']
+
+    def begin_stage(self, stage):
+        self._stage = dict(stage=stage._logging_info, started_at=monotonic(), started_cpu=cpu_time(),
+                           snapshot=self.take_snapshot())
+
+    def end_stage(self):
+        if self._stage is None:
+            return
+        stage, self._stage = self._stage, None
+        record = dict(stage=stage['stage'], wall=round(monotonic() - stage['started_at'], 6),
+                      cpu=round(cpu_time() - stage['started_cpu'], 6))
+        if stage['snapshot'] is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            growth = self.take_snapshot().compare_to(stage['snapshot'], 'lineno')
+            record['memory'] = dict(current=current, peak=peak, top=[
+                dict(where=str(stat.traceback), size_diff=stat.size_diff, count_diff=stat.count_diff)
+                for stat in growth[:self.top]])
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        self.stages.append(record)
+
+    def take_snapshot(self):
+        if not self.trace_memory:
+            return None
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+
+    def get_report(self):
+        pool = self.components['pool']
+        components = dict((name, stats.as_dict()) for name, stats in self.components.items() if name != 'pool')
+        # the rest of the pool loop: choosing, parking and expiring tasks, the timers and the listeners
+        components['scheduler'] = dict(
+            calls=pool.calls,
+            cpu=round(max(0, pool.cpu - self.components['start'].cpu - self.components['poll'].cpu), 6),
+            wall=round(max(0, pool.wall - self.components['start'].wall - self.components['poll'].wall), 6))
+        busy_share = self.busy_wall / pool.wall if pool.wall else 0.0
+        return dict(
+            wall=round(self.wall, 6),
+            cpu=round(self.cpu, 6),
+            pools_wall=round(pool.wall, 6),
+            components=components,
+            counters=dict(self.counters),
+            busy_share=round(busy_share, 4),
+            bottleneck="controller" if busy_share > BUSY_THRESHOLD else "fleet",
+            stages=self.stages,
+        )
+
+    def write(self, path):
+        with io.open(path, "w", encoding="utf-8") as report_file:
+            report_file.write(u"{}\n".format(json.dumps(self.get_report(), indent=2, sort_keys=True)))
+
+    def summary(self):
+        report = self.get_report()
+        components = report['components']
+        return ("the {} is the bottleneck: the controller was busy {:.0%} of {:.1f}s in pools, cpu: start {:.2f}s, "
+                "poll {:.2f}s (pipes {:.2f}s), logging {:.2f}s, scheduler {:.2f}s, {} polls for {} finished "
+                "tasks".format(report['bottleneck'], report['busy_share'], report['pools_wall'],
+                               components['start']['cpu'], components['poll']['cpu'], components['pipes']['cpu'],
+                               components['logging']['cpu'], components['scheduler']['cpu'],
+                               report['counters']['task_polls'], report['counters']['finished_tasks']))
@@ -0,0 +1,160 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from time import sleep
+
+from .helper import monotonic
+from .jobs import Job
+from .result import Ok
+
+
+# one lock for all buckets, so a task takes the tokens of all of its limits or none (e.g. from a Prewarmer thread)
+_lock = threading.Lock()
+# the named limits of this process, see register
+limiters = {}
+_share = 1.0
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity=None):
+        """TokenBucket(rate, capacity=None)
+
+        rate:       type float tokens per second, e.g. new ssh connections or bytes
+        capacity:   type float tokens that can be taken at once after an idle time (default: rate, one second)
+
+        A request for more tokens than the capacity is granted when the bucket is full, the bucket goes into debt
+        then, e.g. to download one artifact that is bigger than the bytes per second.
+        """
+        if rate <= 0:
+            raise ValueError("the rate must be positive: {}".format(rate))
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.share = 1.0
+        self.tokens = self.capacity
+        self.updated = monotonic()
+
+    def refill(self, now):
+        capacity = self.capacity * self.share
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate * self.share)
+        self.updated = now
+
+    def get_wait_time(self, amount, now):
+        self.refill(now)
+        needed = min(amount, self.capacity * self.share)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / (self.rate * self.share)
+
+    def try_acquire(self, amount=1):
+        """
+        Take the tokens and return 0, or return the seconds until they are available.
+        """
+        return try_acquire_all([(self, amount)])
+
+    def acquire(self, amount=1):
+        """
+        Wait until the tokens are available and take them.
+        """
+        wait = self.try_acquire(amount)
+        while wait:
+            sleep(wait)
+            wait = self.try_acquire(amount)
+
+
+def try_acquire_all(requests):
+    """
+    Take the tokens of all (bucket, amount) requests and return 0, or take none and return the seconds until all of
+    them could be available.
+    """
+    if not requests:
+        return 0
+    with _lock:
+        now = monotonic()
+        wait = max(bucket.get_wait_time(amount, now) for bucket, amount in requests)
+        if wait > 0:
+            return wait
+        for bucket, amount in requests:
+            bucket.tokens -= amount
+        return 0
+
+
+def register(name, rate, capacity=None):
+    """
+    Create the named limit, e.g. register('bastion', 20) for 20 new ssh connections per second through the bastion
+    or register('origin', 200 * 1024 ** 2) for 200 MB/s from the artifact origin. Jobs refer to it by its name.
+    """
+    bucket = TokenBucket(rate, capacity)
+    bucket.share = _share
+    limiters[name] = bucket
+    return bucket
+
+
+def get_limiter(name):
+    try:
+        return limiters[name]
+    except KeyError:
+        raise KeyError("no rate limit {!r} is registered, see ratelimit.register".format(name))
+
+
+def get_share():
+    return _share
+
+
+def set_share(share):
+    """
+    Use only a share of every named limit in this process, e.g. 1/4 in each of 4 worker processes, so all of them
+    together stay within the limit.
+    """
+    global _share
+    _share = share
+    for bucket in limiters.values():
+        bucket.share = share
+
+
+def get_requests(limits):
+    """
+    Return the (bucket, amount) requests of a dict {name: amount}, e.g. task.rate_limits.
+    """
+    return [(get_limiter(name), amount) for name, amount in (limits or {}).items()]
+
+
+class RateLimit(Job):
+
+    def __init__(self, limits):
+        """RateLimit(limits)
+
+        limits:     type dict tokens to take per named limit, e.g. {'origin': size_of_the_artifact}
+
+        A subtask that is finished when it took the tokens, e.g. in run_job before a download:
+
+            yield RateLimit({'origin': artifact.size})
+            yield self.download(artifact)
+
+        While it waits the pool parks its job until the tokens are available, the job does not hold a slot.
+        """
+        super(RateLimit, self).__init__()
+        self.limits = limits
+
+    def poll(self):
+        if self._result is not None or self._exception is not None:
+            return True
+        wait = try_acquire_all(get_requests(self.limits))
+        if wait:
+            self.wakeup_at = monotonic() + wait
+            return None
+        self.wakeup_at = None
+        self._result = Ok()
+        return True
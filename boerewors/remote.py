@@ -0,0 +1,361 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import atexit
+import base64
+import errno
+import fcntl
+import inspect
+import os
+import sys
+from select import select
+from subprocess import Popen, PIPE, CalledProcessError
+
+from . import agent
+from .errors import JobTimeout
+from .helper import LoggableObject, monotonic
+from .jobs import Job, SSHJob, cmd_quote, ssh_options
+
+
+def bootstrap_command(python):
+    """
+    Return the command that starts the agent: python reads the source of the agent from stdin and runs it,
+    everything after the source are frames.
+    """
+    source = inspect.getsource(agent).encode('utf8')
+    code = "import sys;s=getattr(sys.stdin,'buffer',sys.stdin);exec(s.read({}))".format(len(source))
+    return [python, '-c', code], source
+
+
+# closed connections whose agents did not exit yet, see reap_agents
+_closing = []
+
+
+def reap_agents(timeout=0):
+    """
+    Finish the closed connections whose agent exited and kill the agents that are past their exit_timeout. With a
+    timeout wait up to that many seconds for the others, e.g. at the end of the program. Return the number of
+    agents that are still running.
+    """
+    deadline = monotonic() + timeout
+    while True:
+        _closing[:] = [connection for connection in _closing if not connection.poll_exit()]
+        if not _closing or monotonic() >= deadline:
+            return len(_closing)
+        select([], [], [], 0.01)
+
+
+class AgentConnection(LoggableObject):
+
+    user = SSHJob.user
+    python = "python3"
+    # seconds a closed agent gets to exit before it is killed
+    exit_timeout = 5
+    # (control_dir, control_persist) of the ssh connection, None uses the class attributes of SSHJob
+    ssh_control = None
+
+    def __init__(self, host, user=None, options=None, python=None):
+        """AgentConnection(host, user=None, options=None, python=None)
+
+        host:       type str ip or hostname, None runs the agent locally (e.g. for tests)
+        user:       type str user name that connects to the server
+        options:    type List[str] ssh options, see SSHJob
+        python:     type str python interpreter on the host (default: python3)
+
+        Starts boerewors.agent on the host over one ssh session when the first request is sent. The requests are
+        subtasks, e.g.
+
+            with AgentConnection(self.host) as connection:
+                yield connection.run("systemctl restart app")
+                yield connection.write_file("/etc/app.conf", config)
+        """
+        super(AgentConnection, self).__init__()
+        self.host = host
+        self.user = self.__class__.user if user is None else user
+        self.options = options
+        self.python = self.__class__.python if python is None else python
+        self.proc = None
+        self.responses = {}
+        self._reader = agent.FrameReader()
+        # frames that are not written yet, the agent may not read while its responses are not read
+        self._outgoing = bytearray()
+        self._next_id = 0
+        self._error = None
+        self._exit_deadline = None
+
+    def get_command(self):
+        command, source = bootstrap_command(self.python if self.host is not None else sys.executable)
+        if self.host is None:
+            return command, source
+        ssh_command = ['/usr/bin/ssh']
+        control_dir, control_persist = self.ssh_control or (SSHJob.control_dir, SSHJob.control_persist)
+        for option in ssh_options(self.options, control_dir, control_persist):
+            ssh_command += ['-o', option]
+        ssh_command.append("{}@{}".format(self.user, self.host))
+        # the remote shell gets the command as one string
+        ssh_command.append(" ".join(cmd_quote(part) for part in command))
+        return ssh_command, source
+
+    def start(self):
+        command, source = self.get_command()
+        self.log.debug("start agent {}".format(command))
+        self.proc = Popen(command, stdin=PIPE, stdout=PIPE)
+        fileno = self.proc.stdin.fileno()
+        fcntl.fcntl(fileno, fcntl.F_SETFL, fcntl.fcntl(fileno, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._outgoing += source
+
+    def send(self, op, **params):
+        """
+        Queue a request and return its id, the response shows up in responses.
+        """
+        if self.proc is None:
+            self.start()
+        self._next_id += 1
+        params.update(id=self._next_id, op=op)
+        self._outgoing += agent.encode_frame(params)
+        self.pump()
+        return self._next_id
+
+    def flush(self):
+        """
+        Write as much of the queued frames as the agent takes, without blocking.
+        """
+        fileno = self.proc.stdin.fileno()
+        while self._outgoing and select([], [fileno], [], 0)[1]:
+            try:
+                written = os.write(fileno, self._outgoing)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.fail("agent is gone: {}".format(e))
+                return
+            del self._outgoing[:written]
+
+    def pump(self):
+        """
+        Write the queued requests and read the responses that arrived, without blocking.
+        """
+        if self.proc is None or self._error is not None:
+            return
+        self.flush()
+        if self._error is None and not self.read_responses():
+            self.fail("agent exited with {}".format(self.proc.wait()))
+
+    def read_responses(self):
+        """
+        Read the responses that arrived, without blocking. Return False at the end of the stream.
+        """
+        fileno = self.proc.stdout.fileno()
+        while select([fileno], [], [], 0)[0]:
+            data = os.read(fileno, 65536)
+            if not data:
+                return False
+            for response in self._reader.feed(data):
+                self.responses[response['id']] = response
+        return True
+
+    def fail(self, error):
+        self._error = error
+        self.log.error(error)
+
+    def pop_response(self, request_id):
+        """
+        Return the response of a request, None if it is not there yet.
+        """
+        reap_agents()
+        self.pump()
+        if request_id in self.responses:
+            return self.responses.pop(request_id)
+        if self._error is not None:
+            return dict(id=request_id, error=self._error)
+        return None
+
+    def run(self, command, timeout=None, cwd=None):
+        return AgentCommand(self, command, timeout=timeout, cwd=cwd)
+
+    def write_file(self, path, data, mode=None):
+        return AgentWriteFile(self, path, data, mode=mode)
+
+    def read_file(self, path):
+        return AgentReadFile(self, path)
+
+    def close(self):
+        """
+        Ask the agent to exit without waiting for it, the pool loop must not block. The process is reaped by a
+        later request of any connection or at the end of the program (see reap_agents), and killed if it did not
+        exit within exit_timeout seconds.
+        """
+        if self.proc is None or self._exit_deadline is not None:
+            return
+        if self._error is None:
+            # the agent exits once it read all the requests
+            self._outgoing += agent.encode_frame(dict(op='exit'))
+        self._exit_deadline = monotonic() + self.exit_timeout
+        _closing.append(self)
+        reap_agents()
+
+    def poll_exit(self):
+        """
+        Finish a closed connection without blocking, return True once the agent is gone.
+        """
+        if self._error is None and self._outgoing:
+            self.flush()
+        if (not self._outgoing or self._error is not None) and not self.proc.stdin.closed:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+        # nobody waits for the responses anymore, but the agent must not block on a full pipe
+        self.read_responses()
+        self.responses = {}
+        if self.proc.poll() is None:
+            if monotonic() < self._exit_deadline:
+                return False
+            self.log.warning("agent did not exit within {}s, kill it".format(self.exit_timeout))
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+        self.proc = None
+        self._outgoing = bytearray()
+        self._exit_deadline = None
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# the agents that are still exiting get exit_timeout seconds at the end of the program
+atexit.register(reap_agents, AgentConnection.exit_timeout)
+
+
+class AgentRequest(Job):
+
+    op = None
+
+    def __init__(self, connection, timeout=None, **params):
+        """AgentRequest(connection, timeout=None, **params)
+
+        A request to the agent of a connection, the subtask is finished when the response arrived.
+        """
+        super(AgentRequest, self).__init__()
+        self.connection = connection
+        self.params = params
+        self.timeout = timeout
+        self.request_id = None
+        self.response = None
+
+    def start(self):
+        self.request_id = self.connection.send(self.op, **self.params)
+        self.deadline = monotonic() + self.timeout if self.timeout else None
+
+    def poll(self):
+        if self.request_id is None:
+            self.start()
+            return None
+        if self.response is None:
+            self.response = self.connection.pop_response(self.request_id)
+            if self.response is None:
+                return None
+            self._result = self.get_value(self.response)
+        return True
+
+    def get_value(self, response):
+        return response
+
+    def get_result(self, result_type=None, can_fail=False):
+        while self.poll() is None:
+            select([], [], [], 0.001)
+        if self._exception:
+            raise self._exception
+        if not can_fail and not self.was_successful():
+            raise CalledProcessError(self.response.get('returncode'), cmd=[self.op, self.params],
+                                     output=self.response.get('error') or self.response.get('stdout'))
+        if result_type is not None:
+            return self.response.get(result_type)
+        return self._result
+
+    def set_ssh_control(self, ssh_control):
+        super(AgentRequest, self).set_ssh_control(ssh_control)
+        # the first request starts the connection
+        if self.connection.proc is None and self.connection.ssh_control is None:
+            self.connection.ssh_control = ssh_control
+
+    def get_deadline(self):
+        if self.request_id is None or self.response is not None:
+            return None
+        return self.deadline
+
+    def expire(self, final=False):
+        # the agent enforces the timeout of commands, a lost response only stops the waiting
+        self._exception = JobTimeout("no response from the agent after {}s: {}".format(self.timeout, self.op))
+        self.response = dict(id=self.request_id, error=str(self._exception))
+
+    def cancel(self, reason="cancelled"):
+        super(AgentRequest, self).cancel(reason)
+        # the agent still runs the request, its response is not waited for
+        self.response = dict(id=self.request_id, error=str(self._exception))
+
+    def was_successful(self):
+        if self.skipped:
+            return True
+        return self.response is not None and not self._exception and 'error' not in self.response
+
+
+class AgentCommand(AgentRequest):
+
+    op = 'run'
+    # seconds the response may take longer than the timeout of the command, the agent kills the command itself
+    grace = 10
+
+    def __init__(self, connection, command, timeout=None, cwd=None):
+        """AgentCommand(connection, command, timeout=None, cwd=None)
+
+        runs the bash command on the host of the connection, get_result('stdout') returns the output (stdout
+        and stderr), get_result('returncode') the exit status
+        """
+        super(AgentCommand, self).__init__(connection, timeout=timeout + self.grace if timeout else None,
+                                           command=command, cwd=cwd)
+        self.params['timeout'] = timeout
+
+    def get_value(self, response):
+        return response.get('returncode')
+
+    def was_successful(self):
+        return super(AgentCommand, self).was_successful() and (self.skipped or self.response['returncode'] == 0)
+
+
+class AgentWriteFile(AgentRequest):
+
+    op = 'write'
+
+    def __init__(self, connection, path, data, mode=None):
+        if not isinstance(data, bytes):
+            data = data.encode('utf8')
+        super(AgentWriteFile, self).__init__(connection, path=path, mode=mode,
+                                             data=base64.b64encode(data).decode('ascii'))
+
+
+class AgentReadFile(AgentRequest):
+
+    op = 'read'
+
+    def __init__(self, connection, path):
+        super(AgentReadFile, self).__init__(connection, path=path)
+
+    def get_value(self, response):
+        return base64.b64decode(response['data']) if 'data' in response else None
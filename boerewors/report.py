@@ -0,0 +1,125 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import logging
+import time
+
+from .helper import to_json
+from .journal import job_key, job_status
+from .result import Result
+
+
+def job_record(stage, job):
+    """
+    Return the outcome of a finished job as a json serializable dict. The job is not polled again.
+    """
+    if getattr(job, 'skipped', False):
+        status = "skipped"
+    elif job._exception:
+        status = "timeout" if job.timed_out() else "error"
+    else:
+        status = job_status(job)
+    result = job._result.value if isinstance(job._result, Result) else job._result
+    started_at = getattr(job, 'started_at', None)
+    finished_at = getattr(job, 'finished_at', None)
+    record = dict(
+        type="job",
+        time=round(time.time(), 3),
+        stage=stage._logging_info,
+        job=job_key(job),
+        host=getattr(job, 'host', None),
+        status=status,
+        duration=round(finished_at - started_at, 3) if None not in (started_at, finished_at) else None,
+        result=to_json(result),
+    )
+    if job._exception:
+        record['error'] = str(job._exception)
+    elif status not in ("ok", "skipped"):
+        record['error'] = str(result)
+    return record
+
+
+class StageReport(object):
+
+    def __init__(self, stage, callbacks=None):
+        """StageReport(stage, callbacks=None)
+
+        stage:      the running stage
+        callbacks:  type List[callable] every one is called with the record of each finished job (see job_record)
+                        and with the record of the stage when it is done
+
+        A pool listener that counts and logs the failed jobs of a stage while it runs. It keeps no reference to
+        the jobs, see Stage.keep_jobs.
+        """
+        self.stage = stage
+        self.callbacks = list(callbacks or [])
+        self.finished = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.log = logging.getLogger("root.report")
+
+    def add_job(self, job):
+        return job
+
+    def task_started(self, pool, task):
+        pass
+
+    def task_finished(self, pool, task):
+        record = job_record(self.stage, task)
+        self.finished += 1
+        self.stage.count_job(task)
+        if record['status'] in ("error", "timeout"):
+            self.failed += 1
+            if record['status'] == "timeout":
+                self.timed_out += 1
+            self.log.error("Job {} {}: {}".format(
+                task, "timed out" if record['status'] == "timeout" else "failed", record.get('error')))
+        self.emit(record)
+
+    def finish(self, errors):
+        self.emit(dict(type="stage", time=round(time.time(), 3), stage=self.stage._logging_info,
+                       status="error" if errors else "ok", finished_jobs=self.finished,
+                       failed_jobs=self.failed, timed_out_jobs=self.timed_out))
+
+    def emit(self, record):
+        for callback in self.callbacks:
+            try:
+                callback(record)
+            except Exception as e:
+                # the run goes on, a broken consumer of the report must not stop a deployment
+                self.log.warning("report callback {} failed: {}".format(callback, e))
+
+
+class ReportWriter(object):
+
+    def __init__(self, path):
+        """ReportWriter(path)
+
+        path:   type str file the records are written to, one json object per line (JSON Lines)
+
+        Every record is flushed right away, so other tools can follow the report while the run goes on.
+        """
+        self.path = path
+        self._file = io.open(path, "w", encoding="utf-8")
+
+    def __call__(self, record):
+        self._file.write(u"{}\n".format(json.dumps(record, sort_keys=True)))
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
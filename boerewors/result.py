@@ -77,3 +77,9 @@ class Err(Result):
         super(Err, self).__init__(force=True)
         self._val = value
         self._type = 'error'
+
+
+class Timeout(Err):
+
+    def __init__(self, value=True):
+        super(Timeout, self).__init__(value)
@@ -0,0 +1,50 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+
+class RetryPolicy(object):
+
+    def __init__(self, delay=1.0, factor=2.0, max_delay=60.0, jitter=0.5, retry_on_timeout=True):
+        """RetryPolicy(delay=1.0, factor=2.0, max_delay=60.0, jitter=0.5, retry_on_timeout=True)
+
+        delay:          type float seconds to wait before the first retry
+        factor:         type float the delay is multiplied by this factor for every further retry
+        max_delay:      type float upper bound for the delay in seconds, None for no bound
+        jitter:         type float between 0 and 1, the share of the delay that is randomized.
+                            0 waits exactly the computed delay, 1 waits anything between 0 and the delay
+        retry_on_timeout: type bool if False, an attempt that timed out is not retried
+
+        The number of attempts is still defined by Job.max_retries, the policy only decides how long a failed
+        job waits before the next attempt. While it waits, the job gives its slot in the pool to other jobs.
+        """
+        self.delay = delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_on_timeout = retry_on_timeout
+
+    def get_delay(self, attempt):
+        """
+        Return the seconds to wait after the given (1 based) failed attempt.
+        """
+        delay = self.delay * self.factor ** (attempt - 1)
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay * (1 - self.jitter * random.random())
+
+    def __repr__(self):
+        return "RetryPolicy(delay={}, factor={}, max_delay={}, jitter={})".format(
+            self.delay, self.factor, self.max_delay, self.jitter)
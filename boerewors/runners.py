@@ -12,11 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .helper import LoggableObject
+from importlib import import_module
+
+from .helper import LoggableObject, camel_case_to_snake_case
 
 
 class Runner(LoggableObject):
 
+    # the host inventory of the executor (--inventory), None without one
+    inventory = None
+
     def __init__(self):
         super(Runner, self).__init__()
         self._stage_counter = 0
@@ -47,3 +52,64 @@ class Runner(LoggableObject):
 
     def get_stages(self):
         raise NotImplementedError()
+
+
+class LazyRunner(object):
+
+    def __init__(self, name, target, help=None):
+        """LazyRunner(name, target, help=None)
+
+        name:       type str name of the subcommand
+        target:     type str "package.module:RunnerClass", an entry point or a callable that returns a Runner
+        help:       type str description of the subcommand
+
+        Stands in for a runner until its subcommand is selected, only then the runner is imported and created.
+        """
+        self.name = name
+        self.target = target
+        self.help = help
+        self._runner = None
+
+    @classmethod
+    def from_path(cls, path, help=None):
+        """
+        Create a LazyRunner for "package.module:RunnerClass", named like the Runner would be.
+        """
+        return cls(camel_case_to_snake_case(path.rpartition(':')[2].rpartition('.')[2]), path, help=help)
+
+    def load(self):
+        if self._runner is None:
+            target = self.target
+            if hasattr(target, 'load'):
+                # an entry point
+                target = target.load()
+            elif not callable(target):
+                module_name, _, attributes = target.partition(':')
+                target = import_module(module_name)
+                for attribute in attributes.split('.'):
+                    target = getattr(target, attribute)
+            self._runner = target()
+        return self._runner
+
+    def __repr__(self):
+        return "LazyRunner {} ({})".format(self.name, self.target)
+
+    __str__ = __repr__
+
+
+def entry_point_runners(group='boerewors.runners'):
+    """
+    Return a LazyRunner for every entry point of the group, the entry point name is the name of the subcommand.
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            from pkg_resources import iter_entry_points
+        except ImportError:
+            return []
+        found = iter_entry_points(group)
+    else:
+        found = entry_points()
+        found = found.select(group=group) if hasattr(found, 'select') else found.get(group, [])
+    return [LazyRunner(entry_point.name, entry_point) for entry_point in found]
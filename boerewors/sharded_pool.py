@@ -0,0 +1,229 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import multiprocessing
+import os
+import pickle
+from collections import OrderedDict
+
+try:
+    from queue import Empty
+except ImportError:
+    # python 2
+    from Queue import Empty
+
+from . import jobs
+from .errors import BoereworsException
+from .helper import monotonic
+from .inventory import shard_of
+from .pool import Pool
+
+
+class ShardFailed(BoereworsException):
+    pass
+
+
+def get_fork_context():
+    """
+    Return the multiprocessing context that forks, None if the platform can not fork.
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        try:
+            return multiprocessing.get_context('fork')
+        except ValueError:
+            return None
+    # python 2 always forks on posix
+    return multiprocessing if hasattr(os, 'fork') else None
+
+
+def dump_state(task):
+    state = task.get_state()
+    try:
+        return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        # e.g. an exception with a socket, keep what can be shown in the log
+        if state.get('_exception') is not None:
+            state['_exception'] = ShardFailed(str(state['_exception']))
+        if state.get('_result') is not None:
+            state['_result'] = repr(state['_result'])
+        return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+
+class ShardReporter(object):
+    """
+    Listener in a worker process, sends the state of started and finished tasks to the parent.
+    """
+
+    def __init__(self, shard, tasks, queue):
+        self.shard = shard
+        self.indexes = dict((id(task), idx) for idx, task in tasks)
+        self.queue = queue
+
+    def send(self, event, task):
+        self.queue.put((event, self.shard, self.indexes[id(task)], dump_state(task)))
+
+    def task_started(self, pool, task):
+        self.send('started', task)
+
+    def task_finished(self, pool, task):
+        self.send('finished', task)
+
+
+def run_shard(shard, tasks, pool_params, queue):
+    # the process pool of the parent does not work in a forked child, ProcessJobs get a new one
+    jobs._process_pool = None
+    pool = Pool(**pool_params)
+    pool.add_listener(ShardReporter(shard, tasks, queue))
+    for _, task in tasks:
+        pool.add_task(task)
+    try:
+        pool.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        jobs.shutdown_process_pool()
+        queue.put(('done', shard, None, None))
+
+
+class ShardedPool(Pool):
+
+    # seconds between the checks whether a worker died
+    check_interval = 1.0
+
+    def __init__(self, processes=2, pool_size=10, **pool_params):
+        """ShardedPool(processes=2, pool_size=10, **pool_params)
+
+        processes:      type int number of worker processes
+        pool_size:      type int maximum number of tasks running at the same time, split across the workers
+        pool_params:    passed to the Pool of every worker (deadline, concurrency_limits, scheduling, ...)
+
+        Splits the tasks into one shard per worker process. Every worker forks with its shard and runs it in its
+        own Pool, so polling and reading pipes is spread over several cores. The workers send the state of every
+        task (Job.state_attributes) back, the listeners of this pool are called in the parent as usual.
+
+        Tasks with concurrency keys are assigned to shards by their keys, so tasks that share all of their keys run
+        in the same worker. Limits are enforced per worker, callable limits only see the state of their worker.
+        """
+        super(ShardedPool, self).__init__(pool_size=pool_size, **pool_params)
+        self.processes = max(1, processes)
+        self.pool_params = dict(pool_params, pool_size=max(1, -(-pool_size // self.processes)))
+        # by the index of the task, tasks finish in any order
+        self.running_tasks = OrderedDict()
+
+    def get_shard(self, index, task):
+        keys = self.get_concurrency_keys(task)
+        if keys:
+            return shard_of(json.dumps(sorted(keys), default=str), self.processes)
+        return index % self.processes
+
+    def run(self):
+        context = get_fork_context()
+        tasks = list(self.upcomming_tasks)
+        self.upcomming_tasks.clear()
+        if context is None or self.processes == 1:
+            self.log.warning("run {} tasks in one process".format(len(tasks)))
+            pool = Pool(**dict(self.pool_params, pool_size=self.pool_size))
+            for listener in self.listeners:
+                pool.add_listener(listener)
+            for task in tasks:
+                pool.add_task(task)
+            pool.run()
+            self.finished_tasks = pool.finished_tasks
+            return
+
+        shards = [[] for _ in range(self.processes)]
+        for idx, task in enumerate(tasks):
+            shards[self.get_shard(idx, task)].append((idx, task))
+        queue = context.Queue()
+        workers = {}
+        # the workers share the named rate limits (see ratelimit)
+        shard_params = dict(self.pool_params,
+                            rate_limit_share=self.rate_limit_share / sum(1 for shard_tasks in shards if shard_tasks))
+        for shard, shard_tasks in enumerate(shards):
+            if shard_tasks:
+                workers[shard] = context.Process(target=run_shard, args=(shard, shard_tasks, shard_params, queue),
+                                                 name="boerewors-shard-{}".format(shard))
+        self.log.info("run {} tasks in {} processes".format(len(tasks), len(workers)))
+        for worker in workers.values():
+            # not daemonic, a daemonic worker can not start the process pool of ProcessJobs
+            worker.start()
+
+        pending = dict((idx, task) for idx, task in enumerate(tasks))
+        done = set()
+        try:
+            while len(done) < len(workers):
+                try:
+                    self.handle_event(queue.get(timeout=self.check_interval), tasks, pending, done)
+                except Empty:
+                    pass
+                self.tick_listeners(monotonic())
+                # checked after every event, the other workers may keep the queue busy
+                dead = [shard for shard, worker in workers.items() if shard not in done and not worker.is_alive()]
+                if dead:
+                    # the events a worker sent before it died come first
+                    while True:
+                        try:
+                            self.handle_event(queue.get_nowait(), tasks, pending, done)
+                        except Empty:
+                            break
+                    for shard in dead:
+                        if shard not in done:
+                            self.fail_shard(shard, shards[shard], pending, workers[shard].exitcode)
+                            done.add(shard)
+        except BaseException:
+            # e.g. interrupted, the workers would outlive the executor otherwise
+            self.log.error("interrupted, stop the workers")
+            for worker in workers.values():
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers.values():
+                worker.join()
+        for shard in workers:
+            # a worker that stopped early (e.g. interrupted) leaves tasks behind
+            self.fail_shard(shard, shards[shard], pending, workers[shard].exitcode)
+
+    def handle_event(self, event, tasks, pending, done):
+        event, shard, idx, state = event
+        if event == 'done':
+            done.add(shard)
+            return
+        task = tasks[idx]
+        task.set_state(pickle.loads(state))
+        if event == 'started':
+            self.running_tasks[idx] = task
+            for listener in self.listeners:
+                listener.task_started(self, task)
+        else:
+            self.finish_sharded_task(task, pending, idx)
+
+    def finish_sharded_task(self, task, pending, idx):
+        pending.pop(idx, None)
+        self.running_tasks.pop(idx, None)
+        self.add_finished(task)
+        for listener in self.listeners:
+            listener.task_finished(self, task)
+
+    def fail_shard(self, shard, shard_tasks, pending, exitcode):
+        remaining = [(idx, task) for idx, task in shard_tasks if idx in pending]
+        if not remaining:
+            return
+        self.log.error("worker {} exited with {}, {} of its tasks did not finish".format(
+            shard, exitcode, len(remaining)))
+        for idx, task in remaining:
+            task.set_state(dict(_exception=ShardFailed("worker {} exited with {}".format(shard, exitcode)),
+                                _failed_finally=True))
+            self.finish_sharded_task(task, pending, idx)
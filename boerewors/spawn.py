@@ -0,0 +1,155 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import errno
+import os
+import signal
+import subprocess
+import sys
+from subprocess import Popen, PIPE, STDOUT
+
+try:
+    DEVNULL = subprocess.DEVNULL
+except AttributeError:
+    # python 2
+    DEVNULL = -3
+
+# python ignores these signals, Popen resets them for the child (restore_signals) and so do we
+RESTORE_SIGNALS = [getattr(signal, name) for name in ('SIGPIPE', 'SIGXFZ', 'SIGXFSZ') if hasattr(signal, name)]
+
+# Popen arguments posix_spawn can handle, everything else (cwd, preexec_fn, ...) falls back to Popen
+SPAWN_ARGUMENTS = {'stdin', 'stdout', 'stderr', 'start_new_session', 'env'}
+
+# Popen of python 3.10+ uses vfork on linux, so it does not copy the memory of the controller either
+POPEN_VFORKS = sys.version_info >= (3, 10) and sys.platform.startswith('linux')
+
+STRATEGIES = ('auto', 'popen', 'posix_spawn')
+strategy = 'auto'
+
+
+def set_strategy(name):
+    """
+    Choose how PopenJob starts its processes:
+
+    popen:          subprocess.Popen, it forks the controller (or vforks on newer pythons)
+    posix_spawn:    os.posix_spawnp, the cost does not grow with the memory of the controller
+    auto:           posix_spawn on python 3.8 and 3.9 if the arguments allow it, Popen otherwise
+    """
+    global strategy
+    if name not in STRATEGIES:
+        raise ValueError("unknown spawn strategy {}, use one of {}".format(name, ", ".join(STRATEGIES)))
+    if name == 'posix_spawn' and not hasattr(os, 'posix_spawnp'):
+        raise ValueError("posix_spawn needs python 3.8+ on a posix system")
+    strategy = name
+
+
+def can_posix_spawn(args, kwargs):
+    return (hasattr(os, 'posix_spawnp') and len(args) == 1 and isinstance(args[0], (list, tuple))
+            and set(kwargs) <= SPAWN_ARGUMENTS)
+
+
+def spawn(*args, **kwargs):
+    """
+    Start a process like subprocess.Popen(*args, **kwargs) with the current strategy. The returned object has
+    the part of the Popen interface the jobs use: pid, stdin, stdout, stderr, returncode, poll, wait and kill.
+    """
+    use_posix_spawn = strategy == 'posix_spawn' or (strategy == 'auto' and not POPEN_VFORKS)
+    if use_posix_spawn and can_posix_spawn(args, kwargs):
+        return SpawnedProcess(args[0], **kwargs)
+    if strategy == 'posix_spawn':
+        raise ValueError("posix_spawn can not start {} with {}".format(args, sorted(kwargs)))
+    return Popen(*args, **kwargs)
+
+
+class SpawnedProcess(object):
+
+    def __init__(self, args, stdin=None, stdout=None, stderr=None, start_new_session=False, env=None):
+        self.args = args
+        self.returncode = None
+        self.stdin = self.stdout = self.stderr = None
+        file_actions = []
+        parent_ends = []
+        child_ends = []
+        try:
+            for fd, target, mode in ((0, stdin, 'wb'), (1, stdout, 'rb'), (2, stderr, 'rb')):
+                if target is None:
+                    continue
+                if target == PIPE:
+                    read_end, write_end = os.pipe()
+                    parent, child = (write_end, read_end) if fd == 0 else (read_end, write_end)
+                    parent_ends.append((fd, parent, mode))
+                    child_ends.append(child)
+                elif target == STDOUT:
+                    child = 1
+                elif target == DEVNULL:
+                    child = os.open(os.devnull, os.O_RDWR)
+                    child_ends.append(child)
+                elif isinstance(target, int):
+                    child = target
+                else:
+                    child = target.fileno()
+                file_actions.append((os.POSIX_SPAWN_DUP2, child, fd))
+            self.pid = os.posix_spawnp(args[0], list(args), os.environ if env is None else env,
+                                       file_actions=file_actions, setsid=bool(start_new_session),
+                                       setsigdef=RESTORE_SIGNALS)
+        except BaseException:
+            for _, parent, _ in parent_ends:
+                os.close(parent)
+            raise
+        finally:
+            # the child has its copies
+            for child in child_ends:
+                os.close(child)
+        for fd, parent, mode in parent_ends:
+            setattr(self, ('stdin', 'stdout', 'stderr')[fd], os.fdopen(parent, mode, 0))
+
+    def _set_returncode(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                # reaped by someone else, we can not know the exit status
+                self.returncode = 0
+                return self.returncode
+            if pid == self.pid:
+                self._set_returncode(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            self._set_returncode(status)
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.returncode is None:
+            os.kill(self.pid, signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def __repr__(self):
+        return "<SpawnedProcess: pid {} returncode {}>".format(self.pid, self.returncode)
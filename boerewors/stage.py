@@ -15,18 +15,42 @@
 from .helper import LoggableObject
 
 
+def new_summary():
+    return dict(failed_jobs=0, succeeded_jobs=0, timed_out_jobs=0)
+
+
+def add_to_summary(summary, job):
+    if job.was_successful():
+        summary['succeeded_jobs'] += 1
+    else:
+        summary['failed_jobs'] += 1
+        if job.timed_out():
+            summary['timed_out_jobs'] += 1
+
+
 class Stage(LoggableObject):
 
     is_canary = True
     allow_parallel_execution = True
     can_fail = False
     pool_params = {}
+    # seconds the whole stage may take, None for no limit
+    timeout = None
+    # set by the executor for --limit and --shard, jobs it returns False for are not run
+    job_filter = None
+    # False forgets the jobs once they are yielded, collect_summary then counts the jobs as they finish (see
+    # count_job), so a stage with many jobs does not keep all of them in memory
+    keep_jobs = True
+    # True if get_jobs does not depend on setup or on the previous stages, with --prefetch its jobs are built
+    # ahead then, otherwise only the stage itself
+    can_prefetch = False
 
     def __init__(self,
                  is_canary=None,
                  allow_parallel_execution=None,
                  can_fail=None,
                  pool_params=None,
+                 timeout=None,
                 ):
         super(Stage, self).__init__()
         if is_canary is not None:
@@ -37,14 +61,20 @@ class Stage(LoggableObject):
             self.can_fail = can_fail
         if pool_params is not None:
             self.pool_params = pool_params
+        if timeout is not None:
+            self.timeout = timeout
         self._joblist = []
+        self._summary = new_summary()
 
     @property
     def jobs(self):
         for idx, job in enumerate(self.get_jobs()):
             # provide logging info if the job accepts it
             getattr(job, 'set_logging_info', lambda *x: None)(self._logging_info, idx)
-            self._joblist.append(job)
+            if self.job_filter is not None and not self.job_filter(job):
+                continue
+            if self.keep_jobs:
+                self._joblist.append(job)
             yield job
 
     def should_continue(self, errors):
@@ -63,13 +93,18 @@ class Stage(LoggableObject):
     def cleanup(self, errors):
         self.log.notice("Stage finish {}\n".format("(errors occured)" if errors else ""))
 
+    def count_job(self, job):
+        """
+        Count a finished job for collect_summary, the executor calls it for every job of the stage.
+        """
+        add_to_summary(self._summary, job)
+
     def collect_summary(self):
-        summary = dict(failed_jobs=0, succeeded_jobs=0)
+        if not self.keep_jobs:
+            return dict(self._summary)
+        summary = new_summary()
         for job in self._joblist:
-            if job.was_successful():
-                summary['succeeded_jobs'] += 1
-            else:
-                summary['failed_jobs'] += 1
+            add_to_summary(summary, job)
         return summary
 
     def get_jobs(self):
@@ -0,0 +1,88 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from math import ceil, floor
+
+
+class Timer(object):
+    __slots__ = ('deadline', 'item', 'cancelled')
+
+    def __init__(self, deadline, item):
+        self.deadline = deadline
+        self.item = item
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+
+    def __init__(self, resolution=0.1, slots=512, now=0.0):
+        """TimerWheel(resolution=0.1, slots=512, now=0.0)
+
+        resolution:     type float seconds covered by one slot, timers fire at most this late
+        slots:          type int number of slots, deadlines further away than resolution * slots wrap around and
+                            stay in their slot for more rounds
+        now:            type float the current (monotonic) time
+
+        A hashed timing wheel. Scheduling and cancelling a timer is O(1) and advancing the wheel only looks at the
+        slots of the elapsed ticks. Most deadlines are cancelled long before they expire (the job finished in
+        time), which is exactly the case the wheel is good at.
+        """
+        self.resolution = resolution
+        self.slots = [[] for _ in range(slots)]
+        # the last tick that has been fully processed
+        self.current_tick = int(floor(now / resolution))
+
+    def schedule(self, deadline, item):
+        """
+        Register item to expire at deadline. Returns a Timer that can be cancelled.
+        """
+        timer = Timer(deadline, item)
+        # a timer is placed in the first slot that starts at or after its deadline
+        tick = max(int(ceil(deadline / self.resolution)), self.current_tick + 1)
+        self.slots[tick % len(self.slots)].append(timer)
+        return timer
+
+    def cancel(self, timer):
+        timer.cancel()
+
+    def expired(self, now):
+        """
+        Advance the wheel to now and return the items of all expired timers.
+        """
+        now_tick = int(floor(now / self.resolution))
+        if now_tick <= self.current_tick:
+            return []
+        first_tick = self.current_tick + 1
+        # if we skipped more than one round, every slot has to be visited only once
+        last_tick = min(now_tick, first_tick + len(self.slots) - 1)
+        self.current_tick = now_tick
+        items = []
+        for tick in range(first_tick, last_tick + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            remaining = []
+            for timer in slot:
+                if timer.cancelled:
+                    continue
+                elif timer.deadline <= now:
+                    items.append(timer.item)
+                else:
+                    remaining.append(timer)
+            self.slots[tick % len(self.slots)] = remaining
+        return items
@@ -0,0 +1,325 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:
+    # optional, pip install boerewors[warmup], the percentiles are computed in python without it
+    numpy = None
+
+from .helper import monotonic
+from .http import HttpConnectionPool, HttpJob
+from .jobs import Job
+from .stage import Stage
+
+
+# upper bounds of the histogram buckets in seconds, the last bucket has no upper bound
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+QUANTILES = (50, 90, 95, 99)
+
+
+def format_latency(seconds):
+    return "-" if seconds is None else "{:.1f}ms".format(seconds * 1000)
+
+
+def percentiles(values, quantiles=QUANTILES):
+    """
+    Return the percentiles (0-100) of the values, interpolated linearly between the closest ranks like
+    numpy.percentile. All percentiles are computed from one sort, with numpy in one vectorized call.
+    """
+    if not len(values):
+        return [None] * len(quantiles)
+    if numpy is not None:
+        return [float(value) for value in numpy.percentile(numpy.asarray(values), quantiles)]
+    ordered = sorted(values)
+    result = []
+    for quantile in quantiles:
+        rank = (len(ordered) - 1) * quantile / 100.0
+        low = int(rank)
+        high = min(low + 1, len(ordered) - 1)
+        result.append(ordered[low] + (ordered[high] - ordered[low]) * (rank - low))
+    return result
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        """LatencyHistogram(buckets=BUCKETS)
+
+        buckets:    type Tuple[float] upper bounds of the buckets in seconds
+
+        Records the latencies (seconds) of the requests to one host. The samples are kept (8 bytes each) for exact
+        percentiles, e.g. of the last window of requests.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.samples = array('d')
+        self.errors = 0
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.counts[bisect_left(self.buckets, latency)] += 1
+
+    def add_error(self):
+        self.errors += 1
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentiles(self, quantiles=QUANTILES, last=None):
+        """
+        Return the percentiles of all samples, or of the last ones.
+        """
+        return percentiles(self.samples[-last:] if last else self.samples, quantiles)
+
+    def summary(self):
+        summary = dict(requests=len(self.samples), errors=self.errors)
+        for quantile, value in zip(QUANTILES, self.percentiles()):
+            summary['p{}'.format(quantile)] = value
+        bounds = ["<={}".format(bound) for bound in self.buckets] + [">{}".format(self.buckets[-1])]
+        summary['histogram'] = dict((bound, count) for bound, count in zip(bounds, self.counts) if count)
+        return summary
+
+
+class WarmupRequests(Job):
+
+    def __init__(self, urls, rps=50, concurrency=4, p95=0.2, window=100, max_duration=300, headers=None,
+                 request_timeout=10):
+        """WarmupRequests(urls, rps=50, concurrency=4, p95=0.2, window=100, max_duration=300, headers=None,
+                          request_timeout=10)
+
+        urls:           type List[str] replayed in order, again from the start when all were sent
+        rps:            type float requests per second at most
+        concurrency:    type int requests in flight at most, they share as many keep-alive connections
+        p95:            type float seconds, the host is warm when the 95th percentile of the last window is below
+        window:         type int number of requests the percentile is computed for, the first check is after
+                            all urls were requested once
+        max_duration:   type float seconds until the host counts as not warm
+        headers:        type dict sent with every request, e.g. {'Host': 'www.example.com'}
+        request_timeout:    type float seconds per request, a timed out request is an error
+
+        A subtask that sends the requests at a steady rate and is finished when the host is warm (result True) or
+        max_duration passed (result False). A window with errors does not count as warm.
+        """
+        super(WarmupRequests, self).__init__()
+        self.urls = list(urls)
+        self.rps = rps
+        self.concurrency = concurrency
+        self.p95 = p95
+        self.window = window
+        self.max_duration = max_duration
+        self.headers = headers
+        self.request_timeout = request_timeout
+        self.histogram = LatencyHistogram()
+        self.connections = HttpConnectionPool(max_per_origin=concurrency)
+        self.warm = False
+        self.window_p95 = None
+        self._in_flight = []
+        self._sent = 0
+        self._checked = 0
+        self._errors_at = []
+        self._next_send_at = None
+        self._stop_at = None
+
+    def start(self):
+        now = monotonic()
+        self._next_send_at = now
+        self._stop_at = now + self.max_duration
+
+    def send_due_requests(self, now):
+        interval = 1.0 / self.rps
+        while len(self._in_flight) < self.concurrency and self._next_send_at <= now:
+            url = self.urls[self._sent % len(self.urls)]
+            request = HttpJob(url, headers=self.headers, timeout=self.request_timeout, connections=self.connections)
+            request.poll()
+            self._in_flight.append((now, request))
+            self._sent += 1
+            # a slow host does not get a burst of requests once a slot is free again
+            self._next_send_at = max(self._next_send_at + interval, now)
+
+    def poll(self):
+        if self._result is not None:
+            return True
+        if self._next_send_at is None:
+            self.start()
+        now = monotonic()
+        self.expire_requests(now)
+        in_flight = []
+        for sent_at, request in self._in_flight:
+            if request.poll() is None:
+                in_flight.append((sent_at, request))
+            elif request.was_successful():
+                self.histogram.add(monotonic() - sent_at)
+            else:
+                self.histogram.add_error()
+                self._errors_at.append(len(self.histogram))
+        self._in_flight = in_flight
+        if self.check_gate() or now >= self._stop_at:
+            self.finish()
+            return True
+        self.send_due_requests(now)
+        return None
+
+    def expire_requests(self, now):
+        # the requests are polled here, not by the pool, their timeouts are enforced here as well
+        for _, request in self._in_flight:
+            deadline = request.get_deadline()
+            if deadline is not None and deadline <= now:
+                request.expire()
+
+    def check_gate(self):
+        done = len(self.histogram)
+        if done == self._checked or done < max(self.window, len(self.urls)):
+            return False
+        self._checked = done
+        if self._errors_at and self._errors_at[-1] > done - self.window:
+            return False
+        self.window_p95 = self.histogram.percentiles((95,), last=self.window)[0]
+        self.warm = self.window_p95 <= self.p95
+        return self.warm
+
+    def finish(self):
+        self.terminate()
+        self.connections.close()
+        self._result = self.warm
+        if not self.warm and len(self.histogram):
+            self.window_p95 = self.histogram.percentiles((95,), last=self.window)[0]
+        self.log.info("warm: {}, p95 of the last {} requests: {}".format(
+            self.warm, self.window, format_latency(self.window_p95)))
+
+    def get_result(self, result_type=None, can_fail=False):
+        while self.poll() is None:
+            continue
+        return self._result
+
+    def get_deadline(self):
+        if self._result is not None:
+            return None
+        deadlines = [request.get_deadline() for _, request in self._in_flight]
+        return min([self._stop_at] + [deadline for deadline in deadlines if deadline is not None])
+
+    def terminate(self):
+        for _, request in self._in_flight:
+            request.terminate()
+        self._in_flight = []
+
+    def expire(self, final=False):
+        now = monotonic()
+        if final or now >= self._stop_at:
+            self.finish()
+        else:
+            # a request timed out, it is an error of the window
+            self.expire_requests(now)
+
+    def cancel(self, reason="cancelled"):
+        self.finish()
+        super(WarmupRequests, self).cancel(reason)
+
+    def was_successful(self):
+        return self._exception is None and bool(self._result)
+
+
+class WarmupJob(Job):
+
+    def __init__(self, host, urls, **warmup_params):
+        """WarmupJob(host, urls, **warmup_params)
+
+        host:           type str the freshly deployed host
+        urls:           type List[str] urls on this host, e.g. the most requested pages of yesterday
+        warmup_params:  see WarmupRequests (rps, concurrency, p95, window, max_duration, headers, request_timeout)
+
+        Warms up the caches of a host and puts it back into rotation (see back_in_rotation) when its latency is
+        good enough. The result is the latency summary of the host.
+        """
+        super(WarmupJob, self).__init__()
+        self.host = host
+        self.urls = urls
+        self.warmup_params = warmup_params
+        self.requests = None
+
+    def run_job(self):
+        self.requests = WarmupRequests(self.urls, **self.warmup_params)
+        yield self.requests
+        if not self.requests.warm:
+            yield self.Error("p95 of {} still {} after {} requests".format(
+                self.host, format_latency(self.requests.window_p95), len(self.requests.histogram)))
+        for sub_task in self.back_in_rotation():
+            yield sub_task
+        yield self.Ok(self.requests.histogram.summary())
+
+    def back_in_rotation(self):
+        """
+        Yield the subtasks that put the warm host back into rotation, e.g. an SSHJob that enables it in the load
+        balancer. Nothing by default.
+        """
+        return iter(())
+
+    def latency_summary(self):
+        return self.requests.histogram.summary() if self.requests is not None else None
+
+
+class WarmupStage(Stage):
+
+    is_canary = False
+    job_class = WarmupJob
+
+    def __init__(self, hosts, urls, url_template="http://{host}{path}", pool_size=10, is_canary=None,
+                 allow_parallel_execution=None, can_fail=None, pool_params=None, timeout=None, **warmup_params):
+        """WarmupStage(hosts, urls, url_template="http://{host}{path}", pool_size=10, is_canary=None,
+                       allow_parallel_execution=None, can_fail=None, pool_params=None, timeout=None,
+                       **warmup_params)
+
+        hosts:          type List[str] the freshly deployed hosts
+        urls:           type List[str] paths (e.g. "/search?q=hotel") or full urls with a {host} placeholder
+        url_template:   type str turns a path into the url of a host
+        pool_size:      type int hosts that are warmed up at the same time, pool_params can override it
+        is_canary, allow_parallel_execution, can_fail, pool_params, timeout:    see Stage
+        warmup_params:  see WarmupRequests (rps, concurrency, p95, window, max_duration, headers, request_timeout)
+
+        Replays the urls against every host at a target rate and gates the host on its p95 latency. The summary
+        of the stage has the latency percentiles and histogram of every host.
+        """
+        stage_pool_params = dict(pool_size=pool_size)
+        stage_pool_params.update(pool_params or {})
+        super(WarmupStage, self).__init__(is_canary=is_canary, allow_parallel_execution=allow_parallel_execution,
+                                          can_fail=can_fail, pool_params=stage_pool_params, timeout=timeout)
+        self.hosts = hosts
+        self.urls = urls
+        self.url_template = url_template
+        self.warmup_params = warmup_params
+
+    def urls_of(self, host):
+        return [url.format(host=host) if "://" in url else self.url_template.format(host=host, path=url)
+                for url in self.urls]
+
+    def get_jobs(self):
+        for host in self.hosts:
+            yield self.job_class(host, self.urls_of(host), **self.warmup_params)
+
+    def collect_summary(self):
+        summary = super(WarmupStage, self).collect_summary()
+        summary['latency'] = dict((job.host, job.latency_summary()) for job in self._joblist)
+        return summary
+
+    def cleanup(self, errors):
+        for job in self._joblist:
+            latency = job.latency_summary()
+            if latency is not None:
+                self.log.notice("{}: {} requests, {} errors, p50 {}, p95 {}, p99 {}".format(
+                    job.host, latency['requests'], latency['errors'], format_latency(latency['p50']),
+                    format_latency(latency['p95']), format_latency(latency['p99'])))
+        super(WarmupStage, self).cleanup(errors)
@@ -22,6 +22,12 @@ AUTHOR = 'Olaf Gladis'
 REQUIRED = [
 ]
 
+# What packages are optional?
+EXTRAS = {
+    # vectorized latency percentiles of the WarmupStage
+    'warmup': ['numpy'],
+}
+
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -86,6 +92,7 @@ setup(
     #     'console_scripts': ['mycli=mymodule:cli'],
     # },
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
     include_package_data=True,
     license='Apache-2.0',
     classifiers=[
@@ -18,5 +18,5 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 import boerewors
 
-from boerewors import executor, helper, jobs, logging_helper, pool, result, runners, stage
+from boerewors import agent, broadcast, cache, cluster, executor, fanout, helper, history, http, inventory, jobs, journal, logging_helper, pool, prefetch, prewarm, profiling, ratelimit, remote, report, result, retry, runners, sharded_pool, spawn, stage, warmup
 from boerewors.executor import BoereworsExecutor
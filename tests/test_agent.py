@@ -0,0 +1,137 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import signal
+import threading
+import time
+
+import pytest
+from context import agent, jobs, pool, remote
+
+
+def test_frames():
+    reader = agent.FrameReader()
+    first = agent.encode_frame({"id": 1})
+    data = first + agent.encode_frame({"id": 2, "op": "ping"})
+    assert reader.feed(data[:3]) == []
+    assert reader.feed(data[3:len(first) + 2]) == [{"id": 1}]
+    assert reader.feed(data[len(first) + 2:]) == [{"id": 2, "op": "ping"}]
+
+
+def test_ssh_command():
+    connection = remote.AgentConnection("hosta", user="deploy", options=["BatchMode=yes"])
+    command, source = connection.get_command()
+    assert command[:4] == ["/usr/bin/ssh", "-o", "BatchMode=yes", "deploy@hosta"]
+    assert command[4].startswith("python3 -c ")
+    assert "exec(s.read({}))".format(len(source)) in command[4]
+
+
+def wait(task):
+    while task.poll() is None:
+        pass
+    return task
+
+
+def test_commands():
+    with remote.AgentConnection(None) as connection:
+        # a batch of requests, the responses are streamed back in order
+        commands = [connection.run("echo {}".format(idx)) for idx in range(10)]
+        for command in commands:
+            command.start()
+        for idx, command in enumerate(commands):
+            assert wait(command).get_result('stdout') == "{}\n".format(idx)
+            assert command.get_result() == 0
+
+        failed = wait(connection.run("echo oh no; exit 3"))
+        assert not failed.was_successful()
+        assert failed.get_result('stdout', can_fail=True) == "oh no\n"
+        assert failed.get_result(can_fail=True) == 3
+        with pytest.raises(jobs.CalledProcessError):
+            failed.get_result()
+        pid = connection.proc.pid
+
+    # the agent exits on its own, close does not wait for it
+    assert remote.reap_agents(5) == 0
+    assert connection.proc is None
+    assert pid
+
+
+def test_files(tmpdir):
+    path = str(tmpdir.join("conf", "app.conf"))
+    with remote.AgentConnection(None) as connection:
+        assert wait(connection.write_file(path, u"key = value\n", mode=0o600)).was_successful()
+        assert wait(connection.read_file(path)).get_result() == b"key = value\n"
+        missing = wait(connection.read_file(str(tmpdir.join("missing"))))
+        assert not missing.was_successful()
+        assert "IOError" in missing.response["error"] or "FileNotFoundError" in missing.response["error"]
+    assert tmpdir.join("conf", "app.conf").read() == "key = value\n"
+
+
+def test_send_does_not_block(tmpdir):
+    # the agent blocks on the large responses while a large request is sent, send must not wait for it
+    path = str(tmpdir.join("large"))
+    tmpdir.join("large").write("x" * 2 ** 20)
+    with remote.AgentConnection(None) as connection:
+        reads = [connection.read_file(path) for _ in range(5)]
+        write = connection.write_file(str(tmpdir.join("copy")), b"y" * 2 ** 20)
+        sender = threading.Thread(target=lambda: [task.start() for task in reads + [write]])
+        sender.start()
+        sender.join(10)
+        assert not sender.is_alive()
+        assert all(len(wait(task).get_result()) == 2 ** 20 for task in reads)
+        assert wait(write).was_successful()
+    assert tmpdir.join("copy").size() == 2 ** 20
+
+
+def test_close_does_not_block():
+    connection = remote.AgentConnection(None)
+    connection.exit_timeout = 0.3
+    connection.run("sleep 10").start()
+    proc = connection.proc
+    started = time.time()
+    connection.close()
+    assert time.time() - started < 0.1
+    assert connection.proc is proc
+    # the agent is busy with the command, it is killed after exit_timeout
+    assert remote.reap_agents(5) == 0
+    assert connection.proc is None
+    assert proc.returncode == -signal.SIGKILL
+
+
+def test_command_timeout():
+    with remote.AgentConnection(None) as connection:
+        command = wait(connection.run("sleep 10", timeout=0.2))
+        assert not command.was_successful()
+        assert "timeout" in command.response["error"]
+
+
+class AgentJob(jobs.Job):
+
+    def run_job(self):
+        with remote.AgentConnection(None) as connection:
+            yield connection.run("echo boerewors")
+            self.output = self.get_subtask_result('stdout')
+            yield connection.run("exit 1")
+            yield self.error_if_subtask_failed()
+        yield self.Ok()
+
+
+def test_agent_job():
+    job = AgentJob()
+    tasks = pool.Pool()
+    tasks.add_task(job)
+    tasks.run()
+    assert job.output == "boerewors\n"
+    assert not job.was_successful()
@@ -0,0 +1,74 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from context import BoereworsExecutor, broadcast, jobs, runners
+
+
+def test_output_groups():
+    groups = broadcast.OutputGroups()
+    first = groups.add("hosta", 0, u"ok\n")
+    assert groups.add("hostb", 0, u"ok\n") is first
+    groups.add("hostc", 1, u"disk full\n")
+    assert len(groups) == 2
+    assert groups.summary() == ["2 hosts (OK): ok", "1 host (exit 1): disk full", "    hosts: hostc"]
+
+    # a retried host moves to its new group
+    groups.add("hostc", 0, u"ok\n")
+    assert len(groups) == 1
+    assert groups.summary() == ["3 hosts (OK): ok"]
+
+
+def test_output_groups_normalize():
+    groups = broadcast.OutputGroups(normalize=lambda output: output.split(":", 1)[1])
+    groups.add("hosta", 0, u"hosta: ok")
+    groups.add("hostb", 0, u"hostb: ok")
+    assert len(groups) == 1
+
+
+class LocalBroadcastJob(broadcast.BroadcastJob):
+
+    def remote_command(self):
+        return jobs.BourneShell("HOST={} && {}".format(self.host, self.command))
+
+
+class LocalBroadcastStage(broadcast.BroadcastStage):
+    job_class = LocalBroadcastJob
+
+
+class BroadcastRunner(runners.Runner):
+
+    def __init__(self, hosts, command):
+        super(BroadcastRunner, self).__init__()
+        self.hosts = hosts
+        self.command = command
+
+    def get_stages(self):
+        self.stage = LocalBroadcastStage(self.hosts, self.command, can_fail=True, pool_params={'pool_size': 10})
+        yield self.stage
+
+
+def test_broadcast_stage():
+    hosts = ["host{:02d}".format(idx) for idx in range(20)]
+    command = 'case $HOST in host1[5-9]) echo "disk full"; exit 1;; *) echo OK;; esac'
+    runner = BroadcastRunner(hosts, command)
+    executor = BoereworsExecutor(runners=[runner])
+    executor.run([])
+
+    summary = runner.stage.collect_summary()
+    assert summary['distinct_outputs'] == 2
+    assert summary['succeeded_jobs'] == 15
+    assert runner.stage.groups.summary()[:2] == ["15 hosts (OK): OK", "5 hosts (exit 1): disk full"]
+    outputs = set(id(job.output) for job in runner.stage._joblist)
+    assert len(outputs) == 2
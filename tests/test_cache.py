@@ -0,0 +1,112 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+from context import BoereworsExecutor, cache, jobs, runners, stage
+
+
+def test_hash_key():
+    assert cache.hash_key(("download", "1.2.3", "hosta")) == cache.hash_key(["download", "1.2.3", "hosta"])
+    assert cache.hash_key({"a": 1, "b": 2}) == cache.hash_key({"b": 2, "a": 1})
+    assert cache.hash_key("release-1") != cache.hash_key("release-2")
+
+
+def test_result_cache(tmpdir):
+    path = str(tmpdir.join("cache.sqlite"))
+    results = cache.ResultCache(path, ttl=60)
+    results.put("a", "done")
+    results.put(("b", 1), {"files": 3})
+    results.close()
+
+    results = cache.ResultCache(path, ttl=60)
+    assert results.get("a")[0] == "done"
+    assert results.get(("b", 1))[0] == {"files": 3}
+    assert results.get("c") is None
+
+    # expired results are not returned
+    results.ttl = 0
+    assert results.get("a") is None
+
+
+def test_eviction(tmpdir):
+    results = cache.ResultCache(str(tmpdir.join("cache.sqlite")), max_entries=2)
+    for key in ("a", "b", "c"):
+        results.put(key, key)
+        results.flush()
+        time.sleep(0.01)
+    assert results.get("a") is None
+    assert results.get("b") is not None
+    assert results.get("c") is not None
+
+
+class DownloadJob(jobs.Job):
+    executed = []
+
+    def __init__(self, host, release):
+        super(DownloadJob, self).__init__()
+        self.host = host
+        self.cache_key = ("download", release, host)
+
+    def run_job(self):
+        DownloadJob.executed.append(self.host)
+        yield self.Ok({"path": "/srv/{}".format(self.host)})
+
+
+class DownloadStage(stage.Stage):
+    release = "1.0"
+
+    def get_jobs(self):
+        for host in ("hosta", "hostb", "hostc"):
+            yield DownloadJob(host, self.release)
+
+
+class DownloadRunner(runners.Runner):
+
+    def get_stages(self):
+        self.stage = DownloadStage()
+        yield self.stage
+
+
+class OtherDownloadRunner(DownloadRunner):
+    pass
+
+
+def test_cached_jobs_are_skipped(tmpdir):
+    path = str(tmpdir.join("cache.sqlite"))
+    executor = BoereworsExecutor(runners=[DownloadRunner()], cache=path)
+
+    DownloadJob.executed = []
+    assert executor.run(["--limit", "2"])
+    assert DownloadJob.executed == ["hosta", "hostb"]
+
+    runner = DownloadRunner()
+    DownloadJob.executed = []
+    assert BoereworsExecutor(runners=[runner], cache=path).run([])
+    assert DownloadJob.executed == ["hostc"]
+    # the skipped jobs have the cached result
+    hosta = runner.stage._joblist[0]
+    assert hosta.skipped
+    assert hosta.get_result().value == {"path": "/srv/hosta"}
+
+    # the keys are scoped to the runner
+    DownloadJob.executed = []
+    assert BoereworsExecutor(runners=[OtherDownloadRunner()], cache=path).run([])
+    assert DownloadJob.executed == ["hosta", "hostb", "hostc"]
+
+    DownloadStage.release = "1.1"
+    DownloadJob.executed = []
+    assert executor.run([])
+    assert DownloadJob.executed == ["hosta", "hostb", "hostc"]
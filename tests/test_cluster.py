@@ -0,0 +1,279 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import socket
+import threading
+
+import pytest
+
+from context import BoereworsExecutor, cluster, jobs, runners, stage
+from boerewors.errors import ClusterException
+from boerewors.helper import monotonic
+from boerewors.result import Ok, Timeout
+
+
+@pytest.fixture(autouse=True)
+def token(monkeypatch):
+    monkeypatch.setenv(cluster.TOKEN_VARIABLE, "secret")
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_state_roundtrip():
+    job = jobs.BourneShell("true")
+    job._result = Timeout("slow")
+    job._exception = ValueError("boom")
+    job._stdout = u"output"
+    job.started_at, job.finished_at = 10.0, 12.5
+    data = cluster.encode_state(job)
+    assert data['duration'] == 2.5
+    state = cluster.decode_state(data)
+    assert isinstance(state['_result'], Timeout) and state['_result'].value == "slow"
+    assert "boom" in str(state['_exception'])
+    assert state['_stdout'] == "output"
+
+
+def test_strip_options():
+    from boerewors.executor import strip_options
+    argv = ['--coordinate', 'host:1', '--workers=3', '-v', 'deploy', '--flag']
+    assert strip_options(argv, ['--coordinate', '--workers']) == ['-v', 'deploy', '--flag']
+
+
+class WhereJob(jobs.Job):
+
+    state_attributes = jobs.Job.state_attributes + ('thread',)
+
+    def __init__(self, idx):
+        super(WhereJob, self).__init__()
+        self.host = "host{:02d}".format(idx)
+        self.thread = None
+
+    def run_job(self):
+        self.thread = threading.current_thread().name
+        yield self.Ok(self.host)
+
+
+class FailingWhereJob(WhereJob):
+
+    def run_job(self):
+        self.thread = threading.current_thread().name
+        yield self.Error("disk full")
+
+
+class ClusterStage(stage.Stage):
+
+    def __init__(self, count, fail=False, **kwargs):
+        super(ClusterStage, self).__init__(**kwargs)
+        self.count = count
+        self.fail = fail
+
+    def get_jobs(self):
+        for idx in range(self.count):
+            yield (FailingWhereJob if self.fail and idx == 5 else WhereJob)(idx)
+
+
+class ClusterRunner(runners.Runner):
+
+    def setup_parser(self, parser):
+        parser.add_argument('--fail', action='store_true')
+
+    def setup(self, args):
+        self.fail = args.fail
+        return True
+
+    def get_stages(self):
+        self.stages_run = getattr(self, 'stages_run', [])
+        for stage_ in [ClusterStage(10, allow_parallel_execution=False), ClusterStage(20, fail=self.fail),
+                       ClusterStage(10)]:
+            self.stages_run.append(stage_)
+            yield stage_
+
+
+class BrokenExecutor(BoereworsExecutor):
+
+    def run_pool(self, jobs, listeners, **pool_params):
+        raise RuntimeError("out of file descriptors")
+
+
+def run_cluster(argv, workers=2, executors=None, runner_class=ClusterRunner):
+    address = "127.0.0.1:{}".format(free_port())
+    results = {}
+
+    def run_worker(name):
+        executor = (executors or {}).get(name, BoereworsExecutor)
+        try:
+            results[name] = executor(runners=[runner_class()]).run(["--worker", address])
+        except RuntimeError as e:
+            results[name] = e
+
+    threads = [threading.Thread(target=run_worker, args=(idx,), name="worker{}".format(idx))
+               for idx in range(workers)]
+    for thread in threads:
+        thread.start()
+    runner = runner_class()
+    success = BoereworsExecutor(runners=[runner]).run(
+        ["--coordinate", address, "--workers", str(workers)] + argv)
+    for thread in threads:
+        thread.join(10)
+    return success, runner, results
+
+
+def test_cluster():
+    success, runner, results = run_cluster([])
+    assert success
+    assert results == {0: True, 1: True}
+    serial, parallel, last = runner.stages_run
+    # the stage without parallel execution ran on the coordinator
+    assert set(job.thread for job in serial._joblist) == {threading.current_thread().name}
+    # the canary ran on the coordinator, the other jobs on the workers
+    assert parallel._joblist[0].thread == threading.current_thread().name
+    assert set(job.thread for job in parallel._joblist[1:]) == {"worker0", "worker1"}
+    assert all(job.get_result() == Ok(job.host) for job in parallel._joblist)
+    assert parallel.collect_summary()['succeeded_jobs'] == 20
+    assert last.collect_summary()['succeeded_jobs'] == 10
+
+
+def test_cluster_should_continue():
+    success, runner, results = run_cluster(["--fail"])
+    assert not success
+    # the failed stage stopped the run on the coordinator and on the workers
+    assert len(runner.stages_run) == 2
+    assert runner.stages_run[1].collect_summary()['failed_jobs'] == 1
+
+
+class KeyedWhereJob(WhereJob):
+
+    def __init__(self, idx):
+        super(KeyedWhereJob, self).__init__(idx)
+        self.concurrency_keys = {'lb_pool': "pool{}".format(idx % 3)}
+
+
+class KeyedStage(ClusterStage):
+    is_canary = False
+
+    def get_jobs(self):
+        for idx in range(12):
+            yield KeyedWhereJob(idx)
+
+
+class KeyedRunner(runners.Runner):
+
+    limit = 1
+
+    def get_stages(self):
+        self.stage = KeyedStage(0, pool_params=dict(pool_size=4, concurrency_limits={'lb_pool': self.limit}))
+        yield self.stage
+
+
+class CallableLimitRunner(KeyedRunner):
+
+    limit = staticmethod(lambda: 1)
+
+
+def test_tasks_are_assigned_by_their_keys():
+    success, runner, results = run_cluster([], runner_class=KeyedRunner)
+    assert success
+    workers = {}
+    for job in runner.stage._joblist:
+        workers.setdefault(job.concurrency_keys['lb_pool'], set()).add(job.thread)
+    # the limit of a key is enforced by one worker
+    assert all(len(threads) == 1 for threads in workers.values())
+    assert set.union(*workers.values()) <= {"worker0", "worker1"}
+
+
+def test_callable_limits_run_on_the_coordinator():
+    with pytest.raises(ClusterException):
+        cluster.ClusterPool(cluster.Coordinator("127.0.0.1:0", 1, [], token="secret"),
+                            concurrency_limits={'lb_pool': lambda: 1})
+    success, runner, results = run_cluster([], runner_class=CallableLimitRunner)
+    assert success
+    assert set(job.thread for job in runner.stage._joblist) == {threading.current_thread().name}
+
+
+def test_failed_worker_fails_its_tasks():
+    success, runner, results = run_cluster([], executors={0: BrokenExecutor})
+    assert not success
+    assert isinstance(results[0], RuntimeError)
+    summary = runner.stages_run[1].collect_summary()
+    # every job has an outcome, the ones of the broken worker failed
+    assert summary['succeeded_jobs'] + summary['failed_jobs'] == 20
+    # the canary ran on the coordinator, the broken worker got 9 or 10 of the other jobs
+    assert summary['failed_jobs'] in (9, 10)
+
+
+def test_worker_needs_the_token():
+    address = "127.0.0.1:{}".format(free_port())
+    hellos = []
+
+    def connect():
+        hellos.append(cluster.Worker(address, token="wrong").connect().hello())
+
+    thread = threading.Thread(target=connect)
+    thread.start()
+    coordinator = cluster.Coordinator(address, 1, ["deploy"], accept_timeout=1)
+    with pytest.raises(ClusterException):
+        coordinator.start()
+    thread.join(5)
+    assert coordinator.connections == []
+    # the worker got no arguments
+    assert hellos == [None]
+
+
+def test_coordinator_needs_the_token():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    address = "127.0.0.1:{}".format(server.getsockname()[1])
+
+    def impostor():
+        sock, _ = server.accept()
+        connection = cluster.Connection(sock, "impostor")
+        connection.send(dict(op='challenge', challenge="abc"))
+        answer = connection.receive()
+        connection.send(dict(op='hello', worker=0, workers=1, argv=["rm"], signature=answer['signature']))
+        connection.receive()
+
+    thread = threading.Thread(target=impostor)
+    thread.start()
+    worker = cluster.Worker(address).connect()
+    with pytest.raises(ClusterException):
+        worker.hello()
+    worker.close()
+    thread.join(5)
+    server.close()
+
+
+def test_deadline_of_silent_workers():
+    local, remote = socket.socketpair()
+    coordinator = cluster.Coordinator("127.0.0.1:0", 1, [], token="secret")
+    coordinator.connections = [cluster.Connection(local, "silent")]
+    pool = cluster.ClusterPool(coordinator, pool_size=2, deadline=monotonic() + 0.2)
+    pool.deadline_grace = 0.1
+    tasks = [WhereJob(idx) for idx in range(3)]
+    for task in tasks:
+        pool.add_task(task)
+    started = monotonic()
+    pool.run()
+    assert monotonic() - started < 5
+    assert all(task.timed_out() for task in tasks)
+    assert len(pool.finished_tasks) == 3
+    assert coordinator.connections == []
+    remote.close()
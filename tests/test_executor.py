@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import subprocess
+import sys
 from datetime import datetime
 from context import BoereworsExecutor, runners, jobs, stage, logging_helper
 import pytest
@@ -251,6 +254,59 @@ def test_limit_parameter():
     assert global_job_index == 1
 
 
+class OptionRunner(LimitRunner):
+    def setup_parser(self, parser):
+        parser.add_argument('--flag', default="default")
+
+    def setup(self, args):
+        self.flag = args.flag
+        return True
+
+
+def test_lazy_runners():
+    loaded = []
+
+    def load_option_runner():
+        loaded.append("option_runner")
+        return OptionRunner()
+
+    def load_other_runner():
+        loaded.append("other")
+        return LimitRunner()
+
+    executor = BoereworsExecutor(runners=[runners.LazyRunner("option_runner", load_option_runner),
+                                          runners.LazyRunner("other", load_other_runner)])
+    assert loaded == []
+    with pytest.raises(SystemExit):
+        executor.run(['--version'])
+    assert loaded == []
+
+    assert executor.run(['option_runner', '--flag', 'set'])
+    assert loaded == ["option_runner"]
+    assert executor.runners["option_runner"].flag == "set"
+
+
+def test_lazy_runner_from_path():
+    runner = runners.LazyRunner.from_path("test_executor:LimitRunner")
+    assert runner.name == "limit_runner"
+    executor = BoereworsExecutor(runners=["test_executor:LimitRunner"])
+    assert isinstance(executor.runners["limit_runner"], runners.LazyRunner)
+    assert executor.run([])
+    assert isinstance(executor.runners["limit_runner"], LimitRunner)
+
+
+def test_cli_imports_no_optional_features():
+    # the modules of the options are imported when the option is used
+    code = "import sys, boerewors.executor; print(' '.join(sys.modules))"
+    output = subprocess.check_output([sys.executable, "-c", code],
+                                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    modules = set(output.decode('utf8').split())
+    for name in ['sqlite3', 'multiprocessing', 'concurrent.futures', 'socket', 'tracemalloc', 'pickle',
+                 'boerewors.cache', 'boerewors.cluster', 'boerewors.prefetch', 'boerewors.prewarm',
+                 'boerewors.profiling', 'boerewors.sharded_pool']:
+        assert name not in modules
+
+
 class NonParallelSimpleStage(stage.Stage):
 
     allow_parallel_execution = False
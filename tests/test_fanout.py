@@ -0,0 +1,109 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+
+import pytest
+from context import BoereworsExecutor, fanout, jobs, runners
+from boerewors.errors import NoSourceException
+
+
+def test_source_tracker():
+    sources = fanout.SourceTracker(origin_slots=2, fanout=3)
+    assert sources.capacity() == 2
+    assert sources.acquire() is None
+    assert sources.acquire() is None
+    with pytest.raises(NoSourceException):
+        sources.acquire()
+
+    sources.add_source("hosta")
+    sources.release(None)
+    assert sources.capacity() == 5
+    # peers go first
+    assert [sources.acquire() for _ in range(3)] == ["hosta"] * 3
+    assert sources.acquire() is None
+    assert sources.capacity() == 5
+
+
+class LocalFanoutJob(fanout.FanoutJob):
+    """
+    Every host is a directory, the files are copied locally.
+    """
+    root = None
+
+    def local_path(self, host):
+        return os.path.join(self.root, host, self.path)
+
+    def copy(self, source_path):
+        return jobs.BourneShell("sleep 0.1; mkdir -p $(dirname {0}) && cp {1} {0}".format(
+            self.local_path(self.host), source_path))
+
+    def origin_transfer(self):
+        return self.copy(self.url)
+
+    def peer_transfer(self, source):
+        return self.copy(self.local_path(source))
+
+
+class LocalFanoutStage(fanout.FanoutStage):
+    job_class = LocalFanoutJob
+
+
+class FanoutRunner(runners.Runner):
+
+    def __init__(self, hosts, url):
+        super(FanoutRunner, self).__init__()
+        self.hosts = hosts
+        self.url = url
+
+    def get_stages(self):
+        self.stage = LocalFanoutStage(self.hosts, "release.tar", self.url, origin_slots=2, fanout=2,
+                                      pool_params={'pool_size': 100})
+        yield self.stage
+
+
+def test_fanout_stage(tmpdir):
+    artifact = tmpdir.join("origin.tar")
+    artifact.write("boerewors")
+    LocalFanoutJob.root = str(tmpdir)
+    hosts = ["host{:02d}".format(idx) for idx in range(20)]
+    runner = FanoutRunner(hosts, str(artifact))
+    executor = BoereworsExecutor(runners=[runner])
+    assert executor.run([])
+
+    for host in hosts:
+        assert tmpdir.join(host, "release.tar").read() == "boerewors"
+    assert sorted(runner.stage.sources.sources) == hosts
+    jobs_by_source = [job.source for job in runner.stage._joblist]
+    # most hosts got the artifact from a peer
+    assert jobs_by_source.count(None) < len(hosts) / 2
+
+
+class BrokenFanoutJob(LocalFanoutJob):
+
+    def origin_transfer(self):
+        return jobs.BourneShell("exit 1")
+
+
+def test_failed_host_is_no_source(tmpdir):
+    LocalFanoutJob.root = str(tmpdir)
+    sources = fanout.SourceTracker(origin_slots=1, fanout=2)
+    job = BrokenFanoutJob("hosta", sources, "release.tar", str(tmpdir.join("origin.tar")))
+    while job.poll() is None:
+        pass
+    assert not job.was_successful()
+    assert sources.sources == []
+    # the slot of the origin is free again
+    assert sources.acquire() is None
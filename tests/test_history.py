@@ -0,0 +1,114 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from context import BoereworsExecutor, history, jobs, pool, runners, stage
+
+
+def test_median():
+    assert history.median([]) is None
+    assert history.median([3, 1, 2]) == 2
+    assert history.median([4, 1, 2, 3]) == 2.5
+
+
+def test_format_duration():
+    assert history.format_duration(5) == "5s"
+    assert history.format_duration(125) == "2m 05s"
+    assert history.format_duration(7300) == "2h 01m"
+
+
+def test_duration_history(tmpdir):
+    path = str(tmpdir.join("history.sqlite"))
+    store = history.DurationHistory(path, samples=3)
+    for duration in (10, 20, 30, 1000):
+        store.record("release", "stage.1", "hosta", duration)
+    store.record("release", "stage.1", "hostb", 5)
+    store.record("release", "stage.1", "hostb", 500, success=False)
+    store.record("release", "stage.2", "hostb", 7)
+    store.close()
+
+    store = history.DurationHistory(path, samples=3)
+    expected, stage_median = store.load_stage("release", "stage.1")
+    # only the 3 most recent successful runs count
+    assert expected == {"hosta": 30, "hostb": 5}
+    assert stage_median == 17.5
+    assert store.load_stage("release", "unknown") == ({}, None)
+
+
+class HostJob(jobs.Job):
+
+    def __init__(self, host):
+        super(HostJob, self).__init__()
+        self.host = host
+
+    def run_job(self):
+        yield self.Ok()
+
+
+class HostStage(stage.Stage):
+
+    def get_jobs(self):
+        for host in ("hosta", "hostb", "hostc"):
+            yield HostJob(host)
+
+
+class HostRunner(runners.Runner):
+
+    def get_stages(self):
+        yield HostStage()
+
+
+def test_progress_tracker():
+    my_stage = HostStage()
+    tracker = history.ProgressTracker(my_stage, pool_size=2, min_samples=1)
+    tracker.expected = {"hosta": 10.0, "hostb": 20.0}
+    tracker.stage_median = 15.0
+    job_list = list(my_stage.jobs)
+    for job in job_list:
+        tracker.add_job(job)
+    assert [job.expected_duration for job in job_list] == [10.0, 20.0, 15.0]
+    assert tracker.eta == 45.0 / 2
+
+    job_list[0].started_at, job_list[0].finished_at = 0.0, 30.0
+    job_list[0].get_result()
+    tracker.task_finished(None, job_list[0])
+    # the finished job was 3 times slower than its history
+    assert tracker.trend == 3.0
+    assert tracker.eta == 35.0 * 3 / 2
+    assert tracker._warned
+
+
+def test_progress_is_reported_by_the_pool(monkeypatch):
+    my_stage = HostStage()
+    tracker = history.ProgressTracker(my_stage, report_interval=0.1)
+    reports = []
+    monkeypatch.setattr(tracker, "report", lambda: reports.append(tracker.finished_jobs))
+    tasks = pool.Pool(pool_size=1)
+    tasks.add_listener(tracker)
+    sleeper = jobs.BourneShell("sleep 0.35")
+    tracker.add_job(sleeper)
+    tasks.add_task(sleeper)
+    tasks.run()
+    # no job finished yet, the progress is logged anyway
+    assert reports[:3] == [0, 0, 0]
+
+
+def test_executor_records_history(tmpdir):
+    path = str(tmpdir.join("history.sqlite"))
+    executor = BoereworsExecutor(runners=[HostRunner()])
+    assert executor.run(["--history", path])
+
+    store = history.DurationHistory(path)
+    expected, _ = store.load_stage("host_runner", "root.host_runner.host_stage.1")
+    assert sorted(expected) == ["hosta", "hostb", "hostc"]
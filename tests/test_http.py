@@ -0,0 +1,178 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from context import pool
+from boerewors import http as boerewors_http
+from boerewors.errors import HttpException
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = []
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        Handler.connections.append(self.client_address)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for part in (b"hello ", b"chunked ", b"world"):
+                self.wfile.write("{:x}\r\n".format(len(part)).encode('ascii') + part + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        if self.path == "/slow":
+            time.sleep(1)
+        status = int(self.path.split("/")[2]) if self.path.startswith("/status/") else 200
+        body = "{} {}".format(self.path, self.headers.get("Host")).encode('utf8')
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == "/close":
+            # close the connection without telling the client
+            self.close_connection = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(201)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    Handler.connections = []
+    httpd = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:{}".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_parse_url():
+    assert boerewors_http.parse_url("http://web-1/health?full=1") == (("http", "web-1", 80), "/health?full=1")
+    assert boerewors_http.parse_url("https://web-1:8443") == (("https", "web-1", 8443), "/")
+    with pytest.raises(HttpException):
+        boerewors_http.parse_url("ftp://web-1/")
+
+
+def test_parser_in_pieces():
+    response = b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" \
+               b"5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n"
+    parser = boerewors_http.ResponseParser()
+    done = [parser.feed(response[idx:idx + 3]) for idx in range(0, len(response), 3)]
+    assert done[-1] and not any(done[:-1])
+    assert parser.get_response().status == 200
+    assert parser.get_response().body == b"hello world"
+    assert parser.buffer == b""
+
+
+def test_keep_alive_pool(server):
+    connections = boerewors_http.HttpConnectionPool(max_per_origin=3)
+    my_pool = pool.Pool(pool_size=20)
+    http_jobs = [boerewors_http.HttpJob("{}/health/{}".format(server, idx), connections=connections)
+                 for idx in range(60)]
+    for job in http_jobs:
+        my_pool.add_task(job)
+    my_pool.run()
+    assert all(my_pool.results)
+    assert http_jobs[7].get_result('text') == u"/health/7 {}".format(server.split("//")[1])
+    # 60 requests over 3 connections
+    assert len(Handler.connections) == 3
+
+
+def test_status_and_body(server):
+    failed = boerewors_http.HttpJob(server + "/status/503")
+    with pytest.raises(HttpException):
+        failed.get_result()
+    assert not failed.was_successful()
+    assert failed.get_result('status', can_fail=True) == 503
+
+    expected = boerewors_http.HttpJob(server + "/status/503", expected_status=[503])
+    assert expected.get_result('status') == 503
+
+    connections = boerewors_http.HttpConnectionPool()
+    for _ in range(2):
+        chunked = boerewors_http.HttpJob(server + "/chunked", connections=connections)
+        assert chunked.get_result('body') == b"hello chunked world"
+    assert len(connections.idle[chunked.origin]) == 1
+
+    post = boerewors_http.HttpJob(server + "/", method="POST", body=u"payload", headers={'host': "www.example.com"})
+    assert post.get_result('status') == 201
+    assert post.get_result('text') == u"payload"
+
+
+def test_closed_idle_connection(server):
+    connections = boerewors_http.HttpConnectionPool()
+    first = boerewors_http.HttpJob(server + "/close", connections=connections)
+    assert first.get_result('status') == 200
+    time.sleep(0.1)
+    second = boerewors_http.HttpJob(server + "/health", connections=connections)
+    assert second.get_result('status') == 200
+    assert len(Handler.connections) == 2
+
+
+class ReusedConnection(object):
+    requests = 1
+
+
+def test_only_idempotent_requests_are_retried():
+    for method, retried in [("GET", True), ("PUT", True), ("POST", False), ("PATCH", False)]:
+        job = boerewors_http.HttpJob("http://web-1/deploy", method=method)
+        # the server closed the reused connection while the request was sent
+        job.connection = ReusedConnection()
+        job._state = 'sending'
+        job._parser = boerewors_http.ResponseParser()
+        assert job.can_retry() is retried
+
+
+def test_timeout(server):
+    slow = boerewors_http.HttpJob(server + "/slow", timeout=0.2)
+    my_pool = pool.Pool()
+    my_pool.add_task(slow)
+    my_pool.run()
+    assert slow.timed_out()
+    assert not slow.was_successful()
+
+
+def test_connection_refused(server):
+    port = int(server.rsplit(":", 1)[1])
+    refused = boerewors_http.HttpJob("http://127.0.0.1:{}/".format(port + 1 if port < 65535 else port - 1))
+    refused.get_result(can_fail=True)
+    assert isinstance(refused._exception, HttpException)
@@ -0,0 +1,166 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+from argparse import ArgumentTypeError
+
+import pytest
+from context import BoereworsExecutor, inventory, jobs, runners, stage
+from boerewors.errors import ConfigNotFoundException
+
+INVENTORY = """
+# host attributes
+web01 dc=ams role=web tags=canary,ssd
+web02 dc=ams role=web
+web03 dc=fra role=web tags=ssd
+db01 dc=ams role=db tags=ssd
+"""
+
+
+@pytest.fixture
+def inventory_file(tmpdir):
+    path = tmpdir.join("hosts.txt")
+    path.write(INVENTORY)
+    return str(path)
+
+
+def test_select(inventory_file):
+    hosts = inventory.Inventory.load(inventory_file)
+    assert list(hosts) == ["web01", "web02", "web03", "db01"]
+    assert hosts.select("dc=ams,role=web") == ["web01", "web02"]
+    assert hosts.select("dc=ams|fra,tag=ssd") == ["web01", "web03", "db01"]
+    assert hosts.select(role="db") == ["db01"]
+    assert hosts.select(tag="missing") == []
+    assert hosts.select("host=web02|unknown") == ["web02"]
+    with pytest.raises(ValueError):
+        hosts.select("rack=1")
+
+
+def test_parse_json(tmpdir):
+    path = tmpdir.join("hosts.json")
+    path.write('{"hosts": [{"host": "web01", "dc": "ams", "tags": ["canary"]}]}')
+    hosts = inventory.Inventory.load(str(path))
+    assert hosts.select(tag="canary") == ["web01"]
+    assert hosts.get("web01")["dc"] == "ams"
+    # json needs no parsing, there is no cache to keep up to date
+    assert tmpdir.listdir() == [path]
+    # selectors are unicode on python 2
+    assert hosts.select(u"dc=ams") == ["web01"]
+
+
+def test_cache(inventory_file, monkeypatch):
+    inventory.Inventory.load(inventory_file)
+    cache_path = os.path.join(os.path.dirname(inventory_file), ".hosts.txt.cache")
+    assert os.path.exists(cache_path)
+
+    parsed = []
+    parse = inventory.Inventory.parse
+    monkeypatch.setattr(inventory.Inventory, "parse", staticmethod(lambda *args: parsed.append(1) or parse(*args)))
+
+    # same mtime and size
+    assert len(inventory.Inventory.load(inventory_file)) == 4
+    # touched, but the content did not change
+    os.utime(inventory_file, (1, 1))
+    assert len(inventory.Inventory.load(inventory_file)) == 4
+    assert parsed == []
+
+    with open(inventory_file, "a") as inventory_handle:
+        inventory_handle.write("web04 dc=fra role=web\n")
+    assert len(inventory.Inventory.load(inventory_file)) == 5
+    assert parsed == [1]
+
+
+def test_cache_is_json(inventory_file):
+    inventory.Inventory.load(inventory_file)
+    cache_path = os.path.join(os.path.dirname(inventory_file), ".hosts.txt.cache")
+    with open(cache_path) as cache_file:
+        cached = json.load(cache_file)
+    assert [host["host"] for host in cached["hosts"]] == ["web01", "web02", "web03", "db01"]
+
+    # a cache that is not what we wrote is ignored, e.g. a pickle of an older version
+    with open(cache_path, "wb") as cache_file:
+        cache_file.write(b"\x80\x04garbage")
+    assert len(inventory.Inventory.load(inventory_file)) == 4
+    cached["hosts"] = "web01"
+    with open(cache_path, "w") as cache_file:
+        json.dump(cached, cache_file)
+    assert len(inventory.Inventory.load(inventory_file)) == 4
+
+
+def test_missing_inventory(tmpdir):
+    with pytest.raises(ConfigNotFoundException):
+        inventory.Inventory.load(str(tmpdir.join("missing")))
+
+
+def test_parse_arguments():
+    assert inventory.parse_shard("2/4") == (1, 4)
+    with pytest.raises(ArgumentTypeError):
+        inventory.parse_shard("5/4")
+    assert inventory.parse_limit("3") == 3
+    assert inventory.parse_limit("dc=ams|fra,tag=ssd") == {"dc": ["ams", "fra"], "tag": ["ssd"]}
+    with pytest.raises(ArgumentTypeError):
+        inventory.parse_limit("dc")
+
+
+class HostJob(jobs.Job):
+
+    def __init__(self, host):
+        super(HostJob, self).__init__()
+        self.host = host
+
+    def run_job(self):
+        yield self.Ok()
+
+
+class HostStage(stage.Stage):
+
+    def __init__(self, hosts):
+        super(HostStage, self).__init__()
+        self.hosts = hosts
+
+    def get_jobs(self):
+        for host in self.hosts:
+            yield HostJob(host)
+
+
+class InventoryRunner(runners.Runner):
+
+    def get_stages(self):
+        self.stage = HostStage(list(self.inventory))
+        yield self.stage
+
+
+def run_hosts(inventory_file, argv):
+    runner = InventoryRunner()
+    executor = BoereworsExecutor(runners=[runner], inventory=inventory_file)
+    assert executor.run(argv)
+    return [job.host for job in runner.stage._joblist]
+
+
+def test_limit_and_shard(inventory_file):
+    assert run_hosts(inventory_file, []) == ["web01", "web02", "web03", "db01"]
+    assert run_hosts(inventory_file, ["--limit", "role=web,tag=ssd"]) == ["web01", "web03"]
+    assert run_hosts(inventory_file, ["--limit", "2"]) == ["web01", "web02"]
+
+    shards = [run_hosts(inventory_file, ["--shard", "{}/3".format(idx)]) for idx in range(1, 4)]
+    assert sorted(sum(shards, [])) == sorted(["web01", "web02", "web03", "db01"])
+    # the split is stable
+    assert shards == [run_hosts(inventory_file, ["--shard", "{}/3".format(idx)]) for idx in range(1, 4)]
+
+
+def test_selector_needs_inventory():
+    executor = BoereworsExecutor(runners=[InventoryRunner()])
+    assert not executor.run(["--limit", "dc=ams"])
@@ -0,0 +1,160 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+
+from context import BoereworsExecutor, jobs, journal, pool, runners, stage
+
+
+def test_journal(tmpdir):
+    path = str(tmpdir.join("journal.jsonl"))
+    assert journal.Journal.last_run_id(path) is None
+
+    my_journal = journal.Journal(path, "run-1", sync_every=2)
+    my_journal.write("job", stage="s", job="hosta", status="error")
+    my_journal.write("job", stage="s", job="hosta", status="ok")
+    my_journal.write("job", stage="s", job="hostb", status="timeout")
+    my_journal.close()
+    other = journal.Journal(path, "run-2")
+    other.write("job", stage="s", job="hostb", status="ok")
+    other.close()
+    # a controller that died while writing
+    with io.open(path, 'a', encoding='utf8') as journal_file:
+        journal_file.write(u'{"run_id": "run-3", "ty')
+
+    assert journal.Journal.last_run_id(path) == "run-2"
+    assert journal.Journal.load_outcomes(path, "run-1") == {("s", "hosta"): "ok", ("s", "hostb"): "timeout"}
+
+
+class SlowJob(jobs.Job):
+
+    def __init__(self, path):
+        super(SlowJob, self).__init__()
+        self.path = path
+        self.recorded = None
+
+    def run_job(self):
+        yield jobs.BourneShell("sleep 0.3")
+        # the record of the job that finished first is on the disk while this one still runs
+        with io.open(self.path, encoding='utf8') as journal_file:
+            self.recorded = len(journal_file.readlines())
+        yield self.Ok()
+
+
+def test_journal_is_synced_on_the_tick(tmpdir):
+    path = str(tmpdir.join("journal.jsonl"))
+    my_journal = journal.Journal(path, "run-1", sync_every=100, sync_interval=0.1)
+    slow = SlowJob(path)
+    tasks = pool.Pool(pool_size=2)
+    tasks.add_listener(journal.JournalRecorder(my_journal, stage.Stage()))
+    tasks.add_task(jobs.BourneShell("true"))
+    tasks.add_task(slow)
+    tasks.run()
+    my_journal.close()
+    assert slow.recorded == 1
+
+
+class HostJob(jobs.Job):
+    executed = []
+    failing = set()
+
+    def __init__(self, host, step=None):
+        super(HostJob, self).__init__()
+        self.host = host
+        self.step = step
+
+    @property
+    def label(self):
+        return self.host if self.step is None else "{}:{}".format(self.host, self.step)
+
+    def run_job(self):
+        HostJob.executed.append(self.label)
+        if self.label in HostJob.failing:
+            yield self.Error("broken")
+        yield self.Ok()
+
+
+class HostStage(stage.Stage):
+    can_fail = True
+
+    def get_jobs(self):
+        for host in ("hosta", "hostb", "hostc", "hostd"):
+            yield HostJob(host)
+
+
+class StepStage(stage.Stage):
+    can_fail = True
+    is_canary = False
+
+    def get_jobs(self):
+        for host in ("hosta", "hostb"):
+            for step in ("stop", "start"):
+                yield HostJob(host, step)
+
+
+class HostRunner(runners.Runner):
+
+    stage_class = HostStage
+
+    def get_stages(self):
+        yield self.stage_class()
+
+
+def run(argv, failing=(), stage_class=HostStage):
+    HostJob.executed = []
+    HostJob.failing = set(failing)
+    runner = HostRunner()
+    runner.stage_class = stage_class
+    executor = BoereworsExecutor(runners=[runner])
+    return executor.run(argv)
+
+
+def test_resume(tmpdir):
+    path = str(tmpdir.join("journal.jsonl"))
+    run(["--journal", path, "--run-id", "release-1"], failing=["hostb"])
+    assert HostJob.executed == ["hosta", "hostb", "hostc", "hostd"]
+
+    # hosta is done, hostb is the new canary
+    assert run(["--journal", path, "--resume"], failing=["hostc"])
+    assert HostJob.executed == ["hostb"]
+
+    assert journal.Journal.last_run_id(path) == "release-1"
+
+
+def test_retry_failed(tmpdir):
+    path = str(tmpdir.join("journal.jsonl"))
+    run(["--journal", path, "--run-id", "release-1", "--limit", "3"], failing=["hostb"])
+    assert HostJob.executed == ["hosta", "hostb", "hostc"]
+
+    run(["--journal", path, "--run-id", "release-1", "--retry-failed"])
+    assert HostJob.executed == ["hostb"]
+
+    run(["--journal", path, "--run-id", "release-1", "--resume"])
+    assert HostJob.executed == ["hostd"]
+
+
+def test_resume_needs_journal():
+    assert not run(["--resume"])
+    assert HostJob.executed == []
+
+
+def test_resume_jobs_of_one_host(tmpdir):
+    path = str(tmpdir.join("journal.jsonl"))
+    run(["--journal", path, "--run-id", "release-1"], failing=["hosta:start"], stage_class=StepStage)
+    assert sorted(HostJob.executed) == ["hosta:start", "hosta:stop", "hostb:start", "hostb:stop"]
+
+    # hosta:stop succeeded, that does not make hosta:start done
+    assert run(["--journal", path, "--resume"], stage_class=StepStage)
+    assert HostJob.executed == ["hosta:start"]
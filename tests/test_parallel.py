@@ -0,0 +1,127 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from subprocess import PIPE
+
+from context import jobs, pool, ratelimit
+from boerewors.errors import JobCancelled, JobTimeout
+from boerewors.helper import monotonic
+
+
+class DeployJob(jobs.Job):
+
+    def __init__(self, commands, fail_fast=False):
+        super(DeployJob, self).__init__()
+        self.commands = commands
+        self.fail_fast = fail_fast
+        self.outputs = None
+
+    def run_job(self):
+        yield jobs.Parallel([jobs.PopenJob(command, stdout=PIPE) for command in self.commands],
+                            fail_fast=self.fail_fast)
+        self.outputs = [job.get_result('stdout') for job in self.sub_task.jobs]
+        yield self.Ok(self.get_subtask_result())
+
+
+def run(job):
+    my_pool = pool.Pool(pool_size=1)
+    my_pool.add_task(job)
+    started = monotonic()
+    my_pool.run()
+    return monotonic() - started
+
+
+def test_parallel():
+    job = DeployJob([["sh", "-c", "sleep 0.5; echo download"], ["sh", "-c", "sleep 0.5; echo cleanup"]])
+    duration = run(job)
+    assert job.was_successful()
+    # both steps ran at the same time in the one slot of the pool
+    assert duration < 0.9
+    assert job.get_result().value == [0, 0]
+    assert job.outputs == ["download\n", "cleanup\n"]
+
+
+def test_failure_waits_for_all():
+    job = DeployJob([["false"], ["sh", "-c", "sleep 0.3; echo done"]])
+    run(job)
+    assert not job.was_successful()
+    assert job.outputs is None
+    # the other subtask was not stopped
+    assert job.sub_task.jobs[1].was_successful()
+
+
+def test_fail_fast():
+    job = DeployJob([["false"], ["sleep", "10"]], fail_fast=True)
+    duration = run(job)
+    assert not job.was_successful()
+    assert duration < 5
+    assert not job.sub_task.jobs[1].was_successful()
+
+
+def test_timed_out_subtask_fails_the_job():
+    class TimeoutJob(jobs.Job):
+        def run_job(self):
+            yield jobs.Parallel([jobs.PopenJob(["sleep", "10"], timeout=0.2), jobs.PopenJob(["true"])])
+            yield self.Ok(self.get_subtask_result())
+
+    job = TimeoutJob()
+    duration = run(job)
+    assert duration < 5
+    assert not job.was_successful()
+    assert job.timed_out()
+    results = job.sub_task.get_result(can_fail=True)
+    assert isinstance(results[0], JobTimeout)
+    assert results[1] == 0
+
+
+class WaitForTokens(jobs.Job):
+
+    def run_job(self):
+        yield ratelimit.RateLimit({'parallel-test': 1})
+        yield self.Ok()
+
+
+def test_fail_fast_cancels_other_jobs():
+    # the only token is gone, the next one comes in 100s
+    ratelimit.register('parallel-test', 0.01, capacity=1).tokens = 0
+    waiting = WaitForTokens()
+
+    class MixedJob(jobs.Job):
+        def run_job(self):
+            yield jobs.Parallel([jobs.PopenJob(["false"]), waiting], fail_fast=True)
+            yield self.Ok(self.get_subtask_result())
+
+    job = MixedJob()
+    try:
+        duration = run(job)
+    finally:
+        del ratelimit.limiters['parallel-test']
+    assert duration < 5
+    assert not job.was_successful()
+    assert isinstance(waiting._exception, JobCancelled)
+    assert not waiting.was_successful()
+
+
+def test_get_result_does_not_spin():
+    group = jobs.Parallel([jobs.PopenJob(["sleep", "0.3"]), jobs.PopenJob(["sleep", "0.3"])])
+    cpu_started = os.times()[0]
+    assert group.get_result() == [0, 0]
+    assert os.times()[0] - cpu_started < 0.15
+
+
+def test_skipped_parallel_is_successful():
+    group = jobs.Parallel([jobs.PopenJob(["false"])])
+    group.skip("done already")
+    assert group.was_successful()
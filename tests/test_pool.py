@@ -0,0 +1,143 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+from context import jobs, pool
+from boerewors.helper import monotonic
+
+
+class KeyedJob(jobs.Job):
+    running = {}
+    peak = {}
+
+    def __init__(self, counter=3, **concurrency_keys):
+        super(KeyedJob, self).__init__()
+        self.counter = counter
+        self.concurrency_keys = concurrency_keys
+
+    def run_job(self):
+        for key in self.concurrency_keys.items():
+            KeyedJob.running[key] = KeyedJob.running.get(key, 0) + 1
+            KeyedJob.peak[key] = max(KeyedJob.peak.get(key, 0), KeyedJob.running[key])
+        while self.counter > 0:
+            self.counter -= 1
+            yield True
+        for key in self.concurrency_keys.items():
+            KeyedJob.running[key] -= 1
+        yield self.Ok()
+
+
+def test_concurrency_limits():
+    KeyedJob.running.clear()
+    KeyedJob.peak.clear()
+    my_pool = pool.Pool(pool_size=10, concurrency_limits={'lb_pool': 2, 'dc': 3})
+    for idx in range(20):
+        my_pool.add_task(KeyedJob(lb_pool='web-{}'.format(idx % 2), dc='ams', rack=idx))
+    for idx in range(5):
+        my_pool.add_task(KeyedJob(dc='sfo'))
+    my_pool.run()
+
+    assert len(my_pool.finished_tasks) == 25
+    assert all(my_pool.results)
+    assert KeyedJob.peak[('dc', 'ams')] == 3
+    assert KeyedJob.peak[('dc', 'sfo')] == 3
+    assert KeyedJob.peak[('lb_pool', 'web-0')] == 2
+    assert KeyedJob.peak[('lb_pool', 'web-1')] == 2
+
+
+def test_blocked_tasks_are_skipped():
+    my_pool = pool.Pool(pool_size=2, concurrency_limits={'lb_pool': 1})
+    slow = KeyedJob(counter=10, lb_pool='a')
+    blocked = KeyedJob(counter=1, lb_pool='a')
+    other = KeyedJob(counter=1, lb_pool='b')
+    for job in (slow, blocked, other):
+        my_pool.add_task(job)
+    my_pool.run()
+    # the blocked job did not stall the pool, the job behind it could run
+    assert list(my_pool.finished_tasks) == [other, slow, blocked]
+
+
+def test_callable_limit_drops_to_zero():
+    # the first job closes the key for a while, no job of the key runs when it opens again
+    closed = dict(until=None)
+
+    def limit():
+        return 0 if closed['until'] is not None and monotonic() < closed['until'] else 1
+
+    class ClosingJob(KeyedJob):
+        def run_job(self):
+            closed['until'] = monotonic() + 0.3
+            return super(ClosingJob, self).run_job()
+
+    started = monotonic()
+    my_pool = pool.Pool(pool_size=3, concurrency_limits={'lb_pool': limit}, deadline=monotonic() + 5)
+    tasks = [ClosingJob(counter=1, lb_pool='a')] + [KeyedJob(counter=1, lb_pool='a') for _ in range(2)]
+    for task in tasks:
+        my_pool.add_task(task)
+    my_pool.run()
+    assert all(task.was_successful() for task in tasks)
+    assert 0.3 <= monotonic() - started < 2
+
+
+def test_invalid_limit():
+    with pytest.raises(ValueError):
+        pool.Pool(concurrency_limits={'dc': 0})
+
+
+def test_priority_queue():
+    queue = pool.PriorityQueue()
+    tasks = [jobs.Job() for _ in range(5)]
+    tasks[1].priority = 1
+    tasks[2].expected_duration = 60
+    tasks[3].expected_duration = 120
+    for task in tasks:
+        queue.append(task)
+    assert len(queue) == 5
+    assert list(queue) == [tasks[1], tasks[3], tasks[2], tasks[0], tasks[4]]
+
+    first = queue.popleft()
+    second = queue.popleft()
+    assert (first, second) == (tasks[1], tasks[3])
+    # a task that is put back keeps its position
+    queue.appendleft(second)
+    assert queue.popleft() is tasks[3]
+    assert [queue.popleft() for _ in range(3)] == [tasks[2], tasks[0], tasks[4]]
+    assert not queue
+    with pytest.raises(IndexError):
+        queue.popleft()
+
+    # the finished tasks are gone, new tasks (that may get their ids) queue up behind each other
+    del tasks[:], first, second
+    tasks = [jobs.Job() for _ in range(5)]
+    for task in tasks:
+        queue.append(task)
+    assert list(queue) == tasks
+
+
+def test_priority_scheduling():
+    my_pool = pool.Pool(pool_size=1, scheduling='priority')
+    short = KeyedJob(counter=1)
+    short.expected_duration = 1
+    long = KeyedJob(counter=1)
+    long.expected_duration = 100
+    important = KeyedJob(counter=1)
+    important.priority = 10
+    for job in (short, long, important):
+        my_pool.add_task(job)
+    my_pool.run()
+    assert list(my_pool.finished_tasks) == [important, long, short]
+
+    with pytest.raises(ValueError):
+        pool.Pool(scheduling='random')
@@ -53,6 +53,15 @@ def test_poll():
     assert echo.was_successful()
 
 
+def test_expired_after_exit():
+    # the process exited with 0, but the job timed out before it was polled
+    echo = jobs.PopenJob(["true"])
+    while echo.poll() is None:
+        pass
+    echo.expire()
+    assert not echo.was_successful()
+
+
 def test_callback():
     echo = jobs.PopenJob(["echo", "lol"], stdout=PIPE)
     echo.set_callback(lambda x: print(x.get_result('stdout')))
@@ -0,0 +1,150 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import pytest
+
+from context import BoereworsExecutor, jobs, prefetch, runners, stage
+
+
+class LookupStage(stage.Stage):
+    is_canary = False
+    can_prefetch = True
+
+    def __init__(self, command="sleep 0.3", count=4, lookup=0.1):
+        super(LookupStage, self).__init__()
+        self.command = command
+        self.count = count
+        self.lookup = lookup
+        self.built = 0
+        self.lookup_started = None
+        self.cleaned_up = None
+
+    def get_jobs(self):
+        self.lookup_started = time.time()
+        for _ in range(self.count):
+            # e.g. a call to the inventory
+            time.sleep(self.lookup)
+            self.built += 1
+            yield jobs.BourneShell(self.command)
+
+    def cleanup(self, errors):
+        self.cleaned_up = time.time()
+        super(LookupStage, self).cleanup(errors)
+
+
+class TwoStageRunner(runners.Runner):
+
+    def __init__(self, first, second):
+        super(TwoStageRunner, self).__init__()
+        self.first = first
+        self.second = second
+
+    def get_stages(self):
+        yield self.first
+        yield self.second
+
+
+def test_prefetch_next_stage():
+    runner = TwoStageRunner(LookupStage(), LookupStage())
+    assert BoereworsExecutor(runners=[runner]).run(["--prefetch", "10"])
+    # the jobs of the second stage were looked up while the first one ran
+    assert runner.second.lookup_started < runner.first.cleaned_up
+    assert len(runner.second._joblist) == 4
+    assert all(job.was_successful() for job in runner.second._joblist)
+
+
+def test_limit_drops_buffered_jobs():
+    runner = TwoStageRunner(LookupStage(count=1), LookupStage(command="true", count=10, lookup=0))
+    assert BoereworsExecutor(runners=[runner]).run(["--prefetch", "5", "--limit", "2"])
+    # the jobs after the limit were buffered, finish_stage dropped them
+    started = [job for job in runner.second._joblist if job.proc is not None]
+    assert len(started) == 2
+    assert len(runner.second._joblist) > 2
+    assert runner.second.built < 10
+
+
+def test_jobs_are_prefetched_on_opt_in():
+    first, second = LookupStage(count=1), stage.Stage()
+    second.get_jobs = lambda: iter([jobs.BourneShell("true")])
+    prefetcher = prefetch.StagePrefetcher([first, second], buffer_size=10)
+    stages = iter(prefetcher)
+    next(stages)
+    list(prefetcher.get_jobs(first))
+    assert next(stages) is second
+    # a plain stage did not opt in, only the stage was built ahead
+    assert id(second) not in prefetcher._prefetched
+    assert len(list(prefetcher.get_jobs(second))) == 1
+    prefetcher.close()
+
+
+def test_without_prefetch():
+    runner = TwoStageRunner(LookupStage(), LookupStage())
+    assert BoereworsExecutor(runners=[runner]).run([])
+    assert runner.second.lookup_started > runner.first.cleaned_up
+
+
+def test_failed_stage_stops_prefetch():
+    runner = TwoStageRunner(LookupStage(command="false"), LookupStage(count=100, lookup=0))
+    assert not BoereworsExecutor(runners=[runner]).run(["--prefetch", "5"])
+    # only the buffer was filled, none of the prefetched jobs ran
+    assert runner.second.built <= 7
+    assert all(job.proc is None for job in runner.second._joblist)
+
+
+def test_buffer_size():
+    first, second = LookupStage(), LookupStage(count=100, lookup=0)
+    prefetcher = prefetch.StagePrefetcher([first, second], buffer_size=3)
+    stages = iter(prefetcher)
+    assert next(stages) is first
+    assert len(list(prefetcher.get_jobs(first))) == 4
+    time.sleep(0.2)
+    # three jobs in the buffer and one waiting for a free place
+    assert second.built == 4
+    assert next(stages) is second
+    assert len(list(prefetcher.get_jobs(second))) == 100
+    with pytest.raises(StopIteration):
+        next(stages)
+    prefetcher.close()
+
+
+class BrokenStage(LookupStage):
+
+    def get_jobs(self):
+        yield jobs.BourneShell("true")
+        raise RuntimeError("inventory is down")
+
+
+class SetupStage(LookupStage):
+    can_prefetch = False
+
+
+def test_errors_and_opt_out():
+    first, broken, late = LookupStage(count=1), BrokenStage(), SetupStage(count=1)
+    prefetcher = prefetch.StagePrefetcher([first, broken, late], buffer_size=10, prepare=lambda stage: None)
+    stages = iter(prefetcher)
+    next(stages)
+    list(prefetcher.get_jobs(first))
+    assert next(stages) is broken
+    broken_jobs = prefetcher.get_jobs(broken)
+    next(broken_jobs)
+    # raised where the jobs are taken, like without prefetching
+    with pytest.raises(RuntimeError):
+        next(broken_jobs)
+    assert next(stages) is late
+    # a stage that opted out builds its jobs when they are taken
+    assert late.built == 0
+    assert len(list(prefetcher.get_jobs(late))) == 1
+    prefetcher.close()
@@ -0,0 +1,181 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import time
+
+import pytest
+from context import BoereworsExecutor, jobs, prewarm, runners, sharded_pool, stage
+
+warmed = []
+
+
+class LocalPrewarmJob(jobs.BourneShell):
+
+    def __init__(self, host, user=None, timeout=None):
+        super(LocalPrewarmJob, self).__init__("exit 1" if host == "down" else "true")
+        self.host = host
+        warmed.append(host)
+
+
+class LocalPrewarmer(prewarm.Prewarmer):
+    job_class = LocalPrewarmJob
+
+
+class HostJob(jobs.Job):
+
+    def __init__(self, host, user=None):
+        super(HostJob, self).__init__()
+        self.host = host
+        self.user = user
+
+    def run_job(self):
+        self.control_dir = self.ssh_control and self.ssh_control[0]
+        yield self.Ok()
+
+
+def test_prewarmer():
+    del warmed[:]
+    skipped = HostJob("skipped")
+    skipped.skip("done already")
+    upcoming = [HostJob("hosta"), HostJob("hosta"), HostJob("hosta", user="root"), HostJob("down"), skipped]
+    prewarmer = LocalPrewarmer(upcoming)
+    assert prewarmer.targets == [("hosta", None), ("hosta", "root"), ("down", None)]
+    prewarmer.start()
+    assert prewarmer.join(5) == ["down"]
+    assert warmed == ["hosta", "hosta", "down"]
+
+
+class HostStage(stage.Stage):
+
+    def get_jobs(self):
+        for idx in range(5):
+            yield HostJob("host{}".format(idx))
+
+
+class PrewarmRunner(runners.Runner):
+
+    def get_stages(self):
+        self.stage = HostStage()
+        yield self.stage
+
+
+def test_prewarm_during_canary(monkeypatch):
+    del warmed[:]
+    monkeypatch.setattr(prewarm.Prewarmer, "job_class", LocalPrewarmJob)
+    runner = PrewarmRunner()
+    executor = BoereworsExecutor(runners=[runner])
+    assert executor.run(["--prewarm"])
+    # every host but the canary is warmed up
+    assert sorted(warmed) == ["host1", "host2", "host3", "host4"]
+    # the jobs of the run share a temporary directory for the ssh connections
+    control_dirs = set(job.control_dir for job in runner.stage._joblist)
+    assert len(control_dirs) == 1 and None not in control_dirs
+    assert jobs.SSHJob.control_dir is None
+
+
+def test_control_directory_exits_the_masters(monkeypatch):
+    exited = []
+
+    def exit_command(self, host, user):
+        exited.append((host, user))
+        return ["true"]
+
+    monkeypatch.setattr(prewarm.ControlDirectory, "exit_command", exit_command)
+    runner = PrewarmRunner()
+    assert BoereworsExecutor(runners=[runner]).run(["--prewarm"])
+    # the master connections stayed open during the run, the ones of every host are closed at its end
+    assert sorted(exited) == [("host{}".format(idx), jobs.SSHJob.user) for idx in range(5)]
+    assert jobs.SSHJob.control_persist == 60
+
+
+class SlowPrewarmJob(jobs.BourneShell):
+
+    def __init__(self, host, user=None, timeout=None):
+        super(SlowPrewarmJob, self).__init__("sleep 0.5")
+        self.host = host
+
+
+def test_prewarm_is_done_before_the_workers_fork(monkeypatch):
+    if sharded_pool.get_fork_context() is None:
+        pytest.skip("needs fork")
+    warming = []
+    run = sharded_pool.ShardedPool.run
+
+    def sharded_run(self):
+        warming.append([thread.name for thread in threading.enumerate() if thread.name == "boerewors-prewarm"])
+        return run(self)
+
+    monkeypatch.setattr(prewarm.Prewarmer, "job_class", SlowPrewarmJob)
+    monkeypatch.setattr(sharded_pool.ShardedPool, "run", sharded_run)
+    assert BoereworsExecutor(runners=[PrewarmRunner()]).run(["--prewarm", "--processes", "2"])
+    assert warming == [[]]
+
+
+class DeployJob(jobs.Job):
+
+    host = "hosta"
+
+    def run_job(self):
+        yield jobs.Parallel([jobs.SSHJob(self.host, "true")])
+        yield self.Ok()
+
+
+def test_control_persist():
+    with prewarm.ControlDirectory() as control_dir:
+        job = jobs.SSHJob("hosta", "true")
+        control_dir.add_job(job)
+        assert "ControlPersist=yes" in job.ssh_command
+        # the settings belong to the jobs of the run, not to SSHJob
+        assert jobs.SSHJob.control_dir is None
+        assert "ControlPersist=yes" not in jobs.SSHJob("hosta", "true").ssh_command
+
+        # the subtasks of a job connect the same way
+        deploy = DeployJob()
+        control_dir.add_job(deploy)
+        parallel = deploy.get_next_subtask()
+        parallel.start()
+        assert "ControlPersist=yes" in parallel.jobs[0].ssh_command
+    assert control_dir.path is None
+
+
+class CountingJob(jobs.PopenJob):
+    running = 0
+    most = 0
+
+    def start(self):
+        super(CountingJob, self).start()
+        CountingJob.running += 1
+        CountingJob.most = max(CountingJob.most, CountingJob.running)
+
+    def poll(self):
+        retval = super(CountingJob, self).poll()
+        if retval is not None:
+            CountingJob.running -= 1
+        return retval
+
+
+def test_run_processes_is_bounded():
+    started = time.time()
+    processes = [CountingJob(["sleep", "0.1"]) for _ in range(6)]
+    assert prewarm.run_processes(processes, 2, timeout=5) == []
+    assert CountingJob.most == 2
+    assert all(job.was_successful() for job in processes)
+    assert time.time() - started < 2
+
+    hanging = [jobs.PopenJob(["sleep", "10"]), jobs.PopenJob(["true"])]
+    assert prewarm.run_processes(hanging, 1, timeout=0.2) == hanging
+    assert hanging[0].proc.returncode is not None and not hanging[0].was_successful()
+    assert hanging[1].proc is None
@@ -0,0 +1,62 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+
+import pytest
+from context import jobs, pool
+
+pytestmark = pytest.mark.skipif(not jobs.process_pool_available(), reason="concurrent.futures is not available")
+
+
+def checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def explode():
+    raise ValueError("lol exception")
+
+
+class ChecksumJob(jobs.Job):
+
+    def run_job(self):
+        yield jobs.ProcessJob(checksum, b"boerewors")
+        self.checksum = self.get_subtask_result()
+        yield self.Ok()
+
+
+def test_processjob():
+    job = jobs.ProcessJob(checksum, b"boerewors")
+    assert not job.was_successful()
+    assert job.get_result() == hashlib.sha256(b"boerewors").hexdigest()
+    assert job.was_successful()
+
+
+def test_processjob_exception():
+    job = jobs.ProcessJob(explode)
+    with pytest.raises(ValueError):
+        job.get_result()
+    assert not job.was_successful()
+    assert job.get_result(can_fail=True) is None
+
+
+def test_processjob_as_subtask():
+    my_pool = pool.Pool()
+    for _ in range(3):
+        my_pool.add_task(ChecksumJob())
+    my_pool.run()
+    assert all(my_pool.results)
+    for job in my_pool.finished_tasks:
+        assert job.checksum == hashlib.sha256(b"boerewors").hexdigest()
+    jobs.shutdown_process_pool()
@@ -0,0 +1,122 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import logging
+import sys
+import threading
+
+from context import BoereworsExecutor, jobs, pool, profiling, runners, stage
+
+
+class SleepStage(stage.Stage):
+
+    def get_jobs(self):
+        for _ in range(4):
+            yield jobs.BourneShell("sleep 0.3; echo done")
+
+
+class ComputeJob(jobs.Job):
+
+    def run_job(self):
+        # work of the controller, e.g. rendering templates in the job
+        self.total = sum(range(5000))
+        yield self.Ok()
+
+
+class ComputeStage(stage.Stage):
+    is_canary = False
+
+    def get_jobs(self):
+        for _ in range(100):
+            yield ComputeJob()
+
+
+class ProfiledRunner(runners.Runner):
+
+    def __init__(self, stage_class):
+        super(ProfiledRunner, self).__init__()
+        self.stage_class = stage_class
+
+    def get_stages(self):
+        yield self.stage_class(pool_params=dict(pool_size=4))
+
+
+def profile(tmpdir, stage_class, argv=()):
+    path = str(tmpdir.join("profile.json"))
+    assert BoereworsExecutor(runners=[ProfiledRunner(stage_class)]).run(["--profile", path] + list(argv))
+    with io.open(path, encoding="utf-8") as report_file:
+        return json.load(report_file)
+
+
+def test_fleet_bottleneck(tmpdir):
+    originals = (pool.Pool.__dict__['run'], logging.Handler.__dict__['handle'])
+    report = profile(tmpdir, SleepStage)
+    assert report['bottleneck'] == "fleet"
+    assert report['counters']['finished_tasks'] == 4
+    # most polls find nothing to do while the hosts work
+    assert report['counters']['task_polls'] > 10 * report['counters']['finished_tasks']
+    assert report['counters']['pipe_reads_with_output'] >= 4
+    assert set(report['components']) == {'start', 'poll', 'pipes', 'logging', 'scheduler'}
+    assert report['components']['start']['calls'] == 4
+    assert [record['stage'] for record in report['stages']] == ["root.profiled_runner.sleep_stage.1"]
+    if sys.version_info >= (3, 4):
+        assert report['stages'][0]['memory']['peak'] > 0
+    # the profiler is gone after the run
+    assert (pool.Pool.__dict__['run'], logging.Handler.__dict__['handle']) == originals
+
+
+def test_controller_bottleneck(tmpdir):
+    report = profile(tmpdir, ComputeStage)
+    assert report['bottleneck'] == "controller"
+    assert report['counters']['finished_tasks'] == 100
+    assert report['components']['poll']['cpu'] > 0
+
+
+def test_sharded_run(tmpdir):
+    report = profile(tmpdir, SleepStage, ["--processes", "2"])
+    # the canary ran in a pool of the executor, the other tasks in the workers
+    assert report['counters']['finished_tasks'] == 4
+    assert report['components']['start']['calls'] == 1
+    # the loop of the sharded pool waited for the workers
+    assert report['pools_wall'] >= 0.3
+    assert report['bottleneck'] == "fleet"
+
+
+def test_stop_restores_methods():
+    originals = (pool.Pool.__dict__['poll_running_tasks'], jobs.PopenJob.__dict__['consume_pipes_non_blocking'])
+    profiler = profiling.Profiler(trace_memory=False).start()
+    my_pool = profiler.instrument(pool.Pool())
+    # only the instance is patched
+    assert pool.Pool.__dict__['poll_running_tasks'] is originals[0]
+    assert 'poll_running_tasks' in my_pool.__dict__
+    assert jobs.PopenJob.__dict__['consume_pipes_non_blocking'] is not originals[1]
+    profiler.stop()
+    assert (pool.Pool.__dict__['poll_running_tasks'], jobs.PopenJob.__dict__['consume_pipes_non_blocking']) == originals
+    assert profiler.get_report()['stages'] == []
+
+
+def test_background_threads_are_not_measured():
+    logger = logging.getLogger("profiling-test")
+    logger.addHandler(logging.NullHandler())
+    profiler = profiling.Profiler(trace_memory=False).start()
+    # e.g. the Prewarmer
+    thread = threading.Thread(target=lambda: logger.warning("from the background"))
+    thread.start()
+    thread.join()
+    assert profiler.components['logging'].calls == 0
+    logger.warning("from the controller")
+    assert profiler.components['logging'].calls > 0
+    profiler.stop()
@@ -0,0 +1,124 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from context import jobs, pool, ratelimit
+from boerewors.helper import monotonic
+
+
+@pytest.fixture(autouse=True)
+def limiters():
+    ratelimit.limiters.clear()
+    yield ratelimit.limiters
+    ratelimit.set_share(1.0)
+    ratelimit.limiters.clear()
+
+
+class QuickJob(jobs.Job):
+
+    def __init__(self, name, rate_limits=None):
+        super(QuickJob, self).__init__()
+        self.job_name = name
+        self.rate_limits = rate_limits
+        self.started = None
+
+    def run_job(self):
+        self.started = monotonic()
+        yield self.Ok()
+
+
+class DownloadJob(QuickJob):
+
+    def run_job(self):
+        yield ratelimit.RateLimit({'origin': 50})
+        self.started = monotonic()
+        yield self.Ok()
+
+
+def test_token_bucket():
+    bucket = ratelimit.TokenBucket(rate=10, capacity=2)
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == pytest.approx(0.1, abs=0.02)
+    # more than the capacity is granted once the bucket is full, it is in debt afterwards
+    big = ratelimit.TokenBucket(rate=100, capacity=10)
+    assert big.try_acquire(50) == 0
+    assert big.try_acquire(1) == pytest.approx(0.41, abs=0.02)
+
+    with pytest.raises(KeyError):
+        ratelimit.get_limiter('bastion')
+
+
+def test_all_or_nothing():
+    ssh = ratelimit.register('bastion', rate=10, capacity=1)
+    origin = ratelimit.register('origin', rate=10, capacity=5)
+    assert ratelimit.try_acquire_all(ratelimit.get_requests({'bastion': 1, 'origin': 5})) == 0
+    assert ratelimit.try_acquire_all(ratelimit.get_requests({'bastion': 1, 'origin': 1})) > 0
+    # nothing was taken from the origin while the bastion had no tokens
+    assert origin.tokens == pytest.approx(0, abs=0.1)
+    assert ssh.tokens < 1
+
+
+def test_pool_rate_limit():
+    ratelimit.register('bastion', rate=20, capacity=1)
+    limited = [QuickJob("ssh{}".format(idx), rate_limits={'bastion': 1}) for idx in range(6)]
+    others = [QuickJob("local{}".format(idx)) for idx in range(6)]
+    my_pool = pool.Pool(pool_size=2)
+    started = monotonic()
+    for job in limited + others:
+        my_pool.add_task(job)
+    my_pool.run()
+    assert all(my_pool.results)
+    starts = sorted(job.started - started for job in limited)
+    # 20 per second, the first one right away
+    assert starts[-1] == pytest.approx(0.25, abs=0.08)
+    for first, second in zip(starts, starts[1:]):
+        assert second - first > 0.03
+    # the waiting jobs did not hold the two slots
+    assert max(job.started - started for job in others) < 0.05
+
+
+def test_rate_limit_subtask():
+    ratelimit.register('origin', rate=100, capacity=50)
+    downloads = [DownloadJob("download{}".format(idx)) for idx in range(3)]
+    local = QuickJob("local")
+    my_pool = pool.Pool(pool_size=1)
+    started = monotonic()
+    for job in downloads + [local]:
+        my_pool.add_task(job)
+    my_pool.run()
+    assert all(my_pool.results)
+    starts = sorted(job.started - started for job in downloads)
+    assert starts[0] < 0.05
+    assert starts[2] == pytest.approx(1.0, abs=0.1)
+    # the parked downloads let the local job run in the only slot
+    assert local.started - started < 0.2
+
+
+def test_share():
+    bucket = ratelimit.register('bastion', rate=100, capacity=100)
+    ratelimit.set_share(0.25)
+    assert ratelimit.try_acquire_all([(bucket, 25)]) == 0
+    assert ratelimit.try_acquire_all([(bucket, 1)]) == pytest.approx(0.04, abs=0.01)
+    assert ratelimit.register('origin', rate=10).share == 0.25
+
+
+def test_pool_restores_the_share():
+    bucket = ratelimit.register('bastion', rate=100, capacity=100)
+    tasks = pool.Pool(pool_size=1, rate_limit_share=0.5)
+    tasks.add_task(QuickJob("deploy", rate_limits={'bastion': 1}))
+    tasks.run()
+    assert ratelimit.get_share() == 1.0
+    assert bucket.share == 1.0
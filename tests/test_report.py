@@ -0,0 +1,114 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import gc
+import io
+import json
+import weakref
+
+from context import BoereworsExecutor, jobs, pool, report, runners, stage
+
+
+class HostJob(jobs.Job):
+    alive = weakref.WeakSet()
+
+    def __init__(self, host, fail=False):
+        super(HostJob, self).__init__()
+        self.host = host
+        self.fail = fail
+        HostJob.alive.add(self)
+
+    def run_job(self):
+        if self.fail:
+            yield self.Error("disk full")
+        yield self.Ok(self.host)
+
+
+class HostStage(stage.Stage):
+    is_canary = False
+    keep_jobs = False
+
+    def __init__(self, failing=(), **kwargs):
+        super(HostStage, self).__init__(**kwargs)
+        self.failing = failing
+
+    def get_jobs(self):
+        for idx in range(20):
+            yield HostJob("host{}".format(idx), fail=idx in self.failing)
+
+
+class HostRunner(runners.Runner):
+
+    def __init__(self, failing=()):
+        super(HostRunner, self).__init__()
+        self.stage = HostStage(failing, pool_params=dict(pool_size=2))
+
+    def get_stages(self):
+        yield self.stage
+
+
+def test_results_do_not_poll_again():
+    class CountingJob(jobs.Job):
+        def run_job(self):
+            yield self.Ok()
+
+        def get_result(self, *args, **kwargs):
+            raise AssertionError("finished jobs are not polled again")
+
+    my_pool = pool.Pool()
+    my_pool.add_task(CountingJob())
+    my_pool.run()
+    assert list(my_pool.results) == [True]
+
+
+def test_streaming_report(tmpdir):
+    path = str(tmpdir.join("report.jsonl"))
+    records = []
+    alive = []
+
+    def on_record(record):
+        records.append(record)
+        gc.collect()
+        alive.append(len(HostJob.alive))
+
+    runner = HostRunner(failing=[3])
+    executor = BoereworsExecutor(runners=[runner], report=path, on_record=on_record)
+    assert not executor.run([])
+
+    with io.open(path, encoding="utf-8") as report_file:
+        written = [json.loads(line) for line in report_file]
+    assert written == records
+    job_records = [record for record in records if record['type'] == "job"]
+    assert len(job_records) == 20
+    assert records[-1]['type'] == "stage"
+    assert records[-1]['status'] == "error"
+    assert records[-1]['failed_jobs'] == 1
+    failed = [record for record in job_records if record['status'] == "error"]
+    assert [(record['host'], record['error']) for record in failed] == [("host3", "disk full")]
+    assert set(record['result'] for record in job_records if record['status'] == "ok") == \
+        set("host{}".format(idx) for idx in range(20) if idx != 3)
+
+    # the finished jobs were released while the stage ran
+    assert alive[10] < alive[0]
+    assert alive[-1] <= 2
+    assert runner.stage.collect_summary() == dict(failed_jobs=1, succeeded_jobs=19, timed_out_jobs=0)
+
+
+def test_broken_callback():
+    def broken(record):
+        raise ValueError("consumer went away")
+
+    executor = BoereworsExecutor(runners=[HostRunner()], on_record=broken)
+    assert executor.run([])
@@ -0,0 +1,80 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from context import jobs, pool, retry
+from boerewors.helper import monotonic
+
+
+class FlakyJob(jobs.Job):
+    max_retries = 3
+
+    def __init__(self, failures=1, **kw):
+        super(FlakyJob, self).__init__(**kw)
+        self.failures = failures
+        self.attempts = 0
+
+    def run_job(self):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            yield self.Error("try again later")
+        yield self.Ok()
+
+
+class QuickJob(jobs.Job):
+
+    def run_job(self):
+        yield self.Ok()
+
+
+def test_policy_delay():
+    policy = retry.RetryPolicy(delay=1, factor=2, max_delay=5, jitter=0)
+    assert [policy.get_delay(attempt) for attempt in range(1, 6)] == [1, 2, 4, 5, 5]
+
+    policy = retry.RetryPolicy(delay=1, factor=2, max_delay=None, jitter=0.5)
+    for _ in range(100):
+        assert 2 <= policy.get_delay(3) <= 4
+
+
+def test_delayed_retry_blocking():
+    job = FlakyJob(failures=2, retry_policy=retry.RetryPolicy(delay=0.05, jitter=0))
+    before = monotonic()
+    job.get_result()
+    # 0.05s after the first and 0.1s after the second failure
+    assert monotonic() - before >= 0.15
+    assert job.was_successful()
+    assert job.attempts == 3
+
+
+def test_no_retry_after_last_attempt():
+    job = FlakyJob(failures=3, retry_policy=retry.RetryPolicy(delay=10, jitter=0))
+    job.max_retries = 1
+    job.get_result()
+    assert not job.was_successful()
+    assert job.wakeup_at is None
+
+
+def test_delayed_retry_frees_pool_slot():
+    my_pool = pool.Pool(pool_size=1)
+    flaky = FlakyJob(failures=1, retry_policy=retry.RetryPolicy(delay=0.1, jitter=0))
+    my_pool.add_task(flaky)
+    quick_jobs = [QuickJob() for _ in range(3)]
+    for job in quick_jobs:
+        my_pool.add_task(job)
+    my_pool.run()
+
+    assert all(my_pool.results)
+    # the flaky job waited for its retry without blocking the only slot
+    assert list(my_pool.finished_tasks) == quick_jobs + [flaky]
+    assert flaky.attempts == 2
@@ -0,0 +1,164 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import time
+
+import pytest
+from context import BoereworsExecutor, jobs, runners, sharded_pool, stage
+
+pytestmark = pytest.mark.skipif(sharded_pool.get_fork_context() is None, reason="needs fork")
+
+
+class PidJob(jobs.Job):
+
+    state_attributes = jobs.Job.state_attributes + ('pid',)
+
+    def __init__(self, fail=False):
+        super(PidJob, self).__init__()
+        self.fail = fail
+        self.pid = None
+
+    def run_job(self):
+        self.pid = os.getpid()
+        yield jobs.BourneShell("exit {}".format(1 if self.fail else 0))
+        yield self.error_if_subtask_failed()
+        yield self.Ok(self.pid)
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.started = []
+        self.finished = []
+
+    def task_started(self, pool, task):
+        self.started.append(task)
+
+    def task_finished(self, pool, task):
+        self.finished.append(task)
+
+
+def test_sharded_pool():
+    tasks = [PidJob(fail=idx == 3) for idx in range(12)]
+    recorder = Recorder()
+    pool = sharded_pool.ShardedPool(processes=3, pool_size=6)
+    pool.add_listener(recorder)
+    for task in tasks:
+        pool.add_task(task)
+    pool.run()
+
+    assert len(pool.finished_tasks) == 12
+    assert len(recorder.started) == len(recorder.finished) == 12
+    assert list(pool.results).count(False) == 1
+    assert not tasks[3].was_successful()
+    assert tasks[0].get_result().value == tasks[0].pid
+    pids = set(task.pid for task in tasks)
+    assert len(pids) == 3 and os.getpid() not in pids
+
+
+def test_shards_by_concurrency_key():
+    pool = sharded_pool.ShardedPool(processes=4, concurrency_limits={'lb_pool': 1})
+    tasks = [PidJob() for _ in range(8)]
+    for idx, task in enumerate(tasks):
+        task.concurrency_keys = {'lb_pool': idx % 2}
+        pool.add_task(task)
+    pool.run()
+    assert all(pool.results)
+    for key in (0, 1):
+        assert len(set(task.pid for task in tasks[key::2])) == 1
+
+
+class PowerJob(jobs.Job):
+
+    def __init__(self, exponent):
+        super(PowerJob, self).__init__()
+        self.exponent = exponent
+
+    def run_job(self):
+        yield jobs.ProcessJob(pow, 2, self.exponent)
+        yield self.Ok(self.get_subtask_result())
+
+
+def test_process_jobs_in_shards():
+    pool = sharded_pool.ShardedPool(processes=2)
+    tasks = [PowerJob(exponent) for exponent in range(4)]
+    for task in tasks:
+        pool.add_task(task)
+    pool.run()
+    assert all(pool.results)
+    assert [task.get_result().value for task in tasks] == [1, 2, 4, 8]
+
+
+class CrashJob(jobs.Job):
+
+    def run_job(self):
+        os._exit(3)
+        yield self.Ok()
+
+
+def test_dead_worker():
+    pool = sharded_pool.ShardedPool(processes=2)
+    pool.check_interval = 0.1
+    tasks = [CrashJob(), PidJob()]
+    for task in tasks:
+        pool.add_task(task)
+    pool.run()
+    assert len(pool.finished_tasks) == 2
+    assert not tasks[0].was_successful()
+    assert isinstance(tasks[0]._exception, sharded_pool.ShardFailed)
+    assert tasks[1].was_successful()
+
+
+class SleepJob(jobs.Job):
+
+    def run_job(self):
+        yield jobs.BourneShell("sleep 0.3")
+        yield self.Ok()
+
+
+def test_dead_worker_is_noticed_while_others_report():
+    pool = sharded_pool.ShardedPool(processes=2, pool_size=2)
+    # longer than the test may take, the crash is noticed between the events of the other worker
+    pool.check_interval = 30
+    tasks = [CrashJob(), SleepJob(), CrashJob(), SleepJob(), CrashJob(), SleepJob()]
+    for task in tasks:
+        pool.add_task(task)
+    started = time.time()
+    pool.run()
+    assert time.time() - started < 10
+    assert len(pool.finished_tasks) == 6
+    assert [task.was_successful() for task in tasks] == [False, True] * 3
+
+
+class ShardedStage(stage.Stage):
+
+    def get_jobs(self):
+        for _ in range(6):
+            yield PidJob()
+
+
+class ShardedRunner(runners.Runner):
+
+    def get_stages(self):
+        self.stage = ShardedStage()
+        yield self.stage
+
+
+def test_executor_processes():
+    runner = ShardedRunner()
+    executor = BoereworsExecutor(runners=[runner])
+    assert executor.run(["--processes", "2"])
+    assert runner.stage.collect_summary()['succeeded_jobs'] == 6
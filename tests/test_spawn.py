@@ -0,0 +1,91 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import signal
+from subprocess import Popen, PIPE, STDOUT
+
+import pytest
+from context import jobs, spawn
+
+posix_spawn = pytest.mark.skipif(not hasattr(os, 'posix_spawnp'), reason="needs os.posix_spawnp")
+
+
+@pytest.fixture(params=['popen', pytest.param('posix_spawn', marks=posix_spawn)])
+def strategy(request):
+    old_strategy = spawn.strategy
+    spawn.set_strategy(request.param)
+    yield request.param
+    spawn.strategy = old_strategy
+
+
+def run(job):
+    while job.poll() is None:
+        pass
+    return job
+
+
+def test_output_and_returncode(strategy):
+    job = run(jobs.BourneShell("echo out; echo err >&2; exit 3"))
+    assert job.get_result('return', can_fail=True) == 3
+    assert job.get_result('stdout', can_fail=True) == "out\nerr\n"
+
+    job = run(jobs.PopenJob(["bash", "-c", "echo out; echo err >&2"], stdout=PIPE, stderr=PIPE))
+    assert job.get_result('stdout') == "out\n"
+    assert job.get_result('stderr') == "err\n"
+
+
+def test_new_session(strategy):
+    # processes that can time out run in a group of their own
+    job = run(jobs.BourneShell("ps -o pgid= -p $$", timeout=10))
+    assert int(job.get_result('stdout')) == job.proc.pid
+    job = run(jobs.BourneShell("ps -o pgid= -p $$"))
+    assert int(job.get_result('stdout')) == os.getpgid(0)
+
+
+def test_kill(strategy):
+    job = jobs.BourneShell("sleep 10")
+    job.start()
+    job.terminate()
+    assert run(job).get_result('return', can_fail=True) == -signal.SIGKILL
+
+
+@posix_spawn
+def test_restore_signals():
+    if not os.path.exists("/proc/self/status"):
+        pytest.skip("needs /proc")
+    proc = spawn.SpawnedProcess(["grep", "SigIgn", "/proc/self/status"], stdout=PIPE)
+    ignored = int(proc.stdout.read().split()[1], 16)
+    assert proc.wait() == 0
+    assert not ignored & (1 << (signal.SIGPIPE - 1))
+
+
+@posix_spawn
+def test_strategies(monkeypatch):
+    monkeypatch.setattr(spawn, "strategy", "posix_spawn")
+    proc = spawn.spawn(["true"], stdout=PIPE, stderr=STDOUT)
+    assert isinstance(proc, spawn.SpawnedProcess)
+    assert proc.wait() == 0
+    # posix_spawn can not change the directory
+    with pytest.raises(ValueError):
+        spawn.spawn(["true"], cwd="/")
+
+    monkeypatch.setattr(spawn, "strategy", "auto")
+    proc = spawn.spawn(["true"], cwd="/")
+    assert isinstance(proc, Popen)
+    assert proc.wait() == 0
+
+    with pytest.raises(ValueError):
+        spawn.set_strategy("fork")
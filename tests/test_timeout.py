@@ -0,0 +1,142 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+from context import jobs, pool, result, retry
+from boerewors.errors import JobTimeout
+from boerewors.helper import monotonic
+from boerewors.timers import TimerWheel
+
+
+def test_timer_wheel():
+    wheel = TimerWheel(resolution=0.1, slots=8, now=0)
+    wheel.schedule(0.25, "a")
+    wheel.schedule(0.35, "b")
+    # far beyond one round of the wheel
+    wheel.schedule(2.05, "c")
+    cancelled = wheel.schedule(0.3, "d")
+    wheel.cancel(cancelled)
+
+    assert wheel.expired(0.2) == []
+    assert wheel.expired(0.31) == ["a"]
+    assert wheel.expired(1.0) == ["b"]
+    assert wheel.expired(2.0) == []
+    assert wheel.expired(2.11) == ["c"]
+    assert wheel.expired(10) == []
+
+
+def test_timer_wheel_skipped_rounds():
+    wheel = TimerWheel(resolution=0.1, slots=8, now=0)
+    for idx in range(20):
+        wheel.schedule(idx * 0.1, idx)
+    assert sorted(wheel.expired(100)) == list(range(20))
+
+
+def test_popenjob_timeout():
+    job = jobs.PopenJob(["sleep", "10"], timeout=0.2)
+    my_pool = pool.Pool()
+    my_pool.add_task(job)
+    before = monotonic()
+    my_pool.run()
+    assert monotonic() - before < 2
+    assert list(my_pool.results) == [False]
+    assert job.timed_out()
+    with pytest.raises(JobTimeout):
+        job.get_result()
+
+
+def test_process_group():
+    # only a process that can time out gets a process group of its own
+    assert not jobs.PopenJob(["true"])._own_process_group
+    assert jobs.PopenJob(["true"], timeout=1)._own_process_group
+
+
+def test_killed_with_children():
+    job = jobs.BourneShell("sleep 10 & wait", timeout=0.2)
+    my_pool = pool.Pool()
+    my_pool.add_task(job)
+    before = monotonic()
+    my_pool.run()
+    assert monotonic() - before < 2
+    assert job.timed_out()
+
+
+class HangingJob(jobs.Job):
+    max_retries = 2
+
+    def __init__(self, **kw):
+        super(HangingJob, self).__init__(**kw)
+        self.attempts = 0
+
+    def run_job(self):
+        self.attempts += 1
+        yield jobs.BourneShell("sleep 10")
+        self.get_subtask_result()
+        yield self.Ok()
+
+
+def test_job_timeout_is_retried():
+    job = HangingJob(timeout=0.2)
+    my_pool = pool.Pool()
+    my_pool.add_task(job)
+    my_pool.run()
+    assert job.attempts == 2
+    assert not job.was_successful()
+    assert job.timed_out()
+    assert isinstance(job.get_result(), result.Timeout)
+
+
+def test_job_timeout_without_retry():
+    job = HangingJob(timeout=0.2, retry_policy=retry.RetryPolicy(retry_on_timeout=False))
+    my_pool = pool.Pool()
+    my_pool.add_task(job)
+    my_pool.run()
+    assert job.attempts == 1
+    assert job.timed_out()
+
+
+class SubtaskTimeoutJob(jobs.Job):
+
+    def run_job(self):
+        try:
+            yield jobs.BourneShell("sleep 10", timeout=0.2)
+            self.get_subtask_result()
+        except JobTimeout:
+            self.fallback = True
+        yield self.Ok()
+
+
+def test_subtask_timeout():
+    job = SubtaskTimeoutJob()
+    my_pool = pool.Pool()
+    my_pool.add_task(job)
+    my_pool.run()
+    assert job.fallback
+    assert job.was_successful()
+
+
+def test_pool_deadline():
+    my_pool = pool.Pool(pool_size=2, deadline=monotonic() + 0.3)
+    hanging_jobs = [jobs.PopenJob(["sleep", "10"]) for _ in range(4)]
+    for job in hanging_jobs:
+        my_pool.add_task(job)
+    before = monotonic()
+    my_pool.run()
+    assert monotonic() - before < 2
+    assert len(my_pool.finished_tasks) == 4
+    assert not any(my_pool.results)
+    assert all(job.timed_out() for job in hanging_jobs)
+    # the last two jobs never got a slot
+    assert [job.proc is None for job in hanging_jobs] == [False, False, True, True]
@@ -0,0 +1,164 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+
+from context import jobs, pool
+
+
+def test_bandwidth_share():
+    bandwidth = jobs.BandwidthShare(1000, 4)
+    shares = [bandwidth.acquire() for _ in range(4)]
+    assert shares == [250, 250, 250, 250]
+    bandwidth.release(shares[0])
+    bandwidth.release(shares[1])
+    assert bandwidth.acquire() == 250
+    assert bandwidth.allocated <= 1000
+
+
+def test_rsync_command():
+    job = jobs.TransferJob("hosta", ["a", "b"], "/tmp/dest/", user="deploy", compress=True, delta=False,
+                           bwlimit=1000, parallel=2, options=["BatchMode=yes"])
+    command = job.rsync_command(["a"], job.get_bwlimit(None))
+    assert command[:5] == ["rsync", "-a", "--partial", "-z", "--whole-file"]
+    assert "--bwlimit=500" in command
+    assert command[-2:] == ["a", "deploy@hosta:/tmp/dest/"]
+    assert job.get_bwlimit(200) == 100
+
+
+def test_chunks_are_balanced(tmpdir):
+    sources = []
+    for name, size in [("a", 100), ("b", 60), ("c", 50), ("d", 10)]:
+        path = tmpdir.join(name)
+        path.write("x" * size)
+        sources.append(str(path))
+    job = jobs.TransferJob("hosta", sources, "/dest", parallel=2)
+    chunks = job.get_chunks()
+    assert sorted(len(chunk) for chunk in chunks) == [2, 2]
+    assert [os.path.basename(path) for path in chunks[0]] == ["a", "d"]
+
+
+class LocalTransferJob(jobs.TransferJob):
+
+    def rsync_command(self, chunk, bwlimit=None):
+        return ["cp"] + chunk + [self.destination]
+
+    def remote_command(self, command):
+        return jobs.BourneShell(command, stdout=jobs.PIPE, stderr=jobs.PIPE)
+
+
+def run(job):
+    tasks = pool.Pool(pool_size=1)
+    tasks.add_task(job)
+    tasks.run()
+    return job
+
+
+def test_transfer_and_verify(tmpdir):
+    destination = tmpdir.mkdir("dest")
+    sources = []
+    for name in ["a", "b", "c"]:
+        path = tmpdir.join(name)
+        path.write(name * 100)
+        sources.append(str(path))
+
+    bandwidth = jobs.BandwidthShare(1000, 2)
+    job = run(LocalTransferJob("localhost", sources, str(destination), parallel=2, bandwidth=bandwidth))
+    assert job.was_successful()
+    assert sorted(os.listdir(str(destination))) == ["a", "b", "c"]
+    assert bandwidth.active == 0
+
+
+def test_verify_detects_mismatch(tmpdir):
+    destination = tmpdir.mkdir("dest")
+    source = tmpdir.join("a")
+    source.write("boerewors")
+
+    class BrokenTransferJob(LocalTransferJob):
+        def rsync_command(self, chunk, bwlimit=None):
+            return ["sh", "-c", "echo broken > {}/a".format(self.destination)]
+
+    job = run(BrokenTransferJob("localhost", [str(source)], str(destination)))
+    assert not job.was_successful()
+    assert "checksum mismatch: a" in str(job.get_result(can_fail=True))
+
+
+class TreeTransferJob(LocalTransferJob):
+
+    def rsync_command(self, chunk, bwlimit=None):
+        return ["cp", "-r"] + chunk + [self.destination]
+
+
+def test_verify_directories(tmpdir):
+    destination = tmpdir.mkdir("dest")
+    for directory in ["one", "two"]:
+        tmpdir.mkdir(directory).join("a").write(directory)
+    tmpdir.join("one").mkdir("sub").join("b").write("b")
+    sources = [str(tmpdir.join("one")), str(tmpdir.join("two"))]
+    job = TreeTransferJob("localhost", sources, str(destination))
+    # the same name in two directories are two files on the host
+    assert sorted(job.get_copied_files()) == ["one/a", "one/sub/b", "two/a"]
+    assert run(job).was_successful()
+
+    destination.join("one", "sub", "b").write("broken")
+    destination.join("two", "a").remove()
+
+    class NoCopyJob(TreeTransferJob):
+        def rsync_command(self, chunk, bwlimit=None):
+            return ["true"]
+
+    job = run(NoCopyJob("localhost", sources, str(destination)))
+    assert not job.was_successful()
+    assert "checksum mismatch: one/sub/b, two/a" in str(job.get_result(can_fail=True))
+
+
+def test_nothing_to_verify(tmpdir):
+    # an empty directory, the host is not asked for checksums
+    class NoRemoteJob(TreeTransferJob):
+        def remote_command(self, command):
+            raise AssertionError(command)
+
+    job = run(NoRemoteJob("localhost", [str(tmpdir.mkdir("empty"))], str(tmpdir.mkdir("dest"))))
+    assert job.was_successful()
+
+
+def test_timed_out_chunk_fails_the_job(tmpdir):
+    source = tmpdir.join("a")
+    source.write("boerewors")
+
+    class SlowTransferJob(LocalTransferJob):
+        def rsync_command(self, chunk, bwlimit=None):
+            return ["sleep", "10"]
+
+    bandwidth = jobs.BandwidthShare(1000, 1)
+    job = run(SlowTransferJob("localhost", [str(source)], str(tmpdir.mkdir("dest")), bandwidth=bandwidth,
+                              timeout=0.2))
+    assert not job.was_successful()
+    assert "JobTimeout" in str(job.get_result(can_fail=True))
+    assert bandwidth.active == 0
+
+
+def test_checksums_are_kept_by_full_path(tmpdir):
+    sources = []
+    for directory in ["one", "two"]:
+        path = tmpdir.mkdir(directory).join("a")
+        path.write(directory)
+        sources.append(str(path))
+    checksums = {}
+    first = jobs.local_checksum(sources[0], checksums)
+    second = jobs.local_checksum(sources[1], checksums)
+    assert first is not second
+    assert len(checksums) == 2
+    assert jobs.local_checksum(sources[0], checksums) is first
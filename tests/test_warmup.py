@@ -0,0 +1,157 @@
+# Copyright 2017 trivago N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import threading
+import time
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from context import BoereworsExecutor, pool, runners, warmup
+
+
+class CacheHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, nagle would delay the body until the client acks the headers
+    disable_nagle_algorithm = True
+    # the first requests of every path are slow, like a cold cache
+    cold_requests = 3
+    seen = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with CacheHandler.lock:
+            CacheHandler.seen[self.path] = CacheHandler.seen.get(self.path, 0) + 1
+            cold = CacheHandler.seen[self.path] <= CacheHandler.cold_requests
+        if cold:
+            time.sleep(0.05)
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the requests in flight are dropped when a host is warm
+        pass
+
+
+@pytest.fixture
+def host():
+    CacheHandler.seen = {}
+    CacheHandler.cold_requests = 3
+    httpd = Server(("127.0.0.1", 0), CacheHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "127.0.0.1:{}".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_percentiles():
+    assert warmup.percentiles([4, 1, 3, 2], (0, 50, 95, 100)) == pytest.approx([1, 2.5, 3.85, 4])
+    assert warmup.percentiles([], (50,)) == [None]
+    histogram = warmup.LatencyHistogram()
+    for latency in (0.0005, 0.003, 0.003, 7):
+        histogram.add(latency)
+    histogram.add_error()
+    summary = histogram.summary()
+    assert summary['requests'] == 4
+    assert summary['errors'] == 1
+    assert summary['histogram'] == {"<=0.001": 1, "<=0.005": 2, ">5": 1}
+
+
+def test_rate(host):
+    requests = warmup.WarmupRequests(["http://{}/".format(host)], rps=40, concurrency=4, p95=0, max_duration=0.5)
+    started = time.time()
+    assert requests.get_result() is False
+    assert time.time() - started < 1
+    # 40 requests per second for half a second, not as many as the host could answer
+    assert 15 <= requests._sent <= 22
+
+
+class WarmupRunner(runners.Runner):
+
+    def __init__(self, host, **warmup_params):
+        super(WarmupRunner, self).__init__()
+        paths = ["/hotel/{}".format(idx) for idx in range(5)]
+        self.stage = warmup.WarmupStage([host], paths, **warmup_params)
+
+    def get_stages(self):
+        yield self.stage
+
+
+def test_warmup_stage(host):
+    runner = WarmupRunner(host, rps=500, concurrency=4, p95=0.02, window=20, max_duration=10)
+    assert BoereworsExecutor(runners=[runner]).run([])
+    latency = runner.stage.collect_summary()['latency'][host]
+    # the cold requests are in the histogram, but the host was let in once the last window was fast
+    assert latency['requests'] >= 20
+    assert latency['p99'] >= 0.05
+    assert latency['p50'] < 0.02
+    assert latency['errors'] == 0
+    assert sum(CacheHandler.seen.values()) >= latency['requests']
+
+
+def test_cold_host(host):
+    CacheHandler.cold_requests = 10 ** 6
+    runner = WarmupRunner(host, rps=500, concurrency=2, p95=0.02, window=10, max_duration=0.5)
+    assert not BoereworsExecutor(runners=[runner]).run([])
+    job = runner.stage._joblist[0]
+    assert not job.was_successful()
+    assert "p95 of {} still".format(host) in str(job._result.value)
+
+
+def test_stage_params():
+    stage = warmup.WarmupStage(["hosta"], ["/"], pool_size=4, can_fail=True, timeout=30, is_canary=True,
+                               pool_params=dict(scheduling='priority'), rps=50)
+    assert stage.can_fail and stage.is_canary
+    assert stage.timeout == 30
+    assert stage.pool_params == dict(pool_size=4, scheduling='priority')
+    # the other keyword arguments are for the requests
+    assert stage.warmup_params == dict(rps=50)
+
+
+def test_request_timeout():
+    # accepts the connections, never answers
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(16)
+    requests = warmup.WarmupRequests(["http://127.0.0.1:{}/".format(server.getsockname()[1])], rps=100,
+                                     concurrency=2, request_timeout=0.3, max_duration=1.5)
+    my_pool = pool.Pool()
+    my_pool.add_task(requests)
+    started = time.time()
+    my_pool.run()
+    server.close()
+    assert time.time() - started < 3
+    assert not requests.warm
+    # the stuck requests were given up and new ones sent
+    assert requests.histogram.summary()['errors'] >= 4
+    assert requests._sent > 2